@@ -1,11 +1,33 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
-from pymongo import MongoClient
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, Response, stream_with_context, g
+from pymongo import (MongoClient, ASCENDING, DESCENDING, InsertOne, UpdateOne, UpdateMany, DeleteMany, ReturnDocument,
+                     monitoring)
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from dotenv import load_dotenv, find_dotenv
 from flask_bcrypt import Bcrypt
 from openai import OpenAI
 import os
+import re
+import io
 import json
+import bson
+import bisect
+import heapq
+import itertools
+import math
+import random
+import hashlib
+import hmac
+import threading
+import uuid
+import contextvars
+import functools
+import cProfile
+import pstats
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, time
+from time import perf_counter
 
 # Load .env file
 load_dotenv(find_dotenv(), override=True)
@@ -21,13 +43,821 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 bcrypt = Bcrypt(app)
 app.secret_key = SECRET_KEY
 
+
+# === START OF REQUEST TRACING ===
+# Every request (and every background planner job) gets a trace with an ID,
+# sent back in the X-Trace-Id header. Spans for OpenAI calls, Mongo commands
+# (through pymongo's command monitoring), tool functions and the planner add
+# their time and count to the current trace and to a latency histogram per
+# span name. /trace_stats serves p50/p95/p99 per route and span, /metrics the
+# histograms, and requests slower than TRACE_LOG_MIN_MS are logged with their
+# trace ID and per-kind breakdown. For streamed completions the OpenAI span
+# ends when the stream opens.
+TRACE_LOG_MIN_MS = float(os.getenv("TRACE_LOG_MIN_MS", "250"))
+TRACE_RECENT_LIMIT = int(os.getenv("TRACE_RECENT_LIMIT", "100"))
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+request_latency = {}  # route -> histogram (see METRICS)
+span_latency = {}  # (kind, name) -> histogram
+recent_traces = deque(maxlen=TRACE_RECENT_LIMIT)
+_trace_lock = threading.Lock()
+
+
+def start_trace(route):
+    """Starts a trace for this request or job. Returns the token to pass to finish_trace."""
+    return _current_trace.set({"id": uuid.uuid4().hex[:16], "route": route, "started": perf_counter(),
+                               "spans": {}, "tokens": 0})
+
+
+def current_trace_id():
+    trace = _current_trace.get()
+    return trace["id"] if trace else "-"
+
+
+def record_span(kind, name, seconds):
+    trace = _current_trace.get()
+    with _trace_lock:
+        observe_histogram(span_latency.setdefault((kind, name), new_histogram()), seconds)
+        if trace is not None:
+            span = trace["spans"].setdefault(kind, {"count": 0, "seconds": 0.0})
+            span["count"] += 1
+            span["seconds"] += seconds
+
+
+def record_trace_tokens(tokens):
+    trace = _current_trace.get()
+    if trace is not None:
+        with _trace_lock:
+            trace["tokens"] += tokens
+
+
+@contextmanager
+def trace_span(kind, name):
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        record_span(kind, name, perf_counter() - started)
+
+
+def traced(kind, name=None):
+    """Decorator: runs the function inside a trace_span."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with trace_span(kind, name or function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def finish_trace(token, error=None):
+    trace = _current_trace.get()
+    try:
+        _current_trace.reset(token)
+    except ValueError:  # Finished in a different context than it started in
+        _current_trace.set(None)
+    if trace is None:
+        return
+    seconds = perf_counter() - trace["started"]
+    spans = {kind: {"count": span["count"], "ms": round(span["seconds"] * 1000, 1)}
+             for kind, span in trace["spans"].items()}
+    with _trace_lock:
+        observe_histogram(request_latency.setdefault(trace["route"], new_histogram()), seconds)
+        recent_traces.append({"trace_id": trace["id"], "route": trace["route"], "ms": round(seconds * 1000, 1),
+                              "spans": spans, "tokens": trace["tokens"], "error": error is not None})
+    if seconds * 1000 >= TRACE_LOG_MIN_MS or error is not None:
+        breakdown = "".join(f" | {kind} {span['ms']:.0f}ms x{span['count']}" for kind, span in spans.items())
+        print(f"[trace {trace['id']}] {trace['route']} {seconds * 1000:.0f}ms{breakdown} | {trace['tokens']} tokens")
+
+
+def get_trace_stats():
+    def summary(histogram):
+        quantiles = {f"p{int(q * 100)}_ms": round((histogram_quantile(histogram, q) or 0) * 1000, 1)
+                     for q in (0.5, 0.95, 0.99)}
+        return dict(count=histogram["count"], mean_ms=round(histogram["sum"] / histogram["count"] * 1000, 1),
+                    **quantiles)
+
+    with _trace_lock:
+        return {
+            "requests": {route: summary(histogram) for route, histogram in request_latency.items()},
+            "spans": {f"{kind}:{name}": summary(histogram) for (kind, name), histogram in span_latency.items()},
+            "recent": list(recent_traces)
+        }
+
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """Records every Mongo command as a "mongo" span."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record_span("mongo", event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        record_span("mongo", event.command_name, event.duration_micros / 1e6)
+
+
+@app.before_request
+def _start_request_trace():
+    if request.endpoint != "static":
+        # The endpoint, not the path, so route labels stay a fixed set whatever URLs clients send
+        g.trace_token = start_trace(request.endpoint or "unmatched")
+
+
+@app.after_request
+def _add_trace_header(response):
+    if _current_trace.get() is not None:
+        response.headers["X-Trace-Id"] = current_trace_id()
+    return response
+
+
+@app.teardown_request
+def _finish_request_trace(error=None):
+    token = g.pop("trace_token", None)
+    if token is not None:
+        finish_trace(token, error)
+
+
+def detach_request_trace():
+    """For streamed responses, which outlive the request: the caller finishes the returned trace itself."""
+    return g.pop("trace_token", None)
+
+
+# === END OF REQUEST TRACING ===
+
 # Connect to MongoDB
-client = MongoClient(MONGO_URI)
+client = MongoClient(MONGO_URI, event_listeners=[MongoCommandTracer()])
 db = client["SmartSchedule"]
 users_collection = db["users"]
 
+# === START OF NORMALIZED STORAGE ===
+# The users document only holds auth and settings (preferences, study_windows).
+# Everything that grows with use lives in its own collection, one document per
+# item with a "username" field, so reads can fetch just what they need through
+# the compound indexes below. migrate_storage.py moves old embedded documents over.
+tasks_collection = db["tasks"]
+tests_collection = db["tests"]
+classes_collection = db["classes"]
+plan_blocks_collection = db["plan_blocks"]
+chat_messages_collection = db["chat_messages"]
+daily_digests_collection = db["daily_digests"]  # Precomputed check-in replies, see DAILY DIGESTS
+leases_collection = db["leases"]  # Locks shared by every process, see LEASES
+planner_jobs_collection = db["planner_jobs"]  # Background planner runs, see PLANNER JOB QUEUE
+plan_changes_collection = db["plan_changes"]  # Dates each planner save rewrote, see DATA ACCESS LAYER
+
+# Storage-only fields that are never sent to the client or the model
+ITEM_PROJECTION = {"_id": 0, "username": 0, "expires_at": 0}
+
+# field name in the old user document -> collection that now stores it
+USER_ITEM_COLLECTIONS = {
+    "schedule": classes_collection,
+    "tasks": tasks_collection,
+    "tests": tests_collection,
+    "generated_plan": plan_blocks_collection
+}
+
+
+def ensure_indexes():
+    users_collection.create_index("username", unique=True)
+    tasks_collection.create_index([("username", ASCENDING), ("deadline", ASCENDING)])
+    tasks_collection.create_index([("username", ASCENDING), ("name", ASCENDING)])
+    tests_collection.create_index([("username", ASCENDING), ("deadline", ASCENDING)])
+    tests_collection.create_index([("username", ASCENDING), ("name", ASCENDING)])
+    # Expiry sweeper: covered scans of everything past its deadline, for all users
+    tasks_collection.create_index([("expires_at", ASCENDING), ("username", ASCENDING)])
+    tests_collection.create_index([("expires_at", ASCENDING), ("username", ASCENDING)])
+    plan_blocks_collection.create_index([("date", ASCENDING), ("username", ASCENDING)])
+    classes_collection.create_index([("username", ASCENDING), ("day", ASCENDING), ("start_time", ASCENDING)])
+    classes_collection.create_index([("username", ASCENDING), ("subject", ASCENDING)])
+    plan_blocks_collection.create_index([("username", ASCENDING), ("date", ASCENDING), ("start_time", ASCENDING)])
+    chat_messages_collection.create_index([("username", ASCENDING), ("_id", ASCENDING)])
+    daily_digests_collection.create_index([("username", ASCENDING), ("date", ASCENDING)], unique=True)
+    daily_digests_collection.create_index("expires_at", expireAfterSeconds=0)
+    leases_collection.create_index("expires_at", expireAfterSeconds=3600)  # Long-expired leases only
+    planner_jobs_collection.create_index([("username", ASCENDING), ("submitted_at", DESCENDING)])
+    planner_jobs_collection.create_index("expires_at", expireAfterSeconds=0)
+    plan_changes_collection.create_index([("username", ASCENDING), ("version", ASCENDING)], unique=True)
+    plan_changes_collection.create_index("expires_at", expireAfterSeconds=0)
+
+
+def save_chat_turn(username, turn_messages, reset_history=False):
+    """Appends this turn's messages. reset_history drops everything (and the summary) before them first."""
+    if reset_history:
+        chat_messages_collection.delete_many({"username": username})
+        users_collection.update_one({"username": username}, {"$unset": {"chat_summary": ""}})
+    if turn_messages:
+        chat_messages_collection.insert_many([dict(message, username=username) for message in turn_messages])
+
+
+# === END OF NORMALIZED STORAGE ===
+
+
+# === START OF LEASES ===
+# A lease is a lock shared by every process of the deployment (workers,
+# hosts): one document per lease name with its holder and an expiry. A
+# holder that dies just lets its lease run out.
+LEASE_HOLDER_PREFIX = uuid.uuid4().hex[:12]
+
+
+def lease_holder():
+    # Forked workers share the prefix, so the PID tells them apart
+    return f"{LEASE_HOLDER_PREFIX}:{os.getpid()}"
+
+
+def acquire_lease(name, seconds):
+    """Takes (or renews) the named lease for this process for seconds. False if someone else holds it."""
+    now = datetime.now()
+    holder = lease_holder()
+    try:
+        leases_collection.update_one(
+            {"_id": name, "$or": [{"holder": holder}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"holder": holder, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True)
+    except DuplicateKeyError:
+        return False  # Held by someone else, so the upsert collided with their document
+    return True
+
+
+def acquire_leases(names, seconds):
+    """acquire_lease for many names in one round trip. Returns the set of names this process now holds."""
+    now = datetime.now()
+    holder = lease_holder()
+    names = list(names)
+    if not names:
+        return set()
+    try:
+        leases_collection.bulk_write([
+            UpdateOne({"_id": name, "$or": [{"holder": holder}, {"expires_at": {"$lt": now}}]},
+                      {"$set": {"holder": holder, "expires_at": now + timedelta(seconds=seconds)}}, upsert=True)
+            for name in names
+        ], ordered=False)
+    except BulkWriteError as e:
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+        held = {names[error["index"]] for error in e.details["writeErrors"]}
+        return set(names) - held
+    return set(names)
+
+
+def release_lease(name):
+    leases_collection.delete_one({"_id": name, "holder": lease_holder()})
+
+
+def release_leases(names):
+    leases_collection.delete_many({"_id": {"$in": list(names)}, "holder": lease_holder()})
+
+
+# === END OF LEASES ===
+
+
+# === START OF DATA ACCESS LAYER ===
+# All reads go through _find / _find_one with the projection their caller
+# needs and a call-site name. read_stats keeps calls and documents per call
+# site (served from /read_stats) so the effect of a projection shows up in
+# numbers. Set TRACK_READ_BYTES=1 to add up BSON bytes too; that re-encodes
+# every document read, so it is off by default.
+TRACK_READ_BYTES = os.getenv("TRACK_READ_BYTES", "0") == "1"
+read_stats = {}
+_read_stats_lock = threading.Lock()
+
+USER_SETTINGS_PROJECTION = {"_id": 0, "username": 1, "preferences": 1, "study_windows": 1}
+# What build_work_queue reads from a task or test
+WORK_ITEM_PROJECTION = {"_id": 0, "name": 1, "deadline": 1, "date": 1, "priority": 1, "task_type": 1,
+                        "test_type": 1, "duration_hours": 1}
+
+
+def _record_read(site, documents):
+    size = sum(len(bson.encode(document)) for document in documents) if TRACK_READ_BYTES else 0
+    with _read_stats_lock:
+        stats = read_stats.setdefault(site, {"calls": 0, "documents": 0, "bytes": 0})
+        stats["calls"] += 1
+        stats["documents"] += len(documents)
+        stats["bytes"] += size
+
+
+def _find_one(collection, site, query, projection):
+    document = collection.find_one(query, projection)
+    _record_read(site, [document] if document else [])
+    return document
+
+
+def _find(collection, site, query, projection, sort=None, limit=0):
+    cursor = collection.find(query, projection)
+    if sort:
+        cursor = cursor.sort(sort)
+    if limit:
+        cursor = cursor.limit(limit)
+    documents = list(cursor)
+    _record_read(site, documents)
+    return documents
+
+
+def get_read_stats():
+    with _read_stats_lock:
+        return {site: dict(stats) for site, stats in read_stats.items()}
+
+
+def user_exists(username, site):
+    return _find_one(users_collection, site, {"username": username}, {"_id": 1}) is not None
+
+
+def get_password_hash(username):
+    user = _find_one(users_collection, "login", {"username": username}, {"_id": 0, "password": 1})
+    return user.get("password") if user else None
+
+
+def get_user_settings(username, site, extra_fields=()):
+    """The small users document: username, preferences and study_windows (+ extra_fields). None if missing."""
+    projection = dict(USER_SETTINGS_PROJECTION, **{field: 1 for field in extra_fields})
+    return _find_one(users_collection, site, {"username": username}, projection)
+
+
+def attach_user_items(user_docs, include_plan=True, site="attach_user_items"):
+    """
+    Fills in schedule/tasks/tests (and generated_plan) on already-loaded user
+    documents, using one $in query per collection for the whole batch.
+    Items keep their insertion order; plan blocks are sorted by date and time.
+    """
+    users_by_name = {user["username"]: user for user in user_docs}
+    for field, collection in USER_ITEM_COLLECTIONS.items():
+        if field == "generated_plan" and not include_plan:
+            continue
+        for user in user_docs:
+            user[field] = []
+        sort = [("date", ASCENDING), ("start_time", ASCENDING)] if field == "generated_plan" else [("_id", ASCENDING)]
+        items = _find(collection, f"{site}:{field}", {"username": {"$in": list(users_by_name)}},
+                      {"_id": 0, "expires_at": 0}, sort)
+        for item in items:
+            users_by_name[item.pop("username")][field].append(item)
+    return user_docs
+
+
+def load_user_data(username, include_plan=True, site="load_user_data", extra_fields=()):
+    """Loads a user in the old single-document shape. Returns None if the user does not exist."""
+    user_data = get_user_settings(username, site, extra_fields)
+    if not user_data:
+        return None
+    return attach_user_items([user_data], include_plan, site)[0]
+
+
+def get_plan_for_date(username, date_str, site):
+    return _find(plan_blocks_collection, site, {"username": username, "date": date_str}, ITEM_PROJECTION,
+                 [("start_time", ASCENDING)])
+
+
+def get_work_queue_items(username, site):
+    """The user's tasks and tests, with just the fields the planner's work queue needs."""
+    return (_find(tasks_collection, f"{site}:tasks", {"username": username}, WORK_ITEM_PROJECTION) +
+            _find(tests_collection, f"{site}:tests", {"username": username}, WORK_ITEM_PROJECTION))
+
+
+def load_chat_history(username, limit=0, projection=None, site="chat:history"):
+    """Oldest-first chat messages. With a limit, only the newest `limit` of them."""
+    if not limit:
+        return _find(chat_messages_collection, site, {"username": username}, projection or ITEM_PROJECTION,
+                     [("_id", ASCENDING)])
+    newest_first = _find(chat_messages_collection, site, {"username": username}, projection or ITEM_PROJECTION,
+                         [("_id", DESCENDING)], limit)
+    return newest_first[::-1]
+
+
+def get_chat_summary(username):
+    user = _find_one(users_collection, "chat:summary", {"username": username}, {"_id": 0, "chat_summary": 1})
+    return (user or {}).get("chat_summary")
+
+
+# --- Per-user data versions ---
+# The users document keeps a counter per /get_schedule section ("versions").
+# Every write that changes a section bumps its counter in the same flush, so
+# the counters name a state of the user's data: /get_schedule uses them as its
+# ETag and as the since=<version> token for delta responses.
+DATA_VERSION_SECTIONS = ("schedule", "tasks", "tests", "generated_plan", "settings")
+# collection name -> section its writes change
+DATA_VERSION_SECTION_BY_COLLECTION = {
+    "classes": "schedule",
+    "tasks": "tasks",
+    "tests": "tests",
+    "plan_blocks": "generated_plan",
+    "users": "settings"
+}
+
+
+def data_version_update(sections):
+    """The $inc update that bumps these sections' counters."""
+    return {"$inc": {f"versions.{section}": 1 for section in sections}}
+
+
+def get_data_versions(username, site):
+    """{section: counter} for this user, or None if the user does not exist."""
+    user = _find_one(users_collection, site, {"username": username}, {"_id": 0, "versions": 1})
+    if user is None:
+        return None
+    versions = user.get("versions", {})
+    return {section: versions.get(section, 0) for section in DATA_VERSION_SECTIONS}
+
+
+# Each planner save also logs the dates whose blocks it rewrote, under the
+# generated_plan version it produced. A since=<version> request whose plan
+# versions are all logged gets just those days' blocks; any other plan write
+# (deletes, renames, the expiry sweep) leaves a gap, and the whole plan is sent.
+PLAN_CHANGE_LOG_SECONDS = int(os.getenv("PLAN_CHANGE_LOG_SECONDS", "86400"))
+
+
+def log_plan_change(username, version, dates):
+    plan_changes_collection.insert_one({
+        "username": username, "version": version, "dates": dates,
+        "expires_at": datetime.now() + timedelta(seconds=PLAN_CHANGE_LOG_SECONDS)
+    })
+
+
+def get_plan_change_dates(username, since_version, version, site):
+    """The dates the plan changed on between these generated_plan versions, or None if a change was not logged."""
+    if since_version > version:
+        return None
+    changes = _find(plan_changes_collection, site,
+                    {"username": username, "version": {"$gt": since_version, "$lte": version}},
+                    {"_id": 0, "version": 1, "dates": 1}, [("version", ASCENDING)])
+    if [change["version"] for change in changes] != list(range(since_version + 1, version + 1)):
+        return None
+    return sorted({date for change in changes for date in change["dates"]})
+
+
+def format_data_version(versions):
+    return ".".join(str(versions[section]) for section in DATA_VERSION_SECTIONS)
+
+
+def parse_data_version(token):
+    """The {section: counter} a since=<version> token names, or None if it is malformed."""
+    parts = (token or "").split(".")
+    if len(parts) != len(DATA_VERSION_SECTIONS) or not all(part.isdigit() for part in parts):
+        return None
+    return dict(zip(DATA_VERSION_SECTIONS, map(int, parts)))
+
+
+def load_schedule_sections(username, sections, site, merge_plan=False, plan_dates=None):
+    """
+    The /get_schedule payload fields for just these sections. merge_plan
+    run-length merges generated_plan. With plan_dates, generated_plan is sent
+    as generated_plan_changes: those days' blocks, which replace the client's.
+    """
+    payload = {}
+    if "settings" in sections:
+        settings = get_user_settings(username, f"{site}:settings") or {}
+        payload["preferences"] = settings.get("preferences", {})
+        payload["study_windows"] = settings.get("study_windows", [])
+    for field, collection in USER_ITEM_COLLECTIONS.items():
+        if field not in sections:
+            continue
+        query = {"username": username}
+        sort = [("_id", ASCENDING)]
+        if field == "generated_plan":
+            sort = [("date", ASCENDING), ("start_time", ASCENDING)]
+            if plan_dates is not None:
+                query["date"] = {"$in": plan_dates}
+        payload[field] = _find(collection, f"{site}:{field}", query, ITEM_PROJECTION, sort)
+    if merge_plan and "generated_plan" in payload:
+        payload["generated_plan"] = merge_plan_blocks(payload["generated_plan"])
+    if plan_dates is not None and "generated_plan" in payload:
+        payload["generated_plan_changes"] = {"dates": plan_dates, "blocks": payload.pop("generated_plan")}
+    return payload
+
+
+# === END OF DATA ACCESS LAYER ===
+
+
+# === START OF WRITE BATCHER ===
+# The tool functions queue their writes on a batch instead of writing straight
+# to Mongo, and a /chat turn flushes its batch once, before anything reads the
+# data back. The batching needs MongoDB 8.0+ to save round trips: there the
+# whole batch is a single client-level bulk_write (every collection, one round
+# trip, per-write results). Older servers get one ordered bulk_write per
+# collection, split where two writes would otherwise share the count a reply
+# depends on, which costs about as many round trips as writing directly.
+# Order is kept within each collection. The data version bumps go last, in
+# their own bulk_write, and only for the sections whose writes changed
+# something, so a client never sees a new version before the data it names.
+
+WRITE_MODELS = {
+    "insert_one": InsertOne,
+    "update_one": UpdateOne,
+    "update_many": UpdateMany,
+    "delete_many": DeleteMany
+}
+# BulkWriteResult field a write's count is read from
+WRITE_RESULT_FIELDS = {
+    "insert_one": "inserted_count",
+    "update_one": "modified_count",
+    "update_many": "modified_count",
+    "delete_many": "deleted_count"
+}
+CLIENT_BULK_WRITE_MIN_WIRE_VERSION = 25  # MongoDB 8.0
+_client_bulk_write_supported = None
+write_batch_stats = {"flushes": 0, "writes": 0, "round_trips": 0}
+_write_batch_stats_lock = threading.Lock()
+
+
+def new_write_batch():
+    return {"writes": []}
+
+
+def queue_write(batch, collection, kind, *args, counted=False):
+    """
+    Queues one write (kind is a WRITE_MODELS key, args its model's arguments).
+    Returns a handle whose "count" (inserted/modified/deleted) is set by
+    flush_writes. Pass counted=True when a reply depends on that count.
+    """
+    writes = batch["writes"]
+    previous = next((write for write in reversed(writes) if write["collection"] is collection), None)
+    # Back-to-back $set updates of the same document collapse into one $set;
+    # both callers then share its count.
+    if (kind == "update_one" and previous and previous["kind"] == "update_one"
+            and previous["args"][0] == args[0] and set(previous["args"][1]) == set(args[1]) == {"$set"}):
+        previous["args"][1]["$set"].update(args[1]["$set"])
+        previous["counted"] = previous["counted"] or counted
+        return previous
+
+    write = {"collection": collection, "kind": kind, "args": args, "counted": counted, "count": None}
+    writes.append(write)
+    return write
+
+
+def _supports_client_bulk_write():
+    global _client_bulk_write_supported
+    if _client_bulk_write_supported is None:
+        try:
+            wire_version = client.admin.command("hello").get("maxWireVersion", 0)
+            _client_bulk_write_supported = (hasattr(client, "bulk_write") and
+                                            wire_version >= CLIENT_BULK_WRITE_MIN_WIRE_VERSION)
+            if not _client_bulk_write_supported:
+                print("Write batcher: needs MongoDB 8.0+ and PyMongo 4.9+ for single round trip flushes, "
+                      "using per-collection bulk_write")
+        except Exception as e:
+            print(f"Write batcher: could not check server version ({e}), using per-collection bulk_write")
+            _client_bulk_write_supported = False
+    return _client_bulk_write_supported
+
+
+def _collection_chunks(writes):
+    """
+    Yields (collection, writes) groups for per-collection bulk_writes. A counted
+    write never shares its result field with another write in its group.
+    """
+    by_collection = {}
+    for write in writes:
+        by_collection.setdefault(write["collection"].name, []).append(write)
+
+    for collection_writes in by_collection.values():
+        collection = collection_writes[0]["collection"]
+        chunk, used_fields, counted_fields = [], set(), set()
+        for write in collection_writes:
+            field = WRITE_RESULT_FIELDS[write["kind"]]
+            if field in counted_fields or (write["counted"] and field in used_fields):
+                yield collection, chunk
+                chunk, used_fields, counted_fields = [], set(), set()
+            chunk.append(write)
+            used_fields.add(field)
+            if write["counted"]:
+                counted_fields.add(field)
+        yield collection, chunk
+
+
+def _data_version_writes(writes):
+    """
+    One $inc of the data version counters per user whose sections these
+    flushed writes changed. A write changed something if its count (inserted,
+    modified or deleted) is above zero; in a per-collection chunk that count
+    covers the chunk's other writes of the same kind, which are in the same
+    section. A write sent without a count (its bulk_write failed) may have
+    changed something too.
+    """
+    sections_by_user = {}
+    for write in writes:
+        section = DATA_VERSION_SECTION_BY_COLLECTION.get(write["collection"].name)
+        username = write["args"][0].get("username")
+        if section and isinstance(username, str) and write["count"] != 0:
+            sections_by_user.setdefault(username, set()).add(section)
+    return [UpdateOne({"username": username}, data_version_update(sorted(sections)))
+            for username, sections in sections_by_user.items()]
+
+
+def flush_writes(batch):
+    """Sends every queued write and fills in each handle's "count"."""
+    writes = batch["writes"]
+    if not writes:
+        return
+    batch["writes"] = []
+
+    sent = []  # Writes that reached the server, whether or not their bulk_write succeeded
+    round_trips = 0
+    try:
+        if _supports_client_bulk_write():
+            models = [WRITE_MODELS[write["kind"]](*write["args"], namespace=f"{db.name}.{write['collection'].name}")
+                      for write in writes]
+            sent = writes
+            round_trips = 1
+            result = client.bulk_write(models, ordered=True, verbose_results=True)
+            for index, write in enumerate(writes):
+                if write["kind"] == "insert_one":
+                    write["count"] = 1 if index in result.insert_results else 0
+                elif write["kind"] == "delete_many":
+                    write["count"] = result.delete_results[index].deleted_count
+                else:
+                    write["count"] = result.update_results[index].modified_count
+        else:
+            for collection, chunk in _collection_chunks(writes):
+                sent.extend(chunk)
+                round_trips += 1
+                result = collection.bulk_write([WRITE_MODELS[write["kind"]](*write["args"]) for write in chunk],
+                                               ordered=True)
+                for write in chunk:
+                    write["count"] = getattr(result, WRITE_RESULT_FIELDS[write["kind"]])
+    finally:
+        # After every data write, so the new versions never name data that is not
+        # there yet. Also when a write failed: the ones before it are already saved.
+        version_writes = _data_version_writes(sent)
+        if version_writes:
+            users_collection.bulk_write(version_writes, ordered=False)
+            round_trips += 1
+
+    with _write_batch_stats_lock:
+        write_batch_stats["flushes"] += 1
+        write_batch_stats["writes"] += len(writes)
+        write_batch_stats["round_trips"] += round_trips
+
+
+def finish_writes(batch, own_batch, render_reply):
+    """
+    Ends a tool function. Called without a batch, the function flushed its own
+    writes and replies now; inside a turn the reply is a callable that the turn
+    renders after its flush.
+    """
+    if own_batch:
+        flush_writes(batch)
+        return render_reply()
+    return render_reply
+
+
+def get_write_batch_stats():
+    with _write_batch_stats_lock:
+        return dict(write_batch_stats)
+
+
+# === END OF WRITE BATCHER ===
+
+
+# === START OF METRICS (Prometheus) ===
+# Counters and latency histograms kept in process memory and rendered in the
+# Prometheus text format by /metrics. Histograms store a count per bucket of
+# LATENCY_BUCKETS (seconds) plus the sum, like a Prometheus histogram.
+# /metrics needs METRICS_TOKEN as a bearer token (Prometheus' "authorization"
+# scrape setting) and is off while it is unset.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PLANNER_PHASES = ("queue", "availability", "analysis", "slots", "allocation", "save")
+planner_metrics = {
+    "runs": {},  # status -> runs ("cached" for memoized results)
+    "phase_seconds": {},  # phase -> histogram
+    "items": 0, "slots": 0, "blocks_needed": 0, "blocks_allocated": 0
+}
+_metrics_lock = threading.Lock()
+
+# Opt-in sampling profiler: this fraction of planner runs is run under
+# cProfile. The stats go to PLANNER_PROFILE_DIR as .prof files if it is set,
+# otherwise the top functions are printed.
+PLANNER_PROFILE_SAMPLE_RATE = float(os.getenv("PLANNER_PROFILE_SAMPLE_RATE", "0"))
+PLANNER_PROFILE_DIR = os.getenv("PLANNER_PROFILE_DIR")
+_planner_profile_lock = threading.Lock()  # One profiler at a time
+
+
+def new_histogram():
+    return {"buckets": [0] * (len(LATENCY_BUCKETS) + 1), "count": 0, "sum": 0.0}
+
+
+def observe_histogram(histogram, seconds):
+    histogram["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    histogram["count"] += 1
+    histogram["sum"] += seconds
+
+
+def _prometheus_label_value(value):
+    """A label value escaped for the text exposition format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prometheus_labels(labels):
+    return "{" + ",".join(f'{name}="{_prometheus_label_value(value)}"'
+                          for name, value in labels.items()) + "}" if labels else ""
+
+
+def histogram_quantile(histogram, quantile):
+    """Estimates a quantile from the bucket counts, interpolating inside the bucket like Prometheus. Seconds."""
+    if not histogram["count"]:
+        return None
+    rank = quantile * histogram["count"]
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+        if count and cumulative + count >= rank:
+            return lower + (bound - lower) * (rank - cumulative) / count
+        cumulative += count
+        lower = bound
+    return LATENCY_BUCKETS[-1]  # In the +Inf bucket
+
+
+def prometheus_histogram_lines(name, labels, histogram):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram["buckets"]):
+        cumulative += count
+        lines.append(f"{name}_bucket{_prometheus_labels(dict(labels, le=bound))} {cumulative}")
+    lines.append(f"{name}_sum{_prometheus_labels(labels)} {histogram['sum']:.6f}")
+    lines.append(f"{name}_count{_prometheus_labels(labels)} {histogram['count']}")
+    return lines
+
+
+def _lap(planner_stats, phase, started):
+    """Adds the time since started to planner_stats' phase timings. Returns the new start."""
+    now = perf_counter()
+    if planner_stats is not None:
+        phases = planner_stats.setdefault("phase_seconds", {})
+        phases[phase] = phases.get(phase, 0.0) + now - started
+    return now
+
+
+def record_planner_run(status, planner_stats):
+    """Adds one planner run's phase timings and counts (see _compute_plan) to planner_metrics."""
+    with _metrics_lock:
+        planner_metrics["runs"][status] = planner_metrics["runs"].get(status, 0) + 1
+        for phase, seconds in planner_stats.get("phase_seconds", {}).items():
+            observe_histogram(planner_metrics["phase_seconds"].setdefault(phase, new_histogram()), seconds)
+        for counter in ("items", "slots", "blocks_needed", "blocks_allocated"):
+            planner_metrics[counter] += planner_stats.get(counter, 0)
+
+
+def profile_sampled(label, function, *args):
+    """Runs function(*args), under cProfile for a PLANNER_PROFILE_SAMPLE_RATE sample of calls."""
+    if PLANNER_PROFILE_SAMPLE_RATE <= 0 or random.random() >= PLANNER_PROFILE_SAMPLE_RATE:
+        return function(*args)
+    if not _planner_profile_lock.acquire(blocking=False):
+        return function(*args)
+    try:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(function, *args)
+    finally:
+        _planner_profile_lock.release()
+    if PLANNER_PROFILE_DIR:
+        profiler.dump_stats(os.path.join(PLANNER_PROFILE_DIR, f"{label}-{datetime.now():%Y%m%d-%H%M%S-%f}.prof"))
+    else:
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(15)
+        print(f"Profile of {label}:\n{summary.getvalue()}")
+    return result
+
+
+def render_metrics():
+    """Every metric in the Prometheus text exposition format."""
+    with _metrics_lock:
+        planner = {key: (dict(value) if isinstance(value, dict) else value) for key, value in planner_metrics.items()}
+    cache_stats = get_planner_cache_stats()
+    job_stats = get_planner_job_stats()
+    with _trace_lock:
+        requests = {route: dict(histogram, buckets=list(histogram["buckets"]))
+                    for route, histogram in request_latency.items()}
+        spans = {key: dict(histogram, buckets=list(histogram["buckets"])) for key, histogram in span_latency.items()}
+
+    lines = ["# TYPE smartscheduler_planner_runs_total counter"]
+    lines += [f'smartscheduler_planner_runs_total{{status="{status}"}} {count}'
+              for status, count in sorted(planner["runs"].items())]
+    lines.append("# TYPE smartscheduler_planner_phase_seconds histogram")
+    for phase in PLANNER_PHASES:
+        if phase in planner["phase_seconds"]:
+            lines += prometheus_histogram_lines("smartscheduler_planner_phase_seconds", {"phase": phase},
+                                                planner["phase_seconds"][phase])
+    for counter in ("items", "slots", "blocks_needed", "blocks_allocated"):
+        lines.append(f"# TYPE smartscheduler_planner_{counter}_total counter")
+        lines.append(f"smartscheduler_planner_{counter}_total {planner[counter]:g}")
+    for name in ("hits", "misses", "evictions"):
+        lines.append(f"# TYPE smartscheduler_planner_cache_{name}_total counter")
+        lines.append(f"smartscheduler_planner_cache_{name}_total {cache_stats[name]}")
+    for name in ("requested", "runs", "coalesced"):
+        lines.append(f"# TYPE smartscheduler_planner_jobs_{name}_total counter")
+        lines.append(f"smartscheduler_planner_jobs_{name}_total {job_stats[name]}")
+    lines.append("# TYPE smartscheduler_request_seconds histogram")
+    for route, histogram in sorted(requests.items()):
+        lines += prometheus_histogram_lines("smartscheduler_request_seconds", {"route": route}, histogram)
+    lines.append("# TYPE smartscheduler_span_seconds histogram")
+    for (kind, name), histogram in sorted(spans.items()):
+        lines += prometheus_histogram_lines("smartscheduler_span_seconds", {"kind": kind, "name": name}, histogram)
+    return "\n".join(lines) + "\n"
+
+
+# === END OF METRICS ===
+
 # Initialize OpenAI client
 openai_client = OpenAI(api_key=OPENAI_API_KEY)
+openai_client.chat.completions.create = traced("openai", "chat.completions.create")(
+    openai_client.chat.completions.create)
 
 # === V7 SYSTEM PROMPT (Daily Check-in Updated) ===
 SYSTEM_PROMPT = """
@@ -292,23 +1122,20 @@ tools = [
 ]
 
 
-# ---------- AUTH ROUTES (Unchanged) ----------
+# ---------- AUTH ROUTES ----------
 @app.route("/signup", methods=["GET", "POST"])
 def signup():
     if request.method == "POST":
         username = request.form["username"]
         password = request.form["password"]
-        if users_collection.find_one({"username": username}):
+        if user_exists(username, "signup"):
             return "Username already exists!"
         hashed_pw = bcrypt.generate_password_hash(password).decode("utf-8")
 
         users_collection.insert_one({
             "username": username, "password": hashed_pw,
-            "schedule": [], "tasks": [], "tests": [],
             "preferences": {"awake_time": "07:00", "sleep_time": "23:00"},  # Default values
-            "chat_history": [],
-            "study_windows": [],
-            "generated_plan": []
+            "study_windows": []
         })
 
         return redirect(url_for("login"))
@@ -320,13 +1147,10 @@ def login():
     if request.method == "POST":
         username = request.form["username"]
         password = request.form["password"]
-        user = users_collection.find_one({"username": username})
-        if user and bcrypt.check_password_hash(user["password"], password):
+        password_hash = get_password_hash(username)
+        if password_hash and bcrypt.check_password_hash(password_hash, password):
             session["username"] = username
-            users_collection.update_one(
-                {"username": username},
-                {"$set": {"chat_history": []}}
-            )
+            save_chat_turn(username, [], reset_history=True)
             return redirect(url_for("index"))
         return "Invalid credentials!"
     return render_template("login.html")
@@ -335,10 +1159,7 @@ def login():
 @app.route("/logout")
 def logout():
     if "username" in session:
-        users_collection.update_one(
-            {"username": session["username"]},
-            {"$set": {"chat_history": []}}
-        )
+        save_chat_turn(session["username"], [], reset_history=True)
     session.pop("username", None)
     return redirect(url_for("login"))
 
@@ -360,53 +1181,51 @@ def save_personalization():
     data = request.json
 
     try:
-        # 1. Save Preferences
+        # 1. Save Preferences and 2. Study Windows (one $set on the users document)
+        batch = new_write_batch()
         preferences = data.get("preferences", {})
-        users_collection.update_one(
-            {"username": username},
-            {"$set": {"preferences": preferences}}
-        )
+        queue_write(batch, users_collection, "update_one", {"username": username}, {"$set": {"preferences": preferences}})
 
-        # 2. Save Study Windows
         windows = data.get("study_windows", [])
-        save_study_windows_db(username, {"windows": windows})  # Use existing function
+        save_study_windows_db(username, {"windows": windows}, batch)  # Use existing function
+        flush_writes(batch)
 
-        # 3. Re-run the planner engine
-        planner_response = run_planner_engine_db(username, {})
-
-        if planner_response["status"] == "conflict":
-            return jsonify({
-                "reply": "Settings saved! But I found a scheduling conflict. Please choose which task to prioritize first:",
-                "action": "show_priority_modal",
-                "options": planner_response["options"]
-            })
-        else:
-            return jsonify({"reply": f"Settings saved! {planner_response['message']}"})
+        # 3. Re-run the planner engine (in the background; the client asks about conflicts when it finishes)
+        plan_job = submit_planner_job(username, {})
+        return jsonify({"reply": f"Settings saved! {PLANNER_QUEUED_NOTE}", "plan_job": planner_job_status(plan_job)})
 
     except Exception as e:
-        print(f"Error in /save_personalization: {e}")
+        print(f"[trace {current_trace_id()}] Error in /save_personalization: {e}")
         return jsonify({"reply": "Sorry, there was an error saving your settings."}), 500
 
 
-# --- This is our "ADD" function (Unchanged) ---
-def update_user_data(username, data_type, data):
+# --- This is our "ADD" function ---
+@traced("tool")
+def update_user_data(username, data_type, data, batch=None):
+    own_batch = batch is None
+    batch = new_write_batch() if own_batch else batch
+
     if data_type == "class":
-        users_collection.update_one({"username": username}, {"$push": {"schedule": data}})
+        queue_write(batch, classes_collection, "insert_one", dict(data, username=username))
     elif data_type == "task":
-        users_collection.update_one({"username": username}, {"$push": {"tasks": data}})
+        queue_write(batch, tasks_collection, "insert_one",
+                    dict(data, username=username, expires_at=parse_item_deadline(data)))
     elif data_type == "test":
         # Convert test 'date' to a full 'deadline' for consistency
         data['deadline'] = f"{data['date']}T23:59:59"
-        users_collection.update_one({"username": username}, {"$push": {"tests": data}})
+        queue_write(batch, tests_collection, "insert_one",
+                    dict(data, username=username, expires_at=parse_item_deadline(data)))
     elif data_type == "preference":
-        users_collection.update_one({"username": username}, {"$set": {"preferences": data}})
-        return f"Got it! I've saved your awake time as {data['awake_time']} and sleep time as {data['sleep_time']}."
+        queue_write(batch, users_collection, "update_one", {"username": username}, {"$set": {"preferences": data}})
+        return finish_writes(batch, own_batch, lambda: (
+            f"Got it! I've saved your awake time as {data['awake_time']} and sleep time as {data['sleep_time']}."))
 
-    return f"OK, I've added the new {data_type} to your schedule."
+    return finish_writes(batch, own_batch, lambda: f"OK, I've added the new {data_type} to your schedule.")
 
 
-# --- This is our "UPDATE TASK" function (Unchanged) ---
-def update_task_details_db(username, args):
+# --- This is our "UPDATE TASK" function ---
+@traced("tool")
+def update_task_details_db(username, args, batch=None):
     current_name = args.get("current_name")
 
     new_name = args.get("new_name")
@@ -417,141 +1236,254 @@ def update_task_details_db(username, args):
 
     updates = {}
 
-    target_array = "tasks"
-    task_search = users_collection.find_one({"username": username, "tasks.name": current_name})
-    if not task_search:
-        target_array = "tests"
-        task_search = users_collection.find_one({"username": username, "tests.name": current_name})
-
-    if not task_search:
-        return f"Sorry, I couldn't find an item named '{current_name}' to update."
-
     if new_name:
-        updates[f"{target_array}.$.name"] = new_name
-    if new_type:
-        # This logic handles renaming 'test_type' to 'task_type' if needed
-        if target_array == "tests":
-            updates[f"{target_array}.$.test_type"] = new_type
-        else:
-            updates[f"{target_array}.$.task_type"] = new_type
+        updates["name"] = new_name
     if new_deadline:
-        updates[f"{target_array}.$.deadline"] = new_deadline
+        updates["deadline"] = new_deadline
+        updates["expires_at"] = parse_item_deadline({"deadline": new_deadline})
     if new_priority:
-        updates[f"{target_array}.$.priority"] = new_priority
+        updates["priority"] = new_priority
     if new_duration:
-        updates[f"{target_array}.$.duration_hours"] = new_duration
+        updates["duration_hours"] = new_duration
 
-    if not updates:
+    if not updates and not new_type:
         return "You didn't tell me what to update (name, type, deadline, priority, or duration)!"
 
-    result = users_collection.update_one(
-        {"username": username, f"{target_array}.name": current_name},
-        {"$set": updates}
-    )
+    own_batch = batch is None
+    batch = new_write_batch() if own_batch else batch
 
-    if result.modified_count == 0:
-        return f"Sorry, I couldn't find an item named '{current_name}' to update."
+    # The item is a task or a test; rather than probing both collections first,
+    # send the update to both and see which one modified it.
+    item_filter = {"username": username, "name": current_name}
+    # Separate dicts: queue_write may merge a later $set into either one
+    task_updates = dict(updates, task_type=new_type) if new_type else dict(updates)
+    test_updates = dict(updates, test_type=new_type) if new_type else dict(updates)
+    task_write = queue_write(batch, tasks_collection, "update_one", item_filter, {"$set": task_updates}, counted=True)
+    test_write = queue_write(batch, tests_collection, "update_one", item_filter, {"$set": test_updates}, counted=True)
 
     if new_name:
-        users_collection.update_one(
-            {"username": username},
-            {"$set": {"generated_plan.$[elem].task": f"Work on {new_name}"}},
-            array_filters=[{"elem.task": {"$regex": current_name, "$options": "i"}}]
-        )
+        # Blocks only exist for items that do, so this is a no-op when nothing matched.
+        # Exact task, so renaming "Lab" leaves "Work on Lab Report" alone.
+        queue_write(batch, plan_blocks_collection, "update_many",
+                    {"username": username, "task": f"Work on {current_name}"},
+                    {"$set": {"task": f"Work on {new_name}"}})
+
+    def render_reply():
+        if task_write["count"] + test_write["count"] == 0:
+            return f"Sorry, I couldn't find an item named '{current_name}' to update."
+        return f"OK, I've updated the details for '{new_name or current_name}'."
 
-    return f"OK, I've updated the details for '{new_name or current_name}'."
+    return finish_writes(batch, own_batch, render_reply)
 
 
-# --- This is our "UPDATE CLASS" function (Unchanged) ---
-def update_class_schedule_db(username, args):
+# --- This is our "UPDATE CLASS" function ---
+@traced("tool")
+def update_class_schedule_db(username, args, batch=None):
     subject = args.get("subject")
     updates_to_make = {}
     if "new_day" in args:
-        updates_to_make["schedule.$.day"] = args["new_day"]
+        updates_to_make["day"] = args["new_day"]
     if "new_start_time" in args:
-        updates_to_make["schedule.$.start_time"] = args["new_start_time"]
+        updates_to_make["start_time"] = args["new_start_time"]
     if "new_end_time" in args:
-        updates_to_make["schedule.$.end_time"] = args["new_end_time"]
+        updates_to_make["end_time"] = args["new_end_time"]
     if not updates_to_make:
         return "Sorry, you need to provide what you want to change (the day, start time, or end time)."
-    result = users_collection.update_one(
-        {"username": username, "schedule.subject": subject},
-        {"$set": updates_to_make}
-    )
-    if result.modified_count > 0:
-        return f"OK, I've updated your '{subject}' class."
-    else:
-        return f"Sorry, I couldn't find a class with the subject '{subject}' to update."
+    own_batch = batch is None
+    batch = new_write_batch() if own_batch else batch
+    class_write = queue_write(batch, classes_collection, "update_one",
+                              {"username": username, "subject": subject},
+                              {"$set": updates_to_make}, counted=True)
+
+    def render_reply():
+        if class_write["count"] > 0:
+            return f"OK, I've updated your '{subject}' class."
+        else:
+            return f"Sorry, I couldn't find a class with the subject '{subject}' to update."
 
+    return finish_writes(batch, own_batch, render_reply)
 
-# --- This is your NEW function (Unchanged) ---
-def delete_schedule_item_db(username, args):
+
+# --- This is your NEW function ---
+@traced("tool")
+def delete_schedule_item_db(username, args, batch=None):
     item_name = args.get("item_name")
+    own_batch = batch is None
+    batch = new_write_batch() if own_batch else batch
+
+    deletes = [
+        queue_write(batch, classes_collection, "delete_many", {"username": username, "subject": item_name},
+                    counted=True),
+        queue_write(batch, tasks_collection, "delete_many", {"username": username, "name": item_name},
+                    counted=True),
+        queue_write(batch, tests_collection, "delete_many", {"username": username, "name": item_name},
+                    counted=True),
+        queue_write(batch, plan_blocks_collection, "delete_many",
+                    {"username": username, "task": f"Work on {item_name}"}, counted=True)
+    ]
+
+    def render_reply():
+        if any(write["count"] > 0 for write in deletes):
+            return f"OK, I've deleted '{item_name}' and any related schedule blocks."
+        else:
+            return f"Sorry, I couldn't find an item named '{item_name}' to delete."
+
+    return finish_writes(batch, own_batch, render_reply)
 
-    result_class = users_collection.update_one(
-        {"username": username},
-        {"$pull": {"schedule": {"subject": item_name}}}
-    )
-    result_task = users_collection.update_one(
-        {"username": username},
-        {"$pull": {"tasks": {"name": item_name}}}
-    )
-    result_test = users_collection.update_one(
-        {"username": username},
-        {"$pull": {"tests": {"name": item_name}}}
-    )
-    result_plan = users_collection.update_one(
-        {"username": username},
-        {"$pull": {"generated_plan": {"task": {"$regex": item_name, "$options": "i"}}}}
-    )
-    if (result_class.modified_count > 0 or
-            result_task.modified_count > 0 or
-            result_test.modified_count > 0 or
-            result_plan.modified_count > 0):
-        return f"OK, I've deleted '{item_name}' and any related schedule blocks."
-    else:
-        return f"Sorry, I couldn't find an item named '{item_name}' to delete."
 
+# === START OF EXPIRY SWEEPER ===
+# Past tasks, tests and plan blocks are deleted for all users at once by a
+# background sweep every EXPIRY_SWEEP_INTERVAL_SECONDS, not on each
+# /get_schedule call, so reads never write. Tasks and tests carry a BSON
+# "expires_at" date (set on write, backfilled by the sweep for older
+# documents), so expiry compares real datetimes instead of ISO strings. A TTL
+# index could delete plan blocks too, but TTL deletes cannot bump the users'
+# data versions, and /get_schedule clients would keep showing the deleted blocks.
+#
+# Every serving process starts the sweeper (see PROCESS STARTUP), and the
+# "expiry-sweeper" lease lets only one of them sweep per interval. With
+# EXPIRY_SWEEPER=0, run sweep_expired.py from cron.
+EXPIRY_SWEEPER_ENABLED = os.getenv("EXPIRY_SWEEPER", "1") == "1"
+EXPIRY_SWEEP_INTERVAL_SECONDS = int(os.getenv("EXPIRY_SWEEP_INTERVAL_SECONDS", "3600"))
+EXPIRY_SWEEP_BATCH_SIZE = 1000
 
-# --- Auto-cleanup function (Unchanged) ---
-def auto_cleanup_past_items(username):
+
+def parse_item_deadline(item):
+    """
+    When a task or test expires, as a naive local datetime. A date-only
+    deadline lasts the whole day. None if the deadline cannot be parsed.
+    """
+    deadline_str = item.get("deadline", item.get("date"))
     try:
-        now = datetime.now()
-        now_iso = now.isoformat()
-        today_date_str = now.strftime("%Y-%m-%d")
-
-        users_collection.update_one(
-            {"username": username},
-            {
-                "$pull": {
-                    "tasks": {"deadline": {"$lt": now_iso}},
-                    "tests": {"date": {"$lt": today_date_str}},
-                    "generated_plan": {"date": {"$lt": today_date_str}}
-                }
-            }
-        )
-        print(f"Auto-cleanup completed for user {username}")
-    except Exception as e:
-        print(f"Error during auto-cleanup for {username}: {e}")
+        if 'T' not in deadline_str:
+            deadline_str += "T23:59:59"
+        deadline = datetime.fromisoformat(deadline_str)
+    except (TypeError, ValueError):
+        return None
+    if deadline.tzinfo:
+        deadline = deadline.astimezone().replace(tzinfo=None)
+    return deadline
+
+
+def _backfill_expires_at(collection):
+    """Sets expires_at on documents written before it existed (None if their deadline is unparseable)."""
+    operations = []
+    for item in collection.find({"expires_at": {"$exists": False}}, {"deadline": 1, "date": 1}):
+        operations.append(UpdateOne({"_id": item["_id"]}, {"$set": {"expires_at": parse_item_deadline(item)}}))
+        if len(operations) >= EXPIRY_SWEEP_BATCH_SIZE:
+            collection.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+
+
+def sweep_expired_items(now=None):
+    """Deletes every user's past tasks, tests and plan blocks. Returns {section: documents deleted}."""
+    now = now or datetime.now()
+    expired = {
+        "tasks": (tasks_collection, {"expires_at": {"$lt": now}}),
+        "tests": (tests_collection, {"expires_at": {"$lt": now}}),
+        "generated_plan": (plan_blocks_collection, {"date": {"$lt": now.strftime("%Y-%m-%d")}})
+    }
+    _backfill_expires_at(tasks_collection)
+    _backfill_expires_at(tests_collection)
+
+    deleted = {}
+    version_bumps = []
+    for section, (collection, query) in expired.items():
+        # Both are covered by the (expires_at | date, username) indexes
+        usernames = collection.distinct("username", query)
+        deleted[section] = collection.delete_many(query).deleted_count if usernames else 0
+        for start in range(0, len(usernames), EXPIRY_SWEEP_BATCH_SIZE):
+            version_bumps.append(UpdateMany({"username": {"$in": usernames[start:start + EXPIRY_SWEEP_BATCH_SIZE]}},
+                                            data_version_update([section])))
+    if version_bumps:
+        users_collection.bulk_write(version_bumps, ordered=False)
+
+    print(f"Expiry sweep: deleted {deleted['tasks']} tasks, {deleted['tests']} tests, "
+          f"{deleted['generated_plan']} plan blocks")
+    return deleted
+
+
+_expiry_sweeper_started = threading.Event()
+_expiry_sweeper_lock = threading.Lock()
+
+
+def _expiry_sweeper_loop():
+    while True:
+        try:
+            # Whoever swept last renews the lease; the others take over when it runs out
+            if acquire_lease("expiry-sweeper", EXPIRY_SWEEP_INTERVAL_SECONDS):
+                sweep_expired_items()
+        except Exception as e:
+            print(f"Error during expiry sweep: {e}")
+        threading.Event().wait(EXPIRY_SWEEP_INTERVAL_SECONDS)
+
+
+def start_expiry_sweeper():
+    """Starts this process's background sweep, once. EXPIRY_SWEEPER=0 turns it off (see sweep_expired.py)."""
+    with _expiry_sweeper_lock:
+        if not EXPIRY_SWEEPER_ENABLED or _expiry_sweeper_started.is_set():
+            return
+        _expiry_sweeper_started.set()
+    threading.Thread(target=_expiry_sweeper_loop, name="expiry-sweeper", daemon=True).start()
+
+
+# === END OF EXPIRY SWEEPER ===
+
+
+# === START OF PROCESS STARTUP ===
+# WSGI servers (gunicorn, flask run) have no startup hook, so every serving
+# process sets itself up on its first request; the debug reloader's watcher
+# process never gets one. asgi.py calls start_app_process from its lifespan
+# startup instead.
+_app_process_started = False
+_app_process_lock = threading.Lock()
+
+
+def start_app_process():
+    """Creates the indexes and starts the expiry sweeper, once per process."""
+    global _app_process_started
+    with _app_process_lock:
+        if _app_process_started:
+            return
+        _app_process_started = True
+        try:
+            ensure_indexes()  # Under the lock, so no request runs before the indexes exist
+        except Exception as e:
+            print(f"Error creating indexes: {e}")
+    start_expiry_sweeper()
+
 
+@app.before_request
+def _start_app_process():
+    if not _app_process_started:
+        start_app_process()
 
-# --- NEW PLANNING FUNCTIONS (reschedule_day_db Updated) ---
 
-def save_study_windows_db(username, args):
+# === END OF PROCESS STARTUP ===
+
+
+# --- NEW PLANNING FUNCTIONS (reschedule_day Updated) ---
+
+@traced("tool")
+def save_study_windows_db(username, args, batch=None):
     windows = args.get("windows", [])
-    users_collection.update_one(
-        {"username": username},
-        {"$set": {"study_windows": windows}}
-    )
-    return "Study windows saved."
+    own_batch = batch is None
+    batch = new_write_batch() if own_batch else batch
+    queue_write(batch, users_collection, "update_one", {"username": username}, {"$set": {"study_windows": windows}})
+    return finish_writes(batch, own_batch, lambda: "Study windows saved.")
 
 
-def get_daily_plan_db(username, args):
-    user_data = users_collection.find_one({"username": username})
-    generated_plan = user_data.get("generated_plan", [])
-    today_str = datetime.now().strftime("%Y-%m-%d")
-    todays_plan_items = [item for item in generated_plan if item['date'] == today_str]
+# === START OF DAILY DIGESTS ===
+# Every morning each user's first page load runs the daily check-in, which
+# only needs get_daily_plan's one-line summary of the day. Whenever the planner
+# saves a plan (here or in bulk_planner.py), that summary is written to
+# daily_digests for every day from today to the plan's last day, so the
+# check-ins read one small document. A day without a digest falls back to
+# reading plan_blocks. Digests expire through a TTL index after their day.
 
+def format_daily_digest(todays_plan_items):
     if not todays_plan_items:
         return "You have no study blocks scheduled for today. Enjoy the break or ask me to plan something!"
 
@@ -560,29 +1492,99 @@ def get_daily_plan_db(username, args):
     return f"Your default plan for today is: {plan_summary}."
 
 
-def get_priority_list_db(username, args):
-    # This function is now a STUB. The main logic is in run_planner_engine.
-    # We will build this out later using the same V4 logic.
-    hours = args.get("hours", 0)
-    user_data = users_collection.find_one({"username": username})
-    tasks = user_data.get("tasks", [])
+def daily_digest_operations(username, plan, today):
+    """daily_digests bulk_write operations replacing the user's digests with ones for this plan."""
+    blocks_by_date = {}
+    for block in sorted(plan, key=lambda block: (block.get("date") or "", block.get("start_time") or "")):
+        blocks_by_date.setdefault(block.get("date"), []).append(block)
+    last_date = max((date_str for date_str in blocks_by_date if date_str), default=today.isoformat())
 
-    if not tasks:
-        return "You have no pending tasks!"
+    operations = [DeleteMany({"username": username})]
+    day = today
+    while day.isoformat() <= last_date:
+        operations.append(InsertOne({
+            "username": username,
+            "date": day.isoformat(),
+            "text": format_daily_digest(blocks_by_date.get(day.isoformat(), [])),
+            "expires_at": datetime.combine(day + timedelta(days=1), time.max)
+        }))
+        day += timedelta(days=1)
+    return operations
+
+
+def save_daily_digests(username, plan, now):
+    daily_digests_collection.bulk_write(daily_digest_operations(username, plan, now.date()), ordered=True)
+
+
+def get_daily_digest(username, date_str):
+    """The precomputed get_daily_plan reply for this day, or None."""
+    digest = _find_one(daily_digests_collection, "get_daily_plan:digest", {"username": username, "date": date_str},
+                       {"_id": 0, "text": 1})
+    return digest["text"] if digest else None
+
+
+# === END OF DAILY DIGESTS ===
+
+
+@traced("tool")
+def get_daily_plan_db(username, args):
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    digest = get_daily_digest(username, today_str)
+    if digest is not None:
+        return digest
+
+    return format_daily_digest(get_plan_for_date(username, today_str, "get_daily_plan"))
+
+
+PRIORITY_LIST_DEFAULT_SIZE = 3  # Items listed when the AI passes no usable hours
 
+
+@traced("tool")
+def get_priority_list_db(username, args):
+    """
+    What to work on in the given hours. Uses the planner's work queue and
+    order (priority score, then deadline): items come off a heap whole while
+    they fit and the last one partially, so only the items that make the list
+    get ordered, not the whole backlog.
+    """
     try:
-        tasks.sort(key=lambda x: x['deadline'])
-    except Exception as e:
-        print(f"Could not sort tasks: {e}")
+        hours = float(args.get("hours") or 0)
+    except (TypeError, ValueError):
+        hours = 0
+    now = datetime.now()
+    # The queue of the user's last planner run, while their tasks and tests are unchanged since
+    work_items = get_cached_work_queue(username, get_data_versions(username, "get_priority_list:version"), now)
+    if work_items is None:
+        work_items = build_work_queue(get_work_queue_items(username, "get_priority_list"), now)
+
+    if not work_items:
+        return "You have no pending tasks!"
 
-    priority_list_str = "Here is your priority list: " + ", ".join([t['name'] for t in tasks[:2]])
-    return priority_list_str
+    # The index keeps equal keys in queue order and stops the heap comparing dicts
+    heap = [(item.priority, item.deadline, index, item) for index, item in enumerate(work_items)]
+    heapq.heapify(heap)
+    if hours <= 0:
+        top_items = [heapq.heappop(heap)[-1] for _ in range(min(PRIORITY_LIST_DEFAULT_SIZE, len(heap)))]
+        return "Here is your priority list: " + ", ".join(item.name for item in top_items)
+
+    entries = []
+    hours_left = hours
+    while heap and hours_left > 0:
+        item = heapq.heappop(heap)[-1]
+        block_hours = min(item.blocks_needed, hours_left)
+        hours_left -= block_hours
+        if block_hours < item.blocks_needed:
+            entries.append(f"{item.name} ({block_hours:g}h of {item.blocks_needed:g}h)")
+        else:
+            entries.append(f"{item.name} ({block_hours:g}h)")
+    return f"Here is your priority list for {hours:g} hour{'' if hours == 1 else 's'}: " + ", ".join(entries)
 
 
-def reschedule_day_db(username, args):
+def reschedule_day_planner_args(args):
     """
-    This function is a pass-through. It takes the structured time blocks
-    from the AI and passes them to the Master Planner as a daily override.
+    Planner args for a reschedule_day call: today's blocks as a daily override.
+    The call itself is one of the CHAT_PLANNER_TOOLS, answered by the turn's
+    single planner pass with reschedule_day_reply.
     """
     # 1. Get the new time blocks from the AI
     time_blocks = args.get("time_blocks", [])
@@ -592,19 +1594,30 @@ def reschedule_day_db(username, args):
     daily_overrides = {
         today_str: time_blocks
     }
-
-    # 3. Call the Master Planner, passing in this new override
-    planner_args = {
+    return {
         "daily_overrides": daily_overrides,
         "force_auto": True
     }
-    planner_response = run_planner_engine_db(username, planner_args)
 
-    # 4. Return the result to the user
+
+def reschedule_day_reply(planner_response):
+    if planner_response["status"] == "queued":
+        return "OK, I'm re-planning your schedule for today."
     return f"OK, I've re-planned your schedule for today. {planner_response['message']}"
 
 
 # === START OF V8 PLANNER ENGINE (Loop Fix) ===
+# The planner's per-run output (planner_log, and the per-item work queue
+# dump) is only printed with PLANNER_VERBOSE=1; phase timings and counts go to
+# /metrics instead.
+PLANNER_VERBOSE = os.getenv("PLANNER_VERBOSE", "0") == "1"
+
+
+def planner_log(message):
+    if PLANNER_VERBOSE:
+        print(message)
+
+
 # Define our default "heuristic" values
 DEFAULT_PRIORITY_MAP = {
     "top": 0,  # <-- V8 FIX: Added "top" to break loops
@@ -631,215 +1644,1462 @@ def _time_to_minutes(time_str):
         return 0
 
 
-def run_planner_engine_db(username, args):
-    """
-    This is the V8 "Master Planner" engine.
-    """
-    print("--- Running V8 Planner Engine ---")
-    user_data = users_collection.find_one({"username": username})
-    now = datetime.now()
-
-    force_auto = args.get("force_auto", False)
-    daily_overrides = args.get("daily_overrides", {})
-
-    # 1. Build the prioritized "To-Do List"
-    work_items = []
-    all_items = user_data.get("tasks", []) + user_data.get("tests", [])
-    for item in all_items:
-        try:
-            deadline_str = item.get("deadline", item.get("date"))
-            if 'T' not in deadline_str:
-                deadline_str += "T23:59:59"
-            deadline = datetime.fromisoformat(deadline_str)
+# === START OF AVAILABILITY ENGINE (Bitmaps) ===
+# Every planned day is a single Python int used as a bitmap: bit N covers the
+# minutes [N * granularity, (N + 1) * granularity). Sleep, classes, study
+# windows and overrides are OR-ed in as whole intervals, so building the map
+# costs O(intervals) instead of O(days x hours x items).
+PLANNER_HORIZON_DAYS = 14
+PLANNER_BLOCK_MINUTES = 60
+# 1: consecutive blocks of the same task are stored as one interval (see merge_plan_blocks)
+PLAN_MERGE_BLOCKS = os.getenv("PLAN_MERGE_BLOCKS", "0") == "1"
+PLANNER_GRANULARITY_MINUTES = int(os.getenv("PLANNER_GRANULARITY_MINUTES", "15"))
+if 1440 % PLANNER_GRANULARITY_MINUTES or PLANNER_BLOCK_MINUTES % PLANNER_GRANULARITY_MINUTES:
+    print(f"Planner: granularity {PLANNER_GRANULARITY_MINUTES} does not divide a block, using 15 minutes.")
+    PLANNER_GRANULARITY_MINUTES = 15
 
-            if deadline < now:
-                continue
+WEEKDAY_BY_NAME = {name: number for number, name in DAY_OF_WEEK_MAP.items()}
 
-            priority_str = item.get("priority", item.get("task_type", item.get("test_type", "low")))
-            priority_score = DEFAULT_PRIORITY_MAP.get(priority_str, 99)
 
-            item_type = item.get("task_type", item.get("test_type"))
-            duration_blocks = item.get("duration_hours", DEFAULT_DURATION_MAP.get(item_type, 1))
+def _minutes_to_time_str(minutes):
+    """Helper to convert minutes since midnight to an HH:MM string."""
+    minutes %= 1440
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
 
-            work_items.append({
-                "name": item.get("name"),
-                "deadline": deadline,
-                "priority": priority_score,
-                "blocks_needed": duration_blocks,
-                "blocks_allocated": 0
-            })
-        except Exception as e:
-            print(f"Skipping item due to parse error: {item.get('name')}, {e}")
 
-    # 2. Sort the list (multi-level sort)
-    # V8 FIX: We must sort by priority *first* then deadline to respect "top"
-    work_items.sort(key=lambda x: (x["priority"], x["deadline"]))
+def _interval_mask(start_min, end_min):
+    """Returns a day bitmap with every unit touched by [start_min, end_min) set."""
+    if end_min <= start_min:
+        return 0
+    first_unit = start_min // PLANNER_GRANULARITY_MINUTES
+    end_unit = -(-end_min // PLANNER_GRANULARITY_MINUTES)
+    return ((1 << (end_unit - first_unit)) - 1) << first_unit
 
-    if not work_items:
-        print("Planner: No work items to schedule.")
-        return {"status": "success", "message": "Planner ran, but you have no upcoming tasks or tests to plan for."}
 
-    print("--- Planner: Prioritized Work Queue ---")
-    for item in work_items:
-        print(
-            f"  - {item['name']} (Priority: {item['priority']}, Deadline: {item['deadline'].strftime('%Y-%m-%d')}, Blocks: {item['blocks_needed']})")
-    print("---------------------------------------")
-
-    # 3. V8 CONFLICT DETECTION (Iterative)
-    # Check for a "hard tie" anywhere in the list
-    if not force_auto and len(work_items) > 1:
-        for i in range(len(work_items) - 1):
-            item1 = work_items[i]
-            item2 = work_items[i + 1]
-
-            # Check if adjacent items are tied
-            if (item1["deadline"].date() == item2["deadline"].date() and
-                    item1["priority"] == item2["priority"]):
-                print(f"Planner: Hard conflict detected between '{item1['name']}' and '{item2['name']}'. Asking user.")
-                return {
-                    "status": "conflict",
-                    "options": [item1["name"], item2["name"]]
-                }
+def _iter_mask_runs(mask):
+    """Yields (first_unit, end_unit) for every run of consecutive set bits."""
+    while mask:
+        first_unit = (mask & -mask).bit_length() - 1
+        shifted = mask >> first_unit
+        run_length = (~shifted & (shifted + 1)).bit_length() - 1
+        yield first_unit, first_unit + run_length
+        mask &= ~(((1 << run_length) - 1) << first_unit)
 
-    # 4. Build Availability Map (14 days, in 60-min blocks)
-    availability_map = {}
-    start_date = now.date()
-    for i in range(14):  # Plan for the next 14 days
-        day = start_date + timedelta(days=i)
-        day_str = day.strftime("%Y-%m-%d")
-        availability_map[day_str] = {hour: "free" for hour in range(24)}  # Initialize all 24 hours as "free"
 
-    # Block out sleep times
-    prefs = user_data.get("preferences", {})
+def _sleep_mask(prefs):
+    """Day bitmap of the user's sleeping hours (wraps around midnight)."""
     sleep_min = _time_to_minutes(prefs.get("sleep_time", "23:00"))
     awake_min = _time_to_minutes(prefs.get("awake_time", "07:00"))
+    if sleep_min > awake_min:
+        return _interval_mask(sleep_min, 1440) | _interval_mask(0, awake_min)
+    return _interval_mask(sleep_min, awake_min)
+
+
+def _weekly_masks(items, day_key="day"):
+    """Builds one bitmap per weekday (0 = Monday) from items with day/start/end."""
+    masks = [0] * 7
+    for item in items:
+        weekday = WEEKDAY_BY_NAME.get(item.get(day_key))
+        if weekday is None:
+            continue
+        masks[weekday] |= _interval_mask(_time_to_minutes(item.get("start_time", "00:00")),
+                                         _time_to_minutes(item.get("end_time", "00:00")))
+    return masks
+
+
+@functools.lru_cache(maxsize=1024)
+def _ordinal_date_str(day_ordinal):
+    return datetime.fromordinal(day_ordinal).strftime("%Y-%m-%d")
+
+
+def _plan_block(slot_key, task):
+    """The generated_plan block for the slot starting at slot_key. Slots only become strings here."""
+    day_ordinal, start_min = divmod(slot_key, 1440)
+    return {
+        "date": _ordinal_date_str(day_ordinal),
+        "start_time": _minutes_to_time_str(start_min),
+        "end_time": _minutes_to_time_str(start_min + PLANNER_BLOCK_MINUTES),
+        "task": task
+    }
+
+
+def _build_available_slots(user_data, start_date, daily_overrides):
+    """
+    Returns the free 60-min slots for the planning horizon as two ascending
+    lists of slot keys: slots inside a study window (or a daily override) and
+    every other free slot. A slot key is the slot start in epoch minutes (date
+    ordinal * 1440 + minute); see _plan_block for the stored form.
+    """
+    full_day = (1 << (1440 // PLANNER_GRANULARITY_MINUTES)) - 1
+    sleep_mask = _sleep_mask(user_data.get("preferences", {}))
+    class_masks = _weekly_masks(user_data.get("schedule", []))
+    window_masks = _weekly_masks(user_data.get("study_windows", []))
+    block_units = PLANNER_BLOCK_MINUTES // PLANNER_GRANULARITY_MINUTES
 
-    for day_map in availability_map.values():
-        for hour in range(24):
-            hour_min = hour * 60
-            if sleep_min > awake_min:
-                if hour_min >= sleep_min or hour_min < awake_min:
-                    day_map[hour] = "sleep"
-            else:
-                if sleep_min <= hour_min < awake_min:
-                    day_map[hour] = "sleep"
-
-    # Block out busy class times
-    for class_item in user_data.get("schedule", []):
-        class_day_name = class_item.get("day")
-        start_min = _time_to_minutes(class_item.get("start_time", "00:00"))
-        end_min = _time_to_minutes(class_item.get("end_time", "00:00"))
-
-        for day_str, day_map in availability_map.items():
-            day_dt = datetime.fromisoformat(day_str)
-            if DAY_OF_WEEK_MAP.get(day_dt.weekday()) == class_day_name:
-                for hour in range(24):
-                    hour_start_min = hour * 60
-                    hour_end_min = hour_start_min + 59
-                    if max(start_min, hour_start_min) < min(end_min, hour_end_min):
-                        day_map[hour] = "busy"
-
-    # 5. Create a flat list of available slots, prioritizing study_windows & overrides
     available_slots = []
     non_preferred_slots = []
 
-    study_windows = user_data.get("study_windows", [])
-
-    for day_str, day_map in availability_map.items():
-        day_dt = datetime.fromisoformat(day_str)
-        day_name = DAY_OF_WEEK_MAP.get(day_dt.weekday())
+    for i in range(PLANNER_HORIZON_DAYS):
+        day = start_date + timedelta(days=i)
+        day_str = day.strftime("%Y-%m-%d")
+        day_key = day.toordinal() * 1440
+        weekday = day.weekday()
+        free_mask = full_day & ~(sleep_mask | class_masks[weekday])
 
+        override_mask = None
         if day_str in daily_overrides:
-            print(f"Planner: Applying daily override for {day_str}")
-            override_blocks = daily_overrides[day_str]
-            override_hours = set()
-            for block in override_blocks:
-                block_start_min = _time_to_minutes(block.get("start_time"))
-                block_end_min = _time_to_minutes(block.get("end_time"))
-                for hour in range(24):
-                    hour_start_min = hour * 60
-                    hour_end_min = hour_start_min + 59
-                    if max(block_start_min, hour_start_min) < min(block_end_min, hour_end_min) and (
-                            block_end_min - block_start_min > 0):
-                        override_hours.add(hour)
-
-            for hour in override_hours:
-                if day_map.get(hour) == "free":
-                    slot_time = time(hour, 0)
-                    available_slots.append({
-                        "date": day_str,
-                        "start_time": slot_time.strftime("%H:%M"),
-                        "end_time": (datetime.combine(day_dt, slot_time) + timedelta(hours=1)).strftime("%H:%M")
-                    })
+            planner_log(f"Planner: Applying daily override for {day_str}")
+            override_mask = 0
+            for block in daily_overrides[day_str]:
+                override_mask |= _interval_mask(_time_to_minutes(block.get("start_time")),
+                                                _time_to_minutes(block.get("end_time")))
+
+        for first_unit, end_unit in _iter_mask_runs(free_mask):
+            # Align slots to block boundaries inside the free run
+            unit = -(-first_unit // block_units) * block_units
+            while unit + block_units <= end_unit:
+                slot_mask = ((1 << block_units) - 1) << unit
+                slot_key = day_key + unit * PLANNER_GRANULARITY_MINUTES
+                if override_mask is not None:
+                    if slot_mask & override_mask:
+                        available_slots.append(slot_key)
+                elif window_masks[weekday] >> unit & 1:
+                    available_slots.append(slot_key)
+                else:
+                    non_preferred_slots.append(slot_key)
+                unit += block_units
+
+    return available_slots, non_preferred_slots
+
+
+# === END OF AVAILABILITY ENGINE ===
+
+
+# === START OF SLOT ALLOCATOR (Deadline Index) ===
+# Free slots are kept in two min-heaps of integer start times: preferred
+# slots (study windows / overrides) and everything else. The old linear scan
+# always took the earliest slot of the first tier that still had one before the
+# deadline, so one heap-top comparison per tier gives the same answer.
+
+def _deadline_key(deadline):
+    """Epoch minutes such that slot_key < _deadline_key(d) <=> slot start < d."""
+    key = deadline.toordinal() * 1440 + deadline.hour * 60 + deadline.minute
+    if deadline.second or deadline.microsecond:
+        key += 1
+    return key
+
+
+def _build_slot_index(preferred_slots, other_slots):
+    """Builds the allocator index from ascending slot key lists."""
+    index = {"preferred": list(preferred_slots), "other": list(other_slots)}
+    for tier in index.values():
+        heapq.heapify(tier)  # Already sorted, so this is a cheap no-op pass
+    return index
+
+
+def _take_slot(index, deadline_key):
+    """Pops the key of the earliest slot before the deadline, preferred slots first. None if no slot fits."""
+    for tier_name in ("preferred", "other"):
+        tier = index[tier_name]
+        if tier and tier[0] < deadline_key:
+            return heapq.heappop(tier)
+    return None
+
+
+def _slot_index_size(index):
+    return len(index["preferred"]) + len(index["other"])
+
+
+def _slot_key(date_str, time_str, day_ordinals):
+    """Helper to convert a plan date + HH:MM pair to epoch minutes. day_ordinals caches parsed dates."""
+    day_ordinal = day_ordinals.get(date_str)
+    if day_ordinal is None:
+        day_ordinal = day_ordinals[date_str] = datetime.fromisoformat(date_str).toordinal()
+    return day_ordinal * 1440 + _time_to_minutes(time_str)
+
+
+def merge_plan_blocks(blocks):
+    """
+    Run-length merges a plan: consecutive blocks of the same task on the same
+    day become one block from the first start_time to the last end_time.
+    Returns new dicts sorted by date and start_time; blocks is left as it is.
+    """
+    merged = []
+    for block in sorted(blocks, key=lambda block: (block.get("date") or "", block.get("start_time") or "")):
+        previous = merged[-1] if merged else None
+        if (previous and previous.get("date") == block.get("date") and previous.get("task") == block.get("task")
+                and previous.get("end_time") and previous.get("end_time") == block.get("start_time")):
+            previous["end_time"] = block.get("end_time")
+        else:
+            merged.append(dict(block))
+    return merged
+
+
+def _split_plan_block(block):
+    """Yields a (possibly merged) plan block as PLANNER_BLOCK_MINUTES blocks. Short blocks come back as they are."""
+    start_min = _time_to_minutes(block["start_time"])
+    end_min = _time_to_minutes(block["end_time"])
+    if end_min <= start_min:
+        end_min += 1440  # Ends at midnight
+    if end_min - start_min <= PLANNER_BLOCK_MINUTES:
+        yield block
+        return
+    for minute in range(start_min, end_min - PLANNER_BLOCK_MINUTES + 1, PLANNER_BLOCK_MINUTES):
+        yield dict(block, start_time=_minutes_to_time_str(minute),
+                   end_time=_minutes_to_time_str(minute + PLANNER_BLOCK_MINUTES))
+
+
+def _keep_unaffected_blocks(existing_plan, work_items, changed_items, free_keys):
+    """
+    Incremental mode: returns the blocks of the current plan that can stay
+    where they are. A block is kept if its item is still in the queue and was
+    not changed, its slot is still free and before the deadline, and the item
+    does not already have enough blocks. Kept slots are removed from free_keys.
+    Merged blocks are split back into single blocks first.
+    """
+    items_by_task = {f"Work on {item.name}": item for item in work_items
+                     if item.name not in changed_items}
+    kept_plan = []
+    day_ordinals = {}
+    for stored_block in existing_plan:
+        item = items_by_task.get(stored_block.get("task"))
+        if not item:
             continue
+        try:
+            blocks = list(_split_plan_block(stored_block))
+        except (KeyError, TypeError):
+            continue
+        for block in blocks:
+            if item.blocks_allocated >= item.blocks_needed:
+                break
+            try:
+                key = _slot_key(block["date"], block["start_time"], day_ordinals)
+            except (KeyError, TypeError, ValueError):
+                break
+            if key in free_keys and key < item.deadline_key:
+                free_keys.discard(key)
+                item.blocks_allocated += 1
+                kept_plan.append(block)
+    return kept_plan
 
-        for hour, status in day_map.items():
-            if status == "free":
-                slot_time = time(hour, 0)
-                is_preferred = False
-                for window in study_windows:
-                    if window.get("day") == day_name:
-                        win_start_min = _time_to_minutes(window.get("start_time"))
-                        win_end_min = _time_to_minutes(window.get("end_time"))
-                        hour_min = hour * 60
-                        if win_start_min <= hour_min < win_end_min:
-                            is_preferred = True
-                            break
-                slot_data = {
-                    "date": day_str,
-                    "start_time": slot_time.strftime("%H:%M"),
-                    "end_time": (datetime.combine(day_dt, slot_time) + timedelta(hours=1)).strftime("%H:%M")
-                }
-                if is_preferred:
-                    available_slots.append(slot_data)
-                else:
-                    non_preferred_slots.append(slot_data)
 
-    available_slots.extend(non_preferred_slots)
+def _plan_block_key(block):
+    return block.get("date"), block.get("start_time"), block.get("end_time"), block.get("task")
+
+
+def _plan_delta(existing_plan, saved_plan):
+    """
+    Incremental mode: only the blocks that are not in the new plan are deleted
+    and only the ones that are new inserted, instead of rewriting the whole
+    plan. Blocks are compared by value, so a merged block that grew or shrank
+    is one drop and one add. None if nothing changed.
+    """
+    existing_counts = {}
+    for block in existing_plan:
+        key = _plan_block_key(block)
+        existing_counts[key] = existing_counts.get(key, 0) + 1
+    added_blocks = []
+    for block in saved_plan:
+        key = _plan_block_key(block)
+        if existing_counts.get(key):
+            existing_counts[key] -= 1
+        else:
+            added_blocks.append(block)
+    dropped_blocks = []
+    for block in existing_plan:
+        key = _plan_block_key(block)
+        if existing_counts.get(key):
+            existing_counts[key] -= 1
+            dropped_blocks.append(block)
+    planner_log(f"Planner: Dropped {len(dropped_blocks)}, added {len(added_blocks)} blocks.")
+    if not dropped_blocks and not added_blocks:
+        return None
+    return {"drop": dropped_blocks, "add": added_blocks}
+
+
+def plan_write_operations(username, plan_change):
+    """
+    Turns a planner plan_change into plan_blocks bulk_write operations. They
+    must run in order: the delete before the inserts.
+    """
+    if not plan_change:
+        return []
+    if "replace" in plan_change:
+        operations = [DeleteMany({"username": username})]
+        added_blocks = plan_change["replace"]
+    else:
+        operations = []
+        if plan_change["drop"]:
+            operations.append(DeleteMany({"username": username, "$or": [
+                {"date": block.get("date"), "start_time": block.get("start_time"), "end_time": block.get("end_time"),
+                 "task": block.get("task")}
+                for block in plan_change["drop"]
+            ]}))
+        added_blocks = plan_change["add"]
+    operations.extend(InsertOne(dict(block, username=username)) for block in added_blocks)
+    return operations
+
+
+def _plan_change_dates(plan_change):
+    """The dates whose blocks a plan_change rewrites."""
+    if "replace" in plan_change:
+        return plan_change["dates"]
+    return sorted({block.get("date") for block in plan_change["drop"] + plan_change["add"] if block.get("date")})
+
+
+def _apply_plan_change(username, plan_change):
+    """Writes the planner's plan_change to plan_blocks in one round trip, and logs the dates it changed."""
+    operations = plan_write_operations(username, plan_change)
+    if operations:
+        plan_blocks_collection.bulk_write(operations, ordered=True)
+        user = users_collection.find_one_and_update(
+            {"username": username}, data_version_update(["generated_plan"]),
+            projection={"versions.generated_plan": 1}, return_document=ReturnDocument.AFTER)
+        if user:
+            log_plan_change(username, user["versions"]["generated_plan"], _plan_change_dates(plan_change))
+
+
+# === END OF SLOT ALLOCATOR ===
+
+
+# === START OF FEASIBILITY ANALYSIS (EDF) ===
+# One O(n log n) pass that finds every conflict in the work queue, so the
+# priority modal can ask about all of them at once instead of one pair per
+# planner run:
+#   * tie groups: items with the same priority score and deadline date, which
+#     the planner cannot order by itself;
+#   * infeasible items: taking items earliest-deadline-first, each in the
+#     earliest free blocks, is optimal for 1-hour blocks with deadlines. If an
+#     item still runs out of free blocks before its deadline this way, no
+#     order meets every deadline. Which items end up short depends on the
+#     order, so this is only a hint; the planner orders by priority, and the
+#     items it really leaves short come from its allocation (find_short_items).
+
+def find_tie_groups(work_items):
+    """Lists of names of items that share a priority score and deadline date. work_items are in planner order."""
+    tie_groups = []
+    for _, group in itertools.groupby(work_items, key=lambda item: (item.priority, item.deadline.date())):
+        names = [item.name for item in group]
+        if len(names) > 1:
+            tie_groups.append(names)
+    return tie_groups
+
+
+def find_infeasible_items(work_items, slot_keys):
+    """
+    [{"name", "blocks_needed", "blocks_short"}] for the items that are left
+    short when items are taken earliest-deadline-first. Empty means some
+    order meets every deadline. slot_keys are the sorted keys of every free slot.
+    """
+    infeasible = []
+    blocks_used = 0
+    for item in sorted(work_items, key=lambda item: item.deadline):
+        blocks_free = bisect.bisect_left(slot_keys, item.deadline_key) - blocks_used
+        blocks_needed = math.ceil(item.blocks_needed)
+        blocks_taken = max(0, min(blocks_needed, blocks_free))
+        blocks_used += blocks_taken
+        if blocks_taken < blocks_needed:
+            infeasible.append({"name": item.name, "blocks_needed": blocks_needed,
+                               "blocks_short": blocks_needed - blocks_taken})
+    return infeasible
+
+
+def find_short_items(work_items):
+    """[{"name", "blocks_needed", "blocks_short"}] for the items the allocation left without all their blocks."""
+    short_items = []
+    for item in work_items:
+        blocks_needed = math.ceil(item.blocks_needed)
+        if item.blocks_allocated < blocks_needed:
+            short_items.append({"name": item.name, "blocks_needed": blocks_needed,
+                                "blocks_short": blocks_needed - item.blocks_allocated})
+    return short_items
+
+
+def _short_items_note(short_items, deadlines_feasible):
+    if not short_items:
+        return ""
+    items = ", ".join(f"{item['name']} ({item['blocks_short']}h short)" for item in short_items)
+    note = f" Heads up: there isn't enough free time before the deadline for {items}."
+    if deadlines_feasible:
+        note += " Working in deadline order would fit everything, if that matters more than your priorities."
+    return note
+
+
+# === END OF FEASIBILITY ANALYSIS ===
+
+
+# === START OF PLANNER MEMOIZATION ===
+# The planner is a pure function of the user's items, settings, the override
+# args and the clock (to the hour), so a run whose inputs hash the same as the
+# last run for that user can return the previous result without computing or
+# writing anything.
+#   * One entry per user, LRU-evicted beyond PLANNER_CACHE_MAX_USERS users.
+#   * Any change to the hashed inputs (including full vs incremental mode), or
+#     the date/hour rolling over, is a miss.
+#   * The entry also stores a hash of the plan it left in Mongo. If the stored
+#     plan no longer matches (cleanup, delete, rename, ...) it is a miss too.
+#   * It also keeps the run's sorted work queue, tagged with the tasks and
+#     tests data versions and the hour, for get_priority_list_db.
+PLANNER_CACHE_MAX_USERS = int(os.getenv("PLANNER_CACHE_MAX_USERS", "1024"))
+_planner_cache = OrderedDict()
+_planner_cache_lock = threading.Lock()
+planner_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def _stable_hash(value):
+    """sha256 of a canonical JSON encoding (sorted keys, datetimes as strings)."""
+    encoded = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def _planner_cache_key(user_data, args, now):
+    return _stable_hash({
+        "tasks": user_data.get("tasks", []),
+        "tests": user_data.get("tests", []),
+        "schedule": user_data.get("schedule", []),
+        "preferences": user_data.get("preferences", {}),
+        "study_windows": user_data.get("study_windows", []),
+        "daily_overrides": args.get("daily_overrides", {}),
+        "force_auto": bool(args.get("force_auto", False)),
+        # A full run must never be answered with an incremental run's result, or the other way round
+        "mode": "incremental" if "changed_items" in args else "full",
+        "changed_items": sorted(args.get("changed_items", [])),
+        "date": now.strftime("%Y-%m-%d"),
+        "hour": now.hour
+    })
+
+
+def _plan_hash(plan):
+    """Order-insensitive hash of a plan (plan_blocks come back sorted by date)."""
+    return _stable_hash(sorted(plan, key=lambda block: (block.get("date", ""), block.get("start_time", ""),
+                                                        block.get("task", ""))))
+
+
+def _planner_cache_get(username, cache_key, current_plan):
+    with _planner_cache_lock:
+        entry = _planner_cache.get(username)
+        if entry and entry["key"] == cache_key and entry["plan_hash"] == _plan_hash(current_plan):
+            _planner_cache.move_to_end(username)
+            planner_cache_stats["hits"] += 1
+            return dict(entry["result"])
+        planner_cache_stats["misses"] += 1
+        return None
+
+
+def _work_queue_key(versions, now):
+    """The work queue only changes with the tasks, the tests and the hour (see build_work_queue)."""
+    return versions.get("tasks", 0), versions.get("tests", 0), now.strftime("%Y-%m-%d"), now.hour
+
+
+def _planner_cache_put(username, cache_key, result, saved_plan, work_queue, queue_key):
+    with _planner_cache_lock:
+        _planner_cache[username] = {"key": cache_key, "plan_hash": _plan_hash(saved_plan), "result": dict(result),
+                                    "work_queue": work_queue, "queue_key": queue_key}
+        _planner_cache.move_to_end(username)
+        while len(_planner_cache) > PLANNER_CACHE_MAX_USERS:
+            _planner_cache.popitem(last=False)
+            planner_cache_stats["evictions"] += 1
+
+
+def get_cached_work_queue(username, versions, now):
+    """The sorted WorkItems of the user's last planner run, or None if their tasks or tests changed since."""
+    if versions is None:
+        return None
+    with _planner_cache_lock:
+        entry = _planner_cache.get(username)
+        if entry and entry["queue_key"] == _work_queue_key(versions, now):
+            return entry["work_queue"]
+    return None
+
+
+def get_planner_cache_stats():
+    with _planner_cache_lock:
+        return dict(planner_cache_stats, size=len(_planner_cache), max_size=PLANNER_CACHE_MAX_USERS)
+
+
+# === END OF PLANNER MEMOIZATION ===
+
+
+@traced("planner")
+def run_planner_engine_db(username, args):
+    """
+    This is the V8 "Master Planner" engine.
+    Pass "changed_items" (a list of task/test names) to re-plan incrementally:
+    only the blocks of those items, plus any block that is no longer valid,
+    are re-placed and everything else stays where it is. If that leaves an
+    item short of blocks, the run re-plans in full instead.
+    """
+    planner_log("--- Running V8 Planner Engine ---")
+    # One run per user at a time, across processes: each run reads the saved plan and writes a delta against it
+    with _user_planner_lock(username), _user_planner_lease(username):
+        # The users document, and so the versions, is read before the items
+        user_data = load_user_data(username, site="planner", extra_fields=("versions",))
+        now = datetime.now()
+
+        cache_key = _planner_cache_key(user_data, args, now)
+        cached_result = _planner_cache_get(username, cache_key, user_data.get("generated_plan", []))
+        if cached_result:
+            planner_log("Planner: Inputs unchanged since the last run. Reusing the saved plan.")
+            record_planner_run("cached", {})
+            return cached_result
+
+        planner_stats = {}
+        work_queue = []
+        result, saved_plan, plan_change = profile_sampled("planner", _compute_plan, user_data, args, now,
+                                                          planner_stats, work_queue)
+        started = perf_counter()
+        _apply_plan_change(username, plan_change)
+        if plan_change:
+            # An unchanged plan (or a conflict, which saves nothing) already has its digests
+            save_daily_digests(username, saved_plan, now)
+        _lap(planner_stats, "save", started)
+        _planner_cache_put(username, cache_key, result, saved_plan, work_queue,
+                           _work_queue_key(user_data.get("versions") or {}, now))
+        record_planner_run(result["status"], planner_stats)
+        planner_log(f"Planner: {result['status']} in " +
+                    ", ".join(f"{phase} {seconds * 1000:.1f}ms" for phase, seconds in planner_stats["phase_seconds"].items()))
+        return result
+
+
+class WorkItem:
+    """One task or test in the planner's work queue."""
+    __slots__ = ("name", "deadline", "deadline_key", "priority", "blocks_needed", "blocks_allocated")
+
+    def __init__(self, name, deadline, priority, blocks_needed):
+        self.name = name
+        self.deadline = deadline
+        self.deadline_key = _deadline_key(deadline)
+        self.priority = priority
+        self.blocks_needed = blocks_needed
+        self.blocks_allocated = 0
+
+
+def build_work_queue(items, now):
+    """
+    The planner's "To-Do List": one work item per upcoming task or test, with
+    its priority score and the number of 1-hour blocks it needs. Unsorted.
+    """
+    work_items = []
+    for item in items:
+        try:
+            deadline = parse_item_deadline(item)
+            if deadline is None:
+                raise ValueError(f"invalid deadline {item.get('deadline', item.get('date'))!r}")
+
+            if deadline < now:
+                continue
+
+            priority_str = item.get("priority", item.get("task_type", item.get("test_type", "low")))
+            priority_score = DEFAULT_PRIORITY_MAP.get(priority_str, 99)
+
+            item_type = item.get("task_type", item.get("test_type"))
+            duration_blocks = item.get("duration_hours", DEFAULT_DURATION_MAP.get(item_type, 1))
+
+            work_items.append(WorkItem(item.get("name"), deadline, priority_score, duration_blocks))
+        except Exception as e:
+            print(f"Skipping item due to parse error: {item.get('name')}, {e}")
+    return work_items
+
 
-    # 6. Run Round-Robin Scheduler
-    new_plan = []
-    total_blocks_needed = sum(item["blocks_needed"] for item in work_items)
+def _compute_plan(user_data, args, now, planner_stats=None, work_queue=None):
+    """
+    Runs the planner on an already-loaded user document without touching Mongo.
+    Returns (result, the plan as it will be stored, plan_change), where
+    plan_change is None (nothing to write), {"replace": blocks, "dates":
+    the dates whose blocks changed} or {"drop": blocks, "add": blocks}.
+    See plan_write_operations.
+    If given, planner_stats is filled with the time each phase took and the
+    item, slot and block counts (see METRICS), and work_queue with the sorted
+    WorkItems.
+    """
+    started = perf_counter()
+    force_auto = args.get("force_auto", False)
+    daily_overrides = args.get("daily_overrides", {})
+    existing_plan = user_data.get("generated_plan", [])
+    incremental = "changed_items" in args and bool(existing_plan)
+
+    # 1. Build the prioritized "To-Do List"
+    work_items = build_work_queue(user_data.get("tasks", []) + user_data.get("tests", []), now)
 
-    print(
-        f"Planner: Starting round-robin. Tasks: {len(work_items)}, Blocks: {total_blocks_needed}, Slots: {len(available_slots)}")
+    # 2. Sort the list (multi-level sort)
+    # V8 FIX: We must sort by priority *first* then deadline to respect "top"
+    work_items.sort(key=lambda x: (x.priority, x.deadline))
+    if work_queue is not None:
+        work_queue.extend(work_items)
+    started = _lap(planner_stats, "queue", started)
+
+    if not work_items:
+        planner_log("Planner: No work items to schedule.")
+        return {"status": "success",
+                "message": "Planner ran, but you have no upcoming tasks or tests to plan for."}, existing_plan, None
 
-    while total_blocks_needed > 0 and available_slots:
-        made_progress = False
+    if PLANNER_VERBOSE:
+        print("--- Planner: Prioritized Work Queue ---")
         for item in work_items:
-            if item["blocks_allocated"] < item["blocks_needed"]:
-                found_slot_index = -1
-                for i, slot in enumerate(available_slots):
-                    slot_dt = datetime.fromisoformat(f"{slot['date']}T{slot['start_time']}")
-                    if slot_dt < item["deadline"]:
-                        found_slot_index = i
-                        break
-                if found_slot_index != -1:
-                    slot = available_slots.pop(found_slot_index)
-                    new_plan.append({
-                        "date": slot["date"],
-                        "start_time": slot["start_time"],
-                        "end_time": slot["end_time"],
-                        "task": f"Work on {item['name']}"
-                    })
-                    item["blocks_allocated"] += 1
-                    total_blocks_needed -= 1
-                    made_progress = True
-        if not made_progress:
-            print("Planner: Stopping. No more valid slots.")
+            print(
+                f"  - {item.name} (Priority: {item.priority}, Deadline: {item.deadline.strftime('%Y-%m-%d')}, Blocks: {item.blocks_needed})")
+        print("---------------------------------------")
+
+    # 3. Build Availability Map (per-day bitmaps, see _build_available_slots)
+    preferred_slots, other_slots = _build_available_slots(user_data, now.date(), daily_overrides)
+    started = _lap(planner_stats, "availability", started)
+    if planner_stats is not None:
+        planner_stats.update(items=len(work_items), slots=len(preferred_slots) + len(other_slots),
+                             blocks_needed=sum(item.blocks_needed for item in work_items))
+
+    # 4. V8 CONFLICT DETECTION (every tie, and whether every deadline can be met, see FEASIBILITY ANALYSIS)
+    tie_groups = [] if force_auto else find_tie_groups(work_items)
+    infeasible = find_infeasible_items(work_items, list(heapq.merge(preferred_slots, other_slots)))
+    started = _lap(planner_stats, "analysis", started)
+    if tie_groups:
+        planner_log(f"Planner: Hard conflicts detected in {len(tie_groups)} group(s): {tie_groups}. Asking user.")
+        return {
+            "status": "conflict",
+            "options": tie_groups[0],
+            "tie_groups": tie_groups,
+            "infeasible": infeasible
+        }, existing_plan, None
+
+    # 5. Create the slot index, prioritizing study_windows & overrides
+    kept_plan = []
+    if incremental:
+        free_keys = set(preferred_slots)
+        free_keys.update(other_slots)
+        kept_plan = _keep_unaffected_blocks(existing_plan, work_items, set(args["changed_items"]), free_keys)
+        preferred_slots = [key for key in preferred_slots if key in free_keys]
+        other_slots = [key for key in other_slots if key in free_keys]
+        planner_log(f"Planner: Incremental mode. Keeping {len(kept_plan)} of {len(existing_plan)} blocks.")
+    slot_index = _build_slot_index(preferred_slots, other_slots)
+    started = _lap(planner_stats, "slots", started)
+
+    # 6. Run Round-Robin Scheduler (on slot keys; turned into plan blocks in step 7)
+    allocated = []  # (slot_key, item)
+    total_blocks_needed = sum(item.blocks_needed - item.blocks_allocated for item in work_items)
+
+    planner_log(
+        f"Planner: Starting round-robin. Tasks: {len(work_items)}, Blocks: {total_blocks_needed}, Slots: {_slot_index_size(slot_index)}")
+
+    # Slots are only ever removed, so an item that finds nothing before its
+    # deadline never will; it drops out of the rotation for good.
+    active_items = [item for item in work_items if item.blocks_allocated < item.blocks_needed]
+    while active_items:
+        still_active = []
+        for item in active_items:
+            slot_key = _take_slot(slot_index, item.deadline_key)
+            if slot_key is None:
+                continue
+            allocated.append((slot_key, item))
+            item.blocks_allocated += 1
+            if item.blocks_allocated < item.blocks_needed:
+                still_active.append(item)
+        active_items = still_active
+
+    if any(item.blocks_allocated < item.blocks_needed for item in work_items):
+        planner_log("Planner: Stopping. No more valid slots.")
+    _lap(planner_stats, "allocation", started)
+    if planner_stats is not None:
+        planner_stats["blocks_allocated"] = sum(item.blocks_allocated for item in work_items)
+
+    # 7. Save the new plan (run-length merged if PLAN_MERGE_BLOCKS)
+    short_items = find_short_items(work_items)
+    if incremental and short_items:
+        # Kept blocks can hold slots a changed item needed more; a full run re-places everything
+        planner_log("Planner: Incremental run left items short. Re-planning in full.")
+        if work_queue is not None:
+            del work_queue[:]
+        full_args = {key: value for key, value in args.items() if key != "changed_items"}
+        return _compute_plan(user_data, full_args, now, planner_stats, work_queue)
+    note = _short_items_note(short_items, not infeasible)
+    new_plan = [_plan_block(slot_key, f"Work on {item.name}") for slot_key, item in allocated]
+    if incremental:
+        saved_plan = kept_plan + new_plan
+        if PLAN_MERGE_BLOCKS:
+            saved_plan = merge_plan_blocks(saved_plan)
+        plan_change = _plan_delta(existing_plan, saved_plan)
+        planner_log("Planner: V8 incremental run complete.")
+        return ({"status": "success", "message": "I've updated your study plan." + note,
+                 "short_items": short_items}, saved_plan, plan_change)
+
+    if PLAN_MERGE_BLOCKS:
+        new_plan = merge_plan_blocks(new_plan)
+    # Still a replace, which also clears out blocks the old plan stored twice,
+    # but only when something changed, and naming the days that did
+    plan_delta = _plan_delta(existing_plan, new_plan)
+    plan_change = plan_delta and {"replace": new_plan, "dates": _plan_change_dates(plan_delta)}
+    planner_log("Planner: V8 run complete. New plan saved.")
+    return ({"status": "success", "message": "I've regenerated your study plan." + note,
+             "short_items": short_items}, new_plan, plan_change)
+
+
+# === END OF V8 PLANNER ENGINE ===
+
+
+# === START OF PLANNER JOB QUEUE ===
+# Planner runs requested by /chat, the priority modal and /save_personalization
+# run on a local worker pool instead of inside the request. The client gets a
+# job ID straight away, polls /plan_status, and refreshes the calendar (or shows
+# the priority modal on a conflict) when the job is done. Job state lives in
+# planner_jobs, so /plan_status can land on any worker, and a user's runs are
+# serialized across processes by the "planner:<username>" lease.
+#
+# Requests are debounced per user: a job waits PLANNER_DEBOUNCE_SECONDS after
+# the latest request (but no longer than PLANNER_DEBOUNCE_MAX_SECONDS after the
+# first) and every request that arrives meanwhile, or while the user's previous
+# job is still running, joins it. One run then covers the latest state of the
+# whole burst; planner_job_stats["coalesced"] counts the runs saved. Bursts
+# are coalesced per process.
+PLANNER_JOB_WORKERS = int(os.getenv("PLANNER_JOB_WORKERS", "2"))
+PLANNER_DEBOUNCE_SECONDS = float(os.getenv("PLANNER_DEBOUNCE_SECONDS", "0.4"))
+PLANNER_DEBOUNCE_MAX_SECONDS = float(os.getenv("PLANNER_DEBOUNCE_MAX_SECONDS", "2"))
+PLANNER_JOB_RETENTION = timedelta(minutes=10)  # Finished jobs stay queryable this long
+PLANNER_JOB_MAX_AGE = timedelta(days=1)  # Jobs whose process died before finishing them
+PLANNER_LEASE_SECONDS = 60  # Longer than any planner run; a crashed run's lease runs out
+PLANNER_LEASE_POLL_SECONDS = 0.1
+PLANNER_LEASE_WAIT_SECONDS = PLANNER_LEASE_SECONDS + 10  # By then even a crashed holder's lease has run out
+PLANNER_QUEUED_NOTE = "I'm updating your study plan in the background."
+
+_planner_job_pool = ThreadPoolExecutor(max_workers=PLANNER_JOB_WORKERS)
+_planner_schedules = {}  # username -> {"pending", "args", "first_requested", "due", "timer", "running", "saving"}
+planner_job_stats = {"requested": 0, "runs": 0, "coalesced": 0}
+_planner_jobs_lock = threading.Lock()
+_user_planner_locks = {}  # username -> {"lock", "users"}, only while a run holds or waits for it
+
+
+@contextmanager
+def _user_planner_lock(username):
+    with _planner_jobs_lock:
+        entry = _user_planner_locks.setdefault(username, {"lock": threading.Lock(), "users": 0})
+        entry["users"] += 1
+    try:
+        with entry["lock"]:
+            yield
+    finally:
+        with _planner_jobs_lock:
+            entry["users"] -= 1
+            if not entry["users"]:
+                del _user_planner_locks[username]
+
+
+@contextmanager
+def _user_planner_lease(username):
+    """
+    The cross-process half of the per-user planner lock; _user_planner_lock
+    keeps this process's threads off Mongo. Raises TimeoutError if the lease
+    is not free within PLANNER_LEASE_WAIT_SECONDS.
+    """
+    lease_name = f"planner:{username}"
+    give_up_at = perf_counter() + PLANNER_LEASE_WAIT_SECONDS
+    while not acquire_lease(lease_name, PLANNER_LEASE_SECONDS):
+        if perf_counter() >= give_up_at:
+            raise TimeoutError(f"Another process held {lease_name} for over {PLANNER_LEASE_WAIT_SECONDS}s")
+        threading.Event().wait(PLANNER_LEASE_POLL_SECONDS)
+    try:
+        yield
+    finally:
+        release_lease(lease_name)
+
+
+def _save_planner_job(job, *fields):
+    """Writes the job (or just these fields of it) to planner_jobs."""
+    if fields:
+        planner_jobs_collection.update_one({"_id": job["job_id"]}, {"$set": {field: job[field] for field in fields}})
+    else:
+        planner_jobs_collection.insert_one(dict(job, _id=job["job_id"]))
+
+
+def _merge_planner_args(current, new):
+    """
+    Args for one run that covers both requests: incremental only if both were,
+    ties auto-resolved if either asked for it (a modal "Auto" choice is never
+    undone), and daily overrides combined, the newer request winning per day.
+    """
+    merged = {}
+    if "changed_items" in current and "changed_items" in new:
+        merged["changed_items"] = list(dict.fromkeys(current["changed_items"] + new["changed_items"]))
+    if current.get("force_auto") or new.get("force_auto"):
+        merged["force_auto"] = True
+    daily_overrides = dict(current.get("daily_overrides") or {}, **(new.get("daily_overrides") or {}))
+    if daily_overrides:
+        merged["daily_overrides"] = daily_overrides
+    return merged
+
+
+def _arm_planner_timer(username, schedule, now):
+    if schedule["timer"]:
+        schedule["timer"].cancel()
+    latest_start = schedule["first_requested"] + timedelta(seconds=PLANNER_DEBOUNCE_MAX_SECONDS)
+    delay = max(0.0, min(PLANNER_DEBOUNCE_SECONDS, (latest_start - now).total_seconds()))
+    schedule["timer"] = threading.Timer(delay, _release_planner_job, [username])
+    schedule["timer"].daemon = True
+    schedule["timer"].start()
+
+
+def _release_planner_job(username):
+    """Debounce timer: hands the user's pending job to the pool, unless their last job is still running."""
+    with _planner_jobs_lock:
+        schedule = _planner_schedules.get(username)
+        if not schedule or not schedule["pending"]:
+            return
+        schedule["due"] = True
+        if schedule["running"]:
+            return  # _run_planner_job releases it when the running job finishes
+        job, args = schedule["pending"], schedule["args"]
+        schedule.update(pending=None, args=None, timer=None, running=job)
+        planner_job_stats["runs"] += 1
+    _planner_job_pool.submit(_run_planner_job, job, args)
+
+
+def _run_planner_job(job, args):
+    job["status"] = "running"
+    trace_token = start_trace("planner_job")
+    error = None
+    try:
+        _save_planner_job(job, "status")
+        job["result"] = run_planner_engine_db(job["username"], args)
+        job["status"] = "done"
+    except Exception as e:
+        error = e
+        print(f"[trace {current_trace_id()}] Planner job {job['job_id']} for {job['username']} failed: {e}")
+        job["error"] = str(e)
+        job["status"] = "error"
+    job["finished_at"] = datetime.now()
+    job["expires_at"] = job["finished_at"] + PLANNER_JOB_RETENTION
+    try:
+        _save_planner_job(job, "status", "result", "error", "finished_at", "expires_at")
+    except Exception as e:
+        print(f"[trace {current_trace_id()}] Could not save planner job {job['job_id']}: {e}")
+    finish_trace(trace_token, error)
+
+    with _planner_jobs_lock:
+        schedule = _planner_schedules[job["username"]]
+        schedule["running"] = None
+        release_next = schedule["pending"] is not None and schedule["due"]
+        if schedule["pending"] is None:
+            del _planner_schedules[job["username"]]
+    if release_next:
+        _release_planner_job(job["username"])
+
+
+def submit_planner_job(username, args):
+    """
+    Queues a planner run for this user. Returns the job (status "queued"),
+    which is the user's already-pending job if this request joined it.
+    """
+    now = datetime.now()
+    with _planner_jobs_lock:
+        planner_job_stats["requested"] += 1
+        schedule = _planner_schedules.setdefault(username, {
+            "pending": None, "args": None, "first_requested": None, "due": False, "timer": None, "running": None,
+            "saving": False})
+
+        if schedule["pending"]:
+            job = schedule["pending"]
+            schedule["args"] = _merge_planner_args(schedule["args"], args)
+            planner_job_stats["coalesced"] += 1
+            planner_log(f"Planner: Joined {username}'s pending job "
+                        f"({planner_job_stats['coalesced']} runs saved so far).")
+            if not schedule["saving"]:
+                _arm_planner_timer(username, schedule, now)
+            return job
+
+        job = {"job_id": uuid.uuid4().hex, "username": username, "status": "queued", "result": None,
+               "error": None, "submitted_at": now, "finished_at": None, "expires_at": now + PLANNER_JOB_MAX_AGE}
+        schedule.update(pending=job, args=dict(args), first_requested=now, due=False, saving=True)
+
+    # Saved before the timer is armed, so the run always finds the job to
+    # update, but outside the lock, so other users' requests do not wait on Mongo
+    try:
+        _save_planner_job(job)
+    except Exception:
+        with _planner_jobs_lock:
+            schedule.update(pending=None, args=None, saving=False)
+            if not schedule["running"]:
+                del _planner_schedules[username]
+        raise
+    with _planner_jobs_lock:
+        schedule["saving"] = False
+        _arm_planner_timer(username, schedule, datetime.now())
+    return job
+
+
+def get_planner_job_stats():
+    with _planner_jobs_lock:
+        return dict(planner_job_stats)
+
+
+def get_planner_job(username, job_id=None):
+    """The user's job with this ID (or their latest job), or None. Jobs from every process are found."""
+    query = {"username": username}
+    if job_id:
+        query["_id"] = job_id
+    jobs = _find(planner_jobs_collection, "plan_status", query, {"_id": 0}, [("submitted_at", DESCENDING)], 1)
+    return jobs[0] if jobs else None
+
+
+def planner_job_status(job):
+    """The JSON-safe view of a job sent to the client."""
+    status = {"job_id": job["job_id"], "status": job["status"]}
+    if job["status"] == "done":
+        status["result"] = job["result"]
+    elif job["status"] == "error":
+        status["error"] = "The planner ran into an error."
+    return status
+
+
+# === END OF PLANNER JOB QUEUE ===
+
+
+# === START OF CHAT HISTORY (Bounded + Summarized) ===
+# Stored history is append-only (one insert per turn). The prompt only gets
+# the newest messages that fit CHAT_PROMPT_TOKEN_BUDGET, with long tool results
+# clipped. Once a user has more than CHAT_HISTORY_READ_LIMIT messages, a
+# background job folds everything except the newest CHAT_KEEP_RECENT_MESSAGES
+# into users.chat_summary and deletes them, so storage stays bounded too.
+CHAT_PROMPT_TOKEN_BUDGET = int(os.getenv("CHAT_PROMPT_TOKEN_BUDGET", "2000"))
+CHAT_HISTORY_READ_LIMIT = int(os.getenv("CHAT_HISTORY_READ_LIMIT", "40"))
+CHAT_KEEP_RECENT_MESSAGES = int(os.getenv("CHAT_KEEP_RECENT_MESSAGES", "20"))
+CHAT_TOOL_MESSAGE_MAX_CHARS = 300
+CHAT_SUMMARY_PROMPT = (
+    "Summarize this conversation between a student and their study-planner assistant in under 120 words. "
+    "Keep facts that matter for future planning: tasks, tests, deadlines, priorities, availability and "
+    "preferences the student mentioned. Fold in the previous summary if there is one."
+)
+_summarizer_pool = ThreadPoolExecutor(max_workers=2)
+_summaries_in_flight = set()
+_summaries_lock = threading.Lock()
+
+
+def _estimate_tokens(message):
+    """Rough token count (~4 characters per token) without a tokenizer dependency."""
+    text = message.get("content") or ""
+    if message.get("tool_calls"):
+        text += json.dumps(message["tool_calls"])
+    return len(text) // 4 + 4
+
+
+def build_history_window(history, token_budget=CHAT_PROMPT_TOKEN_BUDGET):
+    """
+    Returns the newest messages that fit the token budget. The window always
+    starts at a user message, so a tool result never loses the assistant
+    message that requested it. Long tool results are clipped.
+    """
+    window = []
+    used_tokens = 0
+    for message in reversed(history):
+        if message.get("role") == "tool" and len(message.get("content") or "") > CHAT_TOOL_MESSAGE_MAX_CHARS:
+            message = dict(message, content=message["content"][:CHAT_TOOL_MESSAGE_MAX_CHARS] + "...")
+        used_tokens += _estimate_tokens(message)
+        if used_tokens > token_budget:
             break
+        window.append(message)
+    window.reverse()
+    while window and window[0].get("role") != "user":
+        window.pop(0)
+    return window
 
-    # 7. Save the new plan
-    users_collection.update_one(
-        {"username": username},
-        {"$set": {"generated_plan": new_plan}}
-    )
 
-    print("Planner: V8 run complete. New plan saved.")
-    return {"status": "success", "message": "I've regenerated your study plan."}
+def _format_for_summary(message):
+    if message.get("tool_calls"):
+        calls = ", ".join(f"{call['function']['name']}({call['function']['arguments']})"
+                          for call in message["tool_calls"])
+        return f"assistant called: {calls}"
+    return f"{message.get('role')}: {message.get('content')}"
 
 
-# === END OF V8 PLANNER ENGINE ===
+def summarize_chat_history(username):
+    """Folds all but the newest CHAT_KEEP_RECENT_MESSAGES messages into users.chat_summary."""
+    try:
+        history = load_chat_history(username, projection={"username": 0}, site="chat:summarizer")
+        older = history[:-CHAT_KEEP_RECENT_MESSAGES]
+        # Cut at a user message so the kept part starts with a complete exchange
+        while older and history[len(older)].get("role") != "user":
+            older.pop()
+        if not older:
+            return
+        previous_summary = get_chat_summary(username)
+        transcript = "\n".join(_format_for_summary(message) for message in older)
+        if previous_summary:
+            transcript = f"Previous summary: {previous_summary}\n{transcript}"
+        response = openai_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "system", "content": CHAT_SUMMARY_PROMPT},
+                      {"role": "user", "content": transcript}]
+        )
+        record_prompt_usage("chat:summary", getattr(response, "usage", None))
+        summary = response.choices[0].message.content
+        users_collection.update_one({"username": username}, {"$set": {"chat_summary": summary}})
+        chat_messages_collection.delete_many({"username": username, "_id": {"$lte": older[-1]["_id"]}})
+        print(f"Chat summarizer: folded {len(older)} messages for {username}")
+    except Exception as e:
+        print(f"Error summarizing chat history for {username}: {e}")
+    finally:
+        with _summaries_lock:
+            _summaries_in_flight.discard(username)
+
+
+def schedule_chat_summary(username):
+    with _summaries_lock:
+        if username in _summaries_in_flight:
+            return
+        _summaries_in_flight.add(username)
+    _summarizer_pool.submit(summarize_chat_history, username)
+
+
+# === END OF CHAT HISTORY ===
+
+
+# === START OF PROMPT CONTEXT (Compact + Cache-Friendly) ===
+# The user's data goes to the model as terse, stably ordered lines with
+# relative dates instead of a JSON dump. The prompt runs from most to least
+# stable so OpenAI's automatic prompt caching can reuse its prefix: tools and
+# SYSTEM_PROMPT (fixed), the chat summary, the history (append-only), and only
+# then today's date and the data context, which change from turn to turn.
+# Tasks and tests that do not fit CHAT_CONTEXT_TOKEN_BUDGET are dropped,
+# already-past ones first, then the ones due furthest away.
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "800"))
+prompt_token_stats = {}  # site -> {"requests", "prompt_tokens", "cached_tokens", "completion_tokens"}
+_prompt_token_stats_lock = threading.Lock()
+
+
+def _relative_day(day, now):
+    days = (day - now.date()).days
+    if days == 0:
+        return "today"
+    if days == 1:
+        return "tomorrow"
+    return f"in {days}d" if days > 0 else f"{-days}d ago"
+
+
+def _encode_item(item, deadline, type_field, now):
+    """One task/test line: name | type | due Wed 10-21 17:00 (in 4d) | priority high | 3h"""
+    if deadline:
+        due = deadline.strftime("%a %m-%d %H:%M" if type_field == "task_type" else "%a %m-%d")
+        due = f"{due} ({_relative_day(deadline.date(), now)})"
+    else:
+        due = item.get("deadline", item.get("date"))
+    fields = [item.get("name"), item.get(type_field), f"due {due}"]
+    if item.get("priority"):
+        fields.append(f"priority {item['priority']}")
+    if item.get("duration_hours"):
+        fields.append(f"{item['duration_hours']}h")
+    return " | ".join(str(field) for field in fields)
+
+
+def _encode_weekly(items, label, describe):
+    """Day-ordered "Mon 09:00-12:00" entries for classes or study windows."""
+    ordered = sorted(items, key=lambda item: (WEEKDAY_BY_NAME.get(item.get("day"), 7), item.get("start_time", "")))
+    entries = [f"{str(item.get('day', ''))[:3]} {item.get('start_time')}-{item.get('end_time')}{describe(item)}"
+               for item in ordered]
+    return f"{label}: {'; '.join(entries) if entries else 'none'}"
+
+
+def encode_prompt_context(user_data, selected_year, now, token_budget=CHAT_CONTEXT_TOKEN_BUDGET):
+    """The system message with today's date and the user's data, in at most ~token_budget tokens."""
+    preferences = user_data.get("preferences") or {}
+    lines = [
+        f"CRITICAL: Today's date is {now.strftime('%A, %B %d, %Y')}. Use this as the anchor for all date math. "
+        f"Assume all new dates are for the year {selected_year}.",
+        "Current data:",
+        _encode_weekly(user_data.get("schedule", []), "Classes", lambda item: f" {item.get('subject')}"),
+        f"Awake {preferences.get('awake_time', '?')}-{preferences.get('sleep_time', '?')}. " +
+        _encode_weekly(user_data.get("study_windows", []), "Study windows",
+                       lambda item: f" ({item['focus_level']} focus)" if item.get("focus_level") else "")
+    ]
+    used_tokens = sum(len(line) // 4 + 1 for line in lines)
+
+    items = [("Tasks", item, parse_item_deadline(item), "task_type") for item in user_data.get("tasks", [])]
+    items += [("Tests", item, parse_item_deadline(item), "test_type") for item in user_data.get("tests", [])]
+    # Keep order: upcoming items soonest first, then past items (not swept yet) newest first
+    upcoming = sorted((entry for entry in items if entry[2] and entry[2] >= now), key=lambda entry: entry[2])
+    past = sorted((entry for entry in items if not entry[2] or entry[2] < now),
+                  key=lambda entry: entry[2] or datetime.min, reverse=True)
+
+    kept = {"Tasks": [], "Tests": []}
+    dropped = 0
+    for section, item, deadline, type_field in upcoming + past:
+        line = _encode_item(item, deadline, type_field, now)
+        if used_tokens + len(line) // 4 + 1 > token_budget:
+            dropped += 1
+            continue
+        used_tokens += len(line) // 4 + 1
+        kept[section].append((deadline or datetime.max, str(item.get("name")), line))
+
+    for section in ("Tasks", "Tests"):
+        entries = [line for _, _, line in sorted(kept[section])]
+        lines.append(f"{section}: none" if not entries else f"{section} (name | type | due | ...):")
+        lines.extend(f"- {line}" for line in entries)
+    if dropped:
+        lines.append(f"({dropped} more tasks/tests not shown.)")
+    return {"role": "system", "content": "\n".join(lines)}
+
+
+def record_prompt_usage(site, usage):
+    """Adds an OpenAI response's token usage to prompt_token_stats (served from /prompt_stats)."""
+    if not usage:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", 0) or 0
+    with _prompt_token_stats_lock:
+        stats = prompt_token_stats.setdefault(site, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0,
+                                                     "completion_tokens": 0})
+        stats["requests"] += 1
+        stats["prompt_tokens"] += usage.prompt_tokens or 0
+        stats["cached_tokens"] += cached_tokens
+        stats["completion_tokens"] += usage.completion_tokens or 0
+    record_trace_tokens((usage.prompt_tokens or 0) + (usage.completion_tokens or 0))
+
+
+def get_prompt_token_stats():
+    with _prompt_token_stats_lock:
+        return {site: dict(stats) for site, stats in prompt_token_stats.items()}
+
+
+# === END OF PROMPT CONTEXT ===
+
+
+# === START OF INTENT FAST-PATH ===
+# Commands that always end in the same tool call skip the model. The router
+# builds the assistant message the model would have sent and the turn runs
+# through iter_chat_turn as usual, so the reply and the saved history are the
+# same as before; it just takes milliseconds instead of an OpenAI round trip.
+# Only whole messages that match a pattern exactly are routed locally,
+# everything else still goes to the model. Priority-modal replies never reached
+# the model (see handle_priority_choice) and are counted as fast-path turns.
+FAST_PATH_INTENTS = [
+    # (intent, pattern for the normalized message, tool to call)
+    ("daily_checkin", re.compile(r"trigger:daily_checkin"), "get_daily_plan"),
+    ("todays_plan", re.compile(
+        r"(what'?s|what is|show( me)?) (on |planned )?((for|my plan|the plan)( for)? )?today"
+        r"|(show( me)? )?(my )?today'?s (plan|schedule)"
+        r"|what do i have( on| planned)? today"), "get_daily_plan"),
+    ("update_plan", re.compile(
+        r"(please )?(update|make|generate|regenerate|refresh|redo|rebuild|run) (my|the) (study )?(plan|schedule)"
+        r"( please)?|re-?plan( please)?"), "run_planner_engine"),
+]
+fast_path_stats = {"turns": 0, "hits": 0, "intents": {}}
+_fast_path_stats_lock = threading.Lock()
+
+
+def record_fast_path(intent):
+    """Counts a chat turn; intent is None when it went to the model."""
+    with _fast_path_stats_lock:
+        fast_path_stats["turns"] += 1
+        if intent:
+            fast_path_stats["hits"] += 1
+            fast_path_stats["intents"][intent] = fast_path_stats["intents"].get(intent, 0) + 1
+
+
+def get_fast_path_stats():
+    with _fast_path_stats_lock:
+        stats = dict(fast_path_stats, intents=dict(fast_path_stats["intents"]))
+    stats["hit_rate"] = round(stats["hits"] / stats["turns"], 3) if stats["turns"] else 0.0
+    return stats
+
+
+def match_fast_path_intent(user_message):
+    """(intent, tool name) for a message the router can answer itself, or (None, None)."""
+    text = " ".join(str(user_message or "").lower().replace("\u2019", "'").split()).rstrip("?!. ")
+    for intent, pattern, function_name in FAST_PATH_INTENTS:
+        if pattern.fullmatch(text):
+            return intent, function_name
+    return None, None
+
+
+def fast_path_turn(user_message):
+    """
+    (messages, turn_start, assistant_message) for iter_chat_turn if the
+    message is a known command, otherwise None and the caller asks the model.
+    """
+    intent, function_name = match_fast_path_intent(user_message)
+    record_fast_path(intent)
+    if not intent:
+        return None
+    assistant_message = {
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [{
+            "id": f"call_local_{uuid.uuid4().hex[:16]}",
+            "type": "function",
+            "function": {"name": function_name, "arguments": "{}"}
+        }]
+    }
+    return [{"role": "user", "content": user_message}], 0, assistant_message
+
+
+# === END OF INTENT FAST-PATH ===
+
+
+# The priority modal's replies: "User priority choice: <name or Auto>" for a
+# single tie, "User priority choices: <JSON list of names>" with a pick per
+# tie group. Task names can start with "[", so only the prefix says which.
+PRIORITY_CHOICE_PREFIX = "User priority choice: "
+PRIORITY_CHOICES_PREFIX = "User priority choices: "
+
+
+def is_priority_choice(user_message):
+    return user_message.startswith((PRIORITY_CHOICE_PREFIX, PRIORITY_CHOICES_PREFIX))
+
+
+def parse_priority_choices(user_message):
+    """The task names a priority modal reply picks, ["Auto"] for Auto, or None if it is malformed."""
+    if user_message.startswith(PRIORITY_CHOICES_PREFIX):
+        try:
+            task_names = json.loads(user_message[len(PRIORITY_CHOICES_PREFIX):])
+        except ValueError:
+            return None
+        if not isinstance(task_names, list) or not all(isinstance(name, str) and name for name in task_names):
+            return None
+        return task_names
+    choice = user_message[len(PRIORITY_CHOICE_PREFIX):].strip()
+    return [choice] if choice else None
+
+
+def handle_priority_choice(username, user_message):
+    """
+    Handles a priority modal reply (see PRIORITY_CHOICE_PREFIX).
+    This is a special, non-AI path. Returns the JSON payload for the client.
+    """
+    record_fast_path("priority_choice")
+    task_names = parse_priority_choices(user_message)
+
+    if task_names is None:
+        return {"reply": "Sorry, I couldn't read that choice. Please pick again from the conflict dialog.",
+                "action": "none"}
+
+    if task_names == ["Auto"]:
+        # User wants us to auto-schedule (round-robin)
+        plan_job = submit_planner_job(username, {"force_auto": True})
+        reply_to_send = f"OK, I'm scheduling both tasks. {PLANNER_QUEUED_NOTE}"
+
+    else:
+        # User prioritized specific tasks: one name, or a pick per tie group
+        # (groups the user left to us are not in the list)
+        # V8 FIX: Set priority to "top" (score 0) to permanently win all
+        # future tie-breaks, not just "high" (score 1).
+        batch = new_write_batch()
+        for task_name in task_names:
+            update_task_details_db(username, {"current_name": task_name, "new_priority": "top"}, batch)
+        flush_writes(batch)
+
+        # Re-run the planner. The modal covered every tie the planner found,
+        # so whatever the user left open is auto-resolved instead of asked again.
+        plan_job = submit_planner_job(username, {"force_auto": True})
+        if task_names:
+            reply_to_send = f"OK, I've prioritized {', '.join(task_names)}. {PLANNER_QUEUED_NOTE}"
+        else:
+            reply_to_send = f"OK, I'm scheduling those tasks. {PLANNER_QUEUED_NOTE}"
+
+    # Save this interaction to history
+    save_chat_turn(username, [{"role": "user", "content": user_message},
+                              {"role": "assistant", "content": reply_to_send}])
+    return {"reply": reply_to_send, "action": "none", "plan_job": planner_job_status(plan_job)}
+
+
+def build_chat_messages(username, user_data, user_message, selected_year, chat_history=None):
+    """
+    Builds the prompt for a standard chat turn: system prompt, date, context
+    and the windowed history. Returns (messages, turn_start), where
+    messages[turn_start:] are this turn's messages. chat_history is the newest
+    CHAT_HISTORY_READ_LIMIT messages if the caller already loaded them.
+    """
+    # Most stable first (see PROMPT CONTEXT): system prompt, summary, history, then date + data
+    messages_header = [{"role": "system", "content": SYSTEM_PROMPT}]
+    conversational_history = []
+    if user_message != "trigger:daily_checkin":
+        old_full_history = chat_history
+        if old_full_history is None:
+            old_full_history = load_chat_history(username, limit=CHAT_HISTORY_READ_LIMIT)
+        if len(old_full_history) >= CHAT_HISTORY_READ_LIMIT:
+            schedule_chat_summary(username)
+        conversational_history = build_history_window([
+            msg for msg in old_full_history
+            if msg.get("role") in ["assistant", "tool"] or
+               (msg.get("role") == "user" and not msg.get("content", "").startswith("Here is my current data."))
+        ])
+        if user_data.get("chat_summary"):
+            messages_header.append({"role": "system",
+                                    "content": f"Summary of the earlier conversation: {user_data['chat_summary']}"})
+
+    messages = messages_header + conversational_history
+    messages.append(encode_prompt_context(user_data, selected_year, datetime.now()))
+    turn_start = len(messages)  # Only this turn's messages get appended to the stored history
+    messages.append({"role": "user", "content": user_message})
+    return messages, turn_start
+
+
+# === START OF TOOL DISPATCH ===
+# A turn runs its tool calls in three phases instead of one by one:
+#   1. writes, queued on one batch in the model's order and flushed once;
+#   2. at most one planner pass, covering every write, reschedule_day and
+#      run_planner_engine call in the turn. It is a background job unless the
+#      turn also has read tools, which have to report the new plan;
+#   3. the read tools, in parallel, so they also see the new plan.
+
+CHAT_READ_TOOLS = {
+    "get_daily_plan": get_daily_plan_db,
+    "get_priority_list": get_priority_list_db
+}
+CHAT_PLANNER_TOOLS = ("reschedule_day", "run_planner_engine")
+# update_task_details arguments that change an item's place in the queue or its block count
+TASK_PLANNING_FIELDS = ("new_task_type", "new_deadline", "new_priority", "new_duration_hours")
+READ_TOOL_WORKERS = int(os.getenv("READ_TOOL_WORKERS", "4"))
+_read_tool_pool = ThreadPoolExecutor(max_workers=READ_TOOL_WORKERS)
+
+
+def _run_read_tools(username, read_calls):
+    """Runs [(tool_message, function_name, arguments)] read tools, filling in each message's content."""
+    if len(read_calls) == 1:
+        tool_message, function_name, arguments = read_calls[0]
+        tool_message["content"] = CHAT_READ_TOOLS[function_name](username, arguments)
+        return
+    # Each read runs in a copy of this context so its spans land in the request's trace
+    futures = [(tool_message, _read_tool_pool.submit(contextvars.copy_context().run, CHAT_READ_TOOLS[function_name],
+                                                     username, arguments))
+               for tool_message, function_name, arguments in read_calls]
+    for tool_message, future in futures:
+        tool_message["content"] = future.result()
+
+
+def iter_chat_turn(username, user_message, messages, turn_start, assistant_message):
+    """
+    Runs the tool calls in the model's reply (see TOOL DISPATCH), then saves
+    the turn. Yields ("tool", ...) and ("planner", ...) progress events and
+    finally ("done", payload) with the JSON payload for the client.
+    """
+    messages.append(assistant_message)
+    reset_history = user_message == "trigger:daily_checkin"
+
+    if not assistant_message.get("tool_calls"):
+        save_chat_turn(username, messages[turn_start:], reset_history=reset_history)
+        yield "done", {"reply": assistant_message.get("content")}
+        return
+
+    run_planner = False
+    changed_items = []  # Items whose blocks the incremental planner must re-place (renames and deletes)
+    full_replan = False
+    planner_args = {}
+    batch = new_write_batch()
+    tool_messages = []
+    pending_replies = []  # (tool message, reply rendered after the flush)
+    planner_calls = []  # (tool message, function_name)
+    read_calls = []  # (tool message, function_name, arguments)
+
+    # 1. Writes
+    for tool_call in assistant_message["tool_calls"]:
+        function_name = tool_call["function"]["name"]
+        arguments = json.loads(tool_call["function"]["arguments"])
+        tool_message = {
+            "role": "tool",
+            "tool_call_id": tool_call["id"],
+            "name": function_name,
+            "content": None
+        }
+        tool_messages.append(tool_message)
+        yield "tool", {"name": function_name, "status": "running"}
+
+        if function_name in CHAT_READ_TOOLS:
+            read_calls.append((tool_message, function_name, arguments))
+            continue
+        elif function_name in CHAT_PLANNER_TOOLS:
+            if function_name == "reschedule_day":
+                planner_args = reschedule_day_planner_args(arguments)
+            run_planner = True
+            full_replan = True
+            planner_calls.append((tool_message, function_name))
+            continue
+
+        if function_name == "save_preference":
+            response_msg_for_user = update_user_data(username, "preference", arguments, batch)
+        elif function_name == "save_class":
+            response_msg_for_user = update_user_data(username, "class", arguments, batch)
+        elif function_name == "save_task":
+            response_msg_for_user = update_user_data(username, "task", arguments, batch)
+            run_planner = True
+            full_replan = True  # A new item can outrank the blocks already placed
+        elif function_name == "save_test":
+            response_msg_for_user = update_user_data(username, "test", arguments, batch)
+            run_planner = True
+            full_replan = True
+        elif function_name == "update_task_details":
+            response_msg_for_user = update_task_details_db(username, arguments, batch)
+            run_planner = True
+            if any(arguments.get(field) for field in TASK_PLANNING_FIELDS):
+                full_replan = True  # Its rank or size changed, so other items' blocks may have to move
+            else:
+                changed_items.append(arguments.get("new_name") or arguments.get("current_name"))
+        elif function_name == "update_class_schedule":
+            response_msg_for_user = update_class_schedule_db(username, arguments, batch)
+        elif function_name == "delete_schedule_item":
+            response_msg_for_user = delete_schedule_item_db(username, arguments, batch)
+            run_planner = True
+            changed_items.append(arguments.get("item_name"))
+        elif function_name == "save_study_windows":
+            response_msg_for_user = save_study_windows_db(username, arguments, batch)
+            run_planner = True
+            full_replan = True  # New windows change which slots are preferred for every item
+        else:
+            response_msg_for_user = "Error: AI tried to call an unknown function."
+
+        if callable(response_msg_for_user):
+            pending_replies.append((tool_message, response_msg_for_user))
+        else:
+            tool_message["content"] = response_msg_for_user
+
+    flush_writes(batch)
+    for tool_message, render_reply in pending_replies:
+        tool_message["content"] = render_reply()
+
+    # 2. One planner pass for the whole turn
+    planner_response = None
+    plan_job = None
+    if run_planner:
+        if not full_replan:
+            planner_args = {"changed_items": changed_items}
+        if read_calls:
+            yield "planner", {"status": "running"}
+            planner_response = run_planner_engine_db(username, planner_args)
+        else:
+            plan_job = submit_planner_job(username, planner_args)
+            planner_response = {"status": "queued", "message": PLANNER_QUEUED_NOTE}
+        for tool_message, function_name in planner_calls:
+            if function_name == "reschedule_day":
+                tool_message["content"] = reschedule_day_reply(planner_response)
+            else:
+                tool_message["content"] = planner_response.get("message", "OK, I've run the planner.")
+
+    # 3. Reads
+    if read_calls:
+        _run_read_tools(username, read_calls)
+
+    for tool_message in tool_messages:
+        yield "tool", {"name": tool_message["name"], "status": "done"}
+    messages.extend(tool_messages)
+
+    reply_to_send = tool_messages[-1]["content"]
+    if planner_response:
+        if planner_response["status"] == "conflict":
+            save_chat_turn(username, messages[turn_start:], reset_history=reset_history)
+            yield "done", {
+                "reply": f"{reply_to_send}. (Note: I found a scheduling conflict. Please choose which task to prioritize first:)",
+                "action": "show_priority_modal",
+                "options": planner_response["options"],
+                "tie_groups": planner_response["tie_groups"],
+                "infeasible": planner_response["infeasible"]
+            }
+            return
+        elif tool_messages[-1]["name"] not in CHAT_PLANNER_TOOLS:
+            # The planner tools' own replies already carry the planner's message
+            reply_to_send += f" (Note: {planner_response['message']})"
+
+    save_chat_turn(username, messages[turn_start:], reset_history=reset_history)
+
+    payload = {"reply": reply_to_send}
+    if plan_job:
+        payload["plan_job"] = planner_job_status(plan_job)
+    yield "done", payload
+
+
+# === END OF TOOL DISPATCH ===
 
 
 @app.route("/chat", methods=["POST"])
@@ -850,198 +3110,247 @@ def chat():
     user_message = request.json.get("message")
     selected_year = request.json.get("year", str(json.loads(os.getenv("CURRENT_DATE", '{"year": 2025}'))["year"]))
     username = session["username"]
-    user_data = users_collection.find_one({"username": username})
+    user_data = load_user_data(username, include_plan=False, site="chat", extra_fields=("chat_summary",))
 
     if not user_data:
         session.pop("username", None)
         return jsonify({"reply": "Error: Your user data was not found. Please log in again."}), 401
 
-    old_full_history = user_data.get("chat_history", [])
-
     # === START OF V8 CHAT LOGIC (Loop Fix) ===
 
     # 1. Handle Modal Response
-    # This is a special, non-AI path
-    if user_message.startswith("User priority choice:"):
-        choice = user_message.split(": ", 1)[1]
+    if is_priority_choice(user_message):
+        return jsonify(handle_priority_choice(username, user_message))
+
+    # 2. Commands the intent router answers without the model
+    local_turn = fast_path_turn(user_message)
 
-        if choice == "Auto":
-            # User wants us to auto-schedule (round-robin)
-            planner_response = run_planner_engine_db(username, {"force_auto": True})
-            reply_to_send = f"OK, I'm scheduling both tasks. {planner_response['message']}"
+    # 3. Standard Chat Message Path (Builds context for AI)
+    if not local_turn:
+        messages, turn_start = build_chat_messages(username, user_data, user_message, selected_year)
 
+    # === END OF V8 CHAT LOGIC ===
+
+    try:
+        if local_turn:
+            messages, turn_start, assistant_message = local_turn
         else:
-            # User prioritized a specific task
-            task_name = choice
-
-            # V8 FIX: Set priority to "top" (score 0) to permanently win all
-            # future tie-breaks, not just "high" (score 1).
-            update_task_details_db(username, {"current_name": task_name, "new_priority": "top"})
-
-            # Re-run the planner...
-            planner_response = run_planner_engine_db(username, {})
-
-            # ...and check if the re-run found ANOTHER conflict
-            if planner_response["status"] == "conflict":
-                # Yes, it found another tie. We must ask the user again.
-                reply_to_send = f"OK, I've prioritized {task_name}. (Note: I found another scheduling conflict. Please choose again:)"
-
-                # Save history and return the NEW modal action
-                old_full_history.append({"role": "user", "content": user_message})
-                old_full_history.append({"role": "assistant", "content": reply_to_send})
-                users_collection.update_one(
-                    {"username": username},
-                    {"$set": {"chat_history": old_full_history}}
-                )
-                return jsonify({
-                    "reply": reply_to_send,
-                    "action": "show_priority_modal",
-                    "options": planner_response["options"]
-                })
-
-            # --- If no new conflict, proceed as normal ---
-            reply_to_send = f"OK, I've prioritized {task_name}. {planner_response['message']}"
-
-        # Save this interaction to history (for non-conflict cases)
-        old_full_history.append({"role": "user", "content": user_message})
-        old_full_history.append({"role": "assistant", "content": reply_to_send})
-        users_collection.update_one(
-            {"username": username},
-            {"$set": {"chat_history": old_full_history}}
-        )
-        return jsonify({"reply": reply_to_send, "action": "none"})
+            response = openai_client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                tools=tools,
+                tool_choice="auto"
+            )
+            record_prompt_usage("chat", getattr(response, "usage", None))
+            response_message = response.choices[0].message
 
-    # 2. Standard Chat Message Path (Builds context for AI)
-    today_string = datetime.now().strftime("%A, %B %d, %Y")
-    fresh_context_data = {
-        "schedule": user_data.get("schedule", []),
-        "tasks": user_data.get("tasks", []),
-        "tests": user_data.get("tests", []),
-        "preferences": user_data.get("preferences", {}),
-        "study_windows": user_data.get("study_windows", [])
-    }
-    messages_header = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "system",
-         "content": f"CRITICAL: Today's date is {today_string}. Use this as the anchor for all date math."},
-        {"role": "user",
-         "content": f"Here is my current data. Assume all new dates are for the year {selected_year}. Context: {json.dumps(fresh_context_data)}"}
-    ]
-    conversational_history = [
-        msg for msg in old_full_history
-        if msg.get("role") in ["assistant", "tool"] or
-           (msg.get("role") == "user" and not msg.get("content", "").startswith("Here is my current data."))
-    ]
-    if user_message == "trigger:daily_checkin":
-        conversational_history = []
+            if response_message.tool_calls:
+                assistant_message = response_message.model_dump(exclude={'function_call'})
+            else:
+                assistant_message = {
+                    "role": response_message.role,
+                    "content": response_message.content
+                }
 
-    messages = messages_header + conversational_history
-    messages.append({"role": "user", "content": user_message})
+        for event, data in iter_chat_turn(username, user_message, messages, turn_start, assistant_message):
+            if event == "done":
+                return jsonify(data)
 
-    # === END OF V8 CHAT LOGIC ===
+    except Exception as e:
+        print(f"[trace {current_trace_id()}] Error in /chat route: {e}")
+        return jsonify({"reply": "Sorry, I ran into an error. Please try that again."}), 500
 
-    try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            tools=tools,
-            tool_choice="auto"
-        )
-        response_message = response.choices[0].message
 
-        if response_message.tool_calls:
-            messages.append(response_message.model_dump(exclude={'function_call'}))
-        else:
-            messages.append({
-                "role": response_message.role,
-                "content": response_message.content
-            })
-
-        reply_to_send = ""
-        run_planner = False
-        planner_response = None  # Store planner result
-
-        if response_message.tool_calls:
-            for tool_call in response_message.tool_calls:
-                function_name = tool_call.function.name
-                arguments = json.loads(tool_call.function.arguments)
-
-                if function_name == "save_preference":
-                    response_msg_for_user = update_user_data(username, "preference", arguments)
-                elif function_name == "save_class":
-                    response_msg_for_user = update_user_data(username, "class", arguments)
-                elif function_name == "save_task":
-                    response_msg_for_user = update_user_data(username, "task", arguments)
-                    run_planner = True
-                elif function_name == "save_test":
-                    response_msg_for_user = update_user_data(username, "test", arguments)
-                    run_planner = True
-                elif function_name == "update_task_details":
-                    response_msg_for_user = update_task_details_db(username, arguments)
-                    run_planner = True
-                elif function_name == "update_class_schedule":
-                    response_msg_for_user = update_class_schedule_db(username, arguments)
-                elif function_name == "delete_schedule_item":
-                    response_msg_for_user = delete_schedule_item_db(username, arguments)
-                    run_planner = True
-                elif function_name == "save_study_windows":
-                    response_msg_for_user = save_study_windows_db(username, arguments)
-                    run_planner = True
-                elif function_name == "get_daily_plan":
-                    response_msg_for_user = get_daily_plan_db(username, arguments)
-                elif function_name == "get_priority_list":
-                    response_msg_for_user = get_priority_list_db(username, arguments)
-
-                elif function_name == "reschedule_day":
-                    response_msg_for_user = reschedule_day_db(username, arguments)
-                    planner_response = {"status": "success", "message": response_msg_for_user}
-                    run_planner = False
-
-                elif function_name == "run_planner_engine":
-                    planner_response = run_planner_engine_db(username, {})
-                    response_msg_for_user = planner_response.get("message", "OK, I've run the planner.")
-                else:
-                    response_msg_for_user = "Error: AI tried to call an unknown function."
-
-                messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "name": function_name,
-                    "content": response_msg_for_user
-                })
-                reply_to_send = response_msg_for_user
-        else:
-            reply_to_send = response_message.content
+# === START OF STREAMING CHAT (Server-Sent Events) ===
+# Same turn as /chat, but the model's text is forwarded token by token and
+# tool / planner progress is reported as it happens, so the first bytes reach
+# the browser as soon as OpenAI starts answering. Events:
+#   token   {"text": ...}              a piece of the assistant's reply
+#   tool    {"name": ..., "status": running|done}
+#   planner {"status": "running"}
+#   done    the same payload /chat would have returned
+#   error   {"reply": ...}
 
-        if run_planner and not planner_response:
-            planner_response = run_planner_engine_db(username, {})
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-        if planner_response:
-            if function_name == "reschedule_day":
-                reply_to_send = planner_response['message']
-            elif planner_response["status"] == "conflict":
-                users_collection.update_one(
-                    {"username": username},
-                    {"$set": {"chat_history": messages}}
-                )
-                return jsonify({
-                    "reply": f"{reply_to_send}. (Note: I found a scheduling conflict. Please choose which task to prioritize first:)",
-                    "action": "show_priority_modal",
-                    "options": planner_response["options"]
-                })
+
+def _add_stream_chunk(streamed, chunk):
+    """
+    Folds one streamed completion chunk into streamed ({"content_parts": [],
+    "tool_calls": {}}), joining tool-call fragments by index. Returns the
+    chunk's text, if any.
+    """
+    if getattr(chunk, "usage", None):
+        streamed["usage"] = chunk.usage  # Only on the last chunk, with stream_options include_usage
+    if not chunk.choices:
+        return None
+    delta = chunk.choices[0].delta
+    if delta.content:
+        streamed["content_parts"].append(delta.content)
+    for call_delta in delta.tool_calls or []:
+        call = streamed["tool_calls"].setdefault(call_delta.index, {
+            "id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+        if call_delta.id:
+            call["id"] = call_delta.id
+        if call_delta.function:
+            call["function"]["name"] += call_delta.function.name or ""
+            call["function"]["arguments"] += call_delta.function.arguments or ""
+    return delta.content
+
+
+def _streamed_assistant_message(streamed):
+    tool_calls = streamed["tool_calls"]
+    content = "".join(streamed["content_parts"])
+    if tool_calls:
+        return {"role": "assistant", "content": content or None,
+                "tool_calls": [tool_calls[index] for index in sorted(tool_calls)]}
+    return {"role": "assistant", "content": content}
+
+
+def _collect_streamed_message(stream):
+    """
+    Yields ("token", text) for every content delta of a streamed completion,
+    then ("message", assistant_message) with the tool-call fragments joined.
+    """
+    streamed = {"content_parts": [], "tool_calls": {}}
+    for chunk in stream:
+        text = _add_stream_chunk(streamed, chunk)
+        if text:
+            yield "token", text
+    record_prompt_usage("chat_stream", streamed.get("usage"))
+    yield "message", _streamed_assistant_message(streamed)
+
+
+@app.route("/chat_stream", methods=["POST"])
+def chat_stream():
+    if "username" not in session:
+        return jsonify({"reply": "Error: Not logged in"}), 401
+
+    user_message = request.json.get("message")
+    selected_year = request.json.get("year", str(json.loads(os.getenv("CURRENT_DATE", '{"year": 2025}'))["year"]))
+    username = session["username"]
+    user_data = load_user_data(username, include_plan=False, site="chat", extra_fields=("chat_summary",))
+
+    if not user_data:
+        session.pop("username", None)
+        return jsonify({"reply": "Error: Your user data was not found. Please log in again."}), 401
+
+    trace_token = detach_request_trace()  # Finished when the stream ends, not at teardown
+
+    def generate():
+        error = None
+        try:
+            if is_priority_choice(user_message):
+                yield _sse_event("done", handle_priority_choice(username, user_message))
+                return
+
+            local_turn = fast_path_turn(user_message)
+            if local_turn:
+                messages, turn_start, assistant_message = local_turn
             else:
-                reply_to_send += f" (Note: {planner_response['message']})"
+                messages, turn_start = build_chat_messages(username, user_data, user_message, selected_year)
+                stream = openai_client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=messages,
+                    tools=tools,
+                    tool_choice="auto",
+                    stream=True,
+                    stream_options={"include_usage": True}
+                )
+                assistant_message = None
+                for kind, value in _collect_streamed_message(stream):
+                    if kind == "token":
+                        yield _sse_event("token", {"text": value})
+                    else:
+                        assistant_message = value
 
-        users_collection.update_one(
-            {"username": username},
-            {"$set": {"chat_history": messages}}
-        )
+            for event, data in iter_chat_turn(username, user_message, messages, turn_start, assistant_message):
+                yield _sse_event(event, data)
 
-        return jsonify({"reply": reply_to_send})
+        except Exception as e:
+            error = e
+            print(f"[trace {current_trace_id()}] Error in /chat_stream route: {e}")
+            yield _sse_event("error", {"reply": "Sorry, I ran into an error. Please try that again."})
+        finally:
+            if trace_token is not None:
+                finish_trace(trace_token, error)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# === END OF STREAMING CHAT ===
+
+
+@app.route("/plan_status")
+def plan_status():
+    if "username" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    job = get_planner_job(session["username"], request.args.get("job_id"))
+    if not job:
+        return jsonify({"error": "No such planner job"}), 404
+    return jsonify(planner_job_status(job))
+
+
+@app.route("/planner_job_stats")
+def planner_job_stats_route():
+    if "username" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    return jsonify(get_planner_job_stats())
+
+
+@app.route("/planner_cache_stats")
+def planner_cache_stats_route():
+    if "username" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    return jsonify(get_planner_cache_stats())
+
+
+@app.route("/write_stats")
+def write_stats_route():
+    if "username" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    return jsonify(get_write_batch_stats())
+
+
+@app.route("/trace_stats")
+def trace_stats_route():
+    if "username" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    return jsonify(get_trace_stats())
+
+
+@app.route("/metrics")
+def metrics_route():
+    # For a Prometheus scraper, so no login; the token, not the client address, since a
+    # reverse proxy on the same host makes every request look local
+    if not METRICS_TOKEN:
+        return jsonify({"error": "Not found"}), 404
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
 
-    except Exception as e:
-        print(f"Error in /chat route: {e}")
-        return jsonify({"reply": "Sorry, I ran into an error. Please try that again."}), 500
+
+@app.route("/fast_path_stats")
+def fast_path_stats_route():
+    if "username" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    return jsonify(get_fast_path_stats())
+
+
+@app.route("/prompt_stats")
+def prompt_stats_route():
+    if "username" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    return jsonify(get_prompt_token_stats())
+
+
+@app.route("/read_stats")
+def read_stats_route():
+    if "username" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    return jsonify(get_read_stats())
 
 
 @app.route("/get_schedule")
@@ -1051,22 +3360,41 @@ def get_schedule():
 
     username = session["username"]
 
-    auto_cleanup_past_items(username)
-
-    user_data = users_collection.find_one({"username": username})
+    # The versions are read before the data, so a write racing this request
+    # can only make the response newer than its version, never older.
+    versions = get_data_versions(username, "get_schedule:version")
 
-    if not user_data:
+    if versions is None:
         return jsonify({"error": "User not found"}), 404
 
-    schedule_data = {
-        "schedule": user_data.get("schedule", []),
-        "tasks": user_data.get("tasks", []),
-        "tests": user_data.get("tests", []),
-        "generated_plan": user_data.get("generated_plan", []),
-        "preferences": user_data.get("preferences", {}),
-        "study_windows": user_data.get("study_windows", [])
-    }
-    return jsonify(schedule_data)
+    version = format_data_version(versions)
+    merge_plan = request.args.get("merge") == "1"
+    # The ETag names the user too: another account on the same browser can be at the same version.
+    # It also names the representation, since a merged plan is a different body.
+    etag = f"{hashlib.sha1(username.encode()).hexdigest()[:8]}-{version}" + ("-merged" if merge_plan else "")
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        # ?since=<version>: only the sections that changed after that version,
+        # and of the plan only the days that changed if the log covers it
+        since_versions = parse_data_version(request.args.get("since"))
+        plan_dates = None
+        if since_versions:
+            sections = [section for section in DATA_VERSION_SECTIONS if versions[section] != since_versions[section]]
+            if "generated_plan" in sections:
+                plan_dates = get_plan_change_dates(username, since_versions["generated_plan"],
+                                                   versions["generated_plan"], "get_schedule:plan_changes")
+        else:
+            sections = DATA_VERSION_SECTIONS
+        # ?merge=1: generated_plan with consecutive blocks of a task as one interval
+        schedule_data = load_schedule_sections(username, sections, "get_schedule", merge_plan, plan_dates)
+        schedule_data["version"] = version
+        schedule_data["delta"] = bool(since_versions)
+        response = jsonify(schedule_data)
+
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
 
 if __name__ == "__main__":
@@ -0,0 +1,330 @@
+"""
+Async serving mode.
+
+Serves /chat and /chat_stream natively on the event loop, using AsyncOpenAI
+and PyMongo's async client for the reads on the chat path, so one process can
+hold hundreds of chat requests that are waiting on OpenAI. Every other route
+is the normal Flask app, bridged through asgiref. The tools and the planner
+stay synchronous and run on a thread pool, so they never block the loop.
+It needs asgiref and an ASGI server on top of the Flask app's dependencies
+(both are in requirements.txt). From this directory:
+
+    pip install -r requirements.txt
+    uvicorn asgi:application --workers 2
+
+Sessions are Flask's signed cookies, read with the Flask app's own serializer,
+so logging in through the Flask routes works for the async chat routes too.
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError as e:
+    raise ImportError("asgi.py needs asgiref and an ASGI server such as uvicorn: "
+                      "pip install -r requirements.txt") from e
+from itsdangerous import BadSignature
+from openai import AsyncOpenAI
+from pymongo import AsyncMongoClient, ASCENDING, DESCENDING
+
+import app as smart_scheduler
+
+flask_app = smart_scheduler.app
+wsgi_application = WsgiToAsgi(flask_app)
+
+async_openai_client = AsyncOpenAI(api_key=smart_scheduler.OPENAI_API_KEY)
+async_db = AsyncMongoClient(smart_scheduler.MONGO_URI,
+                            event_listeners=[smart_scheduler.MongoCommandTracer()])[smart_scheduler.db.name]
+
+# Tools, the planner and the history writes are sync PyMongo code
+TOOL_EXECUTOR_WORKERS = int(os.getenv("TOOL_EXECUTOR_WORKERS", "16"))
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_EXECUTOR_WORKERS)
+
+NOT_LOGGED_IN = {"reply": "Error: Not logged in"}
+USER_NOT_FOUND = {"reply": "Error: Your user data was not found. Please log in again."}
+CHAT_ERROR = {"reply": "Sorry, I ran into an error. Please try that again."}
+
+
+def _async_collection(collection):
+    return async_db[collection.name]
+
+
+async def _run_sync(function, *args):
+    # In a copy of this context, so the sync code's spans land in the request's trace
+    return await asyncio.get_running_loop().run_in_executor(
+        tool_executor, functools.partial(contextvars.copy_context().run, function, *args))
+
+
+def _session_username(scope):
+    """The username in the Flask session cookie, or None."""
+    cookies = SimpleCookie()
+    for name, value in scope.get("headers", []):
+        if name == b"cookie":
+            cookies.load(value.decode("latin-1"))
+    morsel = cookies.get(flask_app.config["SESSION_COOKIE_NAME"])
+    if morsel is None:
+        return None
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        session = serializer.loads(morsel.value,
+                                   max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+    return session.get("username")
+
+
+# === START OF ASYNC DATA ACCESS ===
+# Async twins of the reads /chat makes. The item collections are read
+# concurrently, and the reads are still counted in read_stats.
+
+async def _find(collection, site, query, projection, sort=None, limit=0):
+    cursor = _async_collection(collection).find(query, projection)
+    if sort:
+        cursor = cursor.sort(sort)
+    if limit:
+        cursor = cursor.limit(limit)
+    documents = await cursor.to_list(None)
+    smart_scheduler._record_read(site, documents)
+    return documents
+
+
+async def load_chat_user_data(username, site="chat"):
+    """load_user_data(include_plan=False, extra_fields=("chat_summary",)) on the async driver."""
+    projection = dict(smart_scheduler.USER_SETTINGS_PROJECTION, chat_summary=1)
+    user_data = await _async_collection(smart_scheduler.users_collection).find_one({"username": username}, projection)
+    smart_scheduler._record_read(site, [user_data] if user_data else [])
+    if not user_data:
+        return None
+
+    fields = [field for field in smart_scheduler.USER_ITEM_COLLECTIONS if field != "generated_plan"]
+    items = await asyncio.gather(*[
+        _find(smart_scheduler.USER_ITEM_COLLECTIONS[field], f"{site}:{field}", {"username": username},
+              smart_scheduler.ITEM_PROJECTION, [("_id", ASCENDING)])
+        for field in fields
+    ])
+    user_data.update(zip(fields, items))
+    return user_data
+
+
+async def load_chat_history(username, limit):
+    newest_first = await _find(smart_scheduler.chat_messages_collection, "chat:history", {"username": username},
+                               smart_scheduler.ITEM_PROJECTION, [("_id", DESCENDING)], limit)
+    return newest_first[::-1]
+
+
+# === END OF ASYNC DATA ACCESS ===
+
+
+# === START OF ASGI PLUMBING ===
+
+async def _read_json(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return json.loads(body or b"{}")
+
+
+async def _send_json(send, payload, status=200):
+    body = json.dumps(payload).encode()
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"),
+                            (b"content-length", str(len(body)).encode()),
+                            (b"x-trace-id", smart_scheduler.current_trace_id().encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_event_stream(send, events):
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                            (b"cache-control", b"no-cache"),
+                            (b"x-accel-buffering", b"no"),
+                            (b"x-trace-id", smart_scheduler.current_trace_id().encode())]})
+    async for event in events:
+        await send({"type": "http.response.body", "body": event.encode(), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            smart_scheduler.start_app_process()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            tool_executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+# === END OF ASGI PLUMBING ===
+
+
+# === START OF ASYNC CHAT ROUTES ===
+
+async def _prepare_chat_turn(scope, receive):
+    """
+    Reads the session and request body and loads the user.
+    Returns (turn, None), or (None, (error payload, status)).
+    """
+    username = _session_username(scope)
+    if not username:
+        return None, (NOT_LOGGED_IN, 401)
+    data = await _read_json(receive)
+    user_data = await load_chat_user_data(username)
+    if not user_data:
+        return None, (USER_NOT_FOUND, 401)
+    return {
+        "username": username,
+        "user_message": data.get("message"),
+        "selected_year": data.get("year", str(json.loads(os.getenv("CURRENT_DATE", '{"year": 2025}'))["year"])),
+        "user_data": user_data
+    }, None
+
+
+async def _build_messages(username, user_data, user_message, selected_year):
+    chat_history = None
+    if user_message != "trigger:daily_checkin":
+        chat_history = await load_chat_history(username, smart_scheduler.CHAT_HISTORY_READ_LIMIT)
+    return smart_scheduler.build_chat_messages(username, user_data, user_message, selected_year, chat_history)
+
+
+async def _iter_chat_turn_events(*args):
+    """Steps the sync iter_chat_turn generator on the tool executor."""
+    events = smart_scheduler.iter_chat_turn(*args)
+    while True:
+        event = await _run_sync(next, events, None)
+        if event is None:
+            return
+        yield event
+
+
+async def chat(scope, receive, send):
+    turn, error = await _prepare_chat_turn(scope, receive)
+    if error:
+        return await _send_json(send, *error)
+    username, user_message = turn["username"], turn["user_message"]
+
+    try:
+        if smart_scheduler.is_priority_choice(user_message):
+            return await _send_json(send, await _run_sync(smart_scheduler.handle_priority_choice,
+                                                          username, user_message))
+
+        local_turn = smart_scheduler.fast_path_turn(user_message)
+        if local_turn:
+            messages, turn_start, assistant_message = local_turn
+        else:
+            messages, turn_start = await _build_messages(username, turn["user_data"], user_message,
+                                                         turn["selected_year"])
+            with smart_scheduler.trace_span("openai", "chat.completions.create"):
+                response = await async_openai_client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=messages,
+                    tools=smart_scheduler.tools,
+                    tool_choice="auto"
+                )
+            smart_scheduler.record_prompt_usage("chat", getattr(response, "usage", None))
+            response_message = response.choices[0].message
+            if response_message.tool_calls:
+                assistant_message = response_message.model_dump(exclude={'function_call'})
+            else:
+                assistant_message = {"role": response_message.role, "content": response_message.content}
+
+        async for event, data in _iter_chat_turn_events(username, user_message, messages, turn_start,
+                                                        assistant_message):
+            if event == "done":
+                return await _send_json(send, data)
+
+    except Exception as e:
+        print(f"[trace {smart_scheduler.current_trace_id()}] Error in async /chat route: {e}")
+        return await _send_json(send, CHAT_ERROR, 500)
+
+
+async def _iter_streamed_message(stream):
+    """Async version of app._collect_streamed_message."""
+    streamed = {"content_parts": [], "tool_calls": {}}
+    async for chunk in stream:
+        text = smart_scheduler._add_stream_chunk(streamed, chunk)
+        if text:
+            yield "token", text
+    smart_scheduler.record_prompt_usage("chat_stream", streamed.get("usage"))
+    yield "message", smart_scheduler._streamed_assistant_message(streamed)
+
+
+async def chat_stream(scope, receive, send):
+    turn, error = await _prepare_chat_turn(scope, receive)
+    if error:
+        return await _send_json(send, *error)
+    username, user_message = turn["username"], turn["user_message"]
+
+    async def events():
+        try:
+            if smart_scheduler.is_priority_choice(user_message):
+                payload = await _run_sync(smart_scheduler.handle_priority_choice, username, user_message)
+                yield smart_scheduler._sse_event("done", payload)
+                return
+
+            local_turn = smart_scheduler.fast_path_turn(user_message)
+            if local_turn:
+                messages, turn_start, assistant_message = local_turn
+            else:
+                messages, turn_start = await _build_messages(username, turn["user_data"], user_message,
+                                                             turn["selected_year"])
+                with smart_scheduler.trace_span("openai", "chat.completions.create"):
+                    stream = await async_openai_client.chat.completions.create(
+                        model="gpt-4o-mini",
+                        messages=messages,
+                        tools=smart_scheduler.tools,
+                        tool_choice="auto",
+                        stream=True,
+                        stream_options={"include_usage": True}
+                    )
+                assistant_message = None
+                async for kind, value in _iter_streamed_message(stream):
+                    if kind == "token":
+                        yield smart_scheduler._sse_event("token", {"text": value})
+                    else:
+                        assistant_message = value
+
+            async for event, data in _iter_chat_turn_events(username, user_message, messages, turn_start,
+                                                            assistant_message):
+                yield smart_scheduler._sse_event(event, data)
+
+        except Exception as e:
+            print(f"[trace {smart_scheduler.current_trace_id()}] Error in async /chat_stream route: {e}")
+            yield smart_scheduler._sse_event("error", CHAT_ERROR)
+
+    await _send_event_stream(send, events())
+
+
+ASYNC_ROUTES = {
+    ("POST", "/chat"): chat,
+    ("POST", "/chat_stream"): chat_stream
+}
+
+
+# === END OF ASYNC CHAT ROUTES ===
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    route = ASYNC_ROUTES.get((scope.get("method"), scope.get("path")))
+    if route is None:
+        return await wsgi_application(scope, receive, send)  # Traced by the Flask app's request hooks
+    trace_token = smart_scheduler.start_trace(f"async:{route.__name__}")
+    error = None
+    try:
+        return await route(scope, receive, send)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        smart_scheduler.finish_trace(trace_token, error)
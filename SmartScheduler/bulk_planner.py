@@ -0,0 +1,193 @@
+"""
+Offline bulk planner.
+
+Re-runs the V8 planner for every user (or a filtered subset) outside of Flask,
+so plans can be regenerated overnight when the date rolls over instead of on
+each user's first request of the day. Run it from cron just after midnight:
+
+    python bulk_planner.py                      # every user
+    python bulk_planner.py --users alice bob    # only these users
+    python bulk_planner.py --workers 8 --chunk-size 500 --force-auto
+
+Users are streamed from Mongo with a cursor, their items are loaded with one
+query per collection per chunk, the chunks are planned across a process pool,
+and each finished chunk is written back to plan_blocks with two unordered
+bulk_writes (every user's delete, then every user's inserts). Only plans that
+changed are written. The users' daily check-in digests are rewritten from the
+new plans too, so the morning check-ins are served from daily_digests.
+
+Each chunk holds its users' "planner:<username>" leases from before their data
+is read until their plans are written, like a /chat planner run does. Users
+whose lease is held (a run in the app is planning them right now) are skipped.
+Users whose plan could not be planned or written are listed at the end, and
+the exit status is 1 if there were any.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+import app as smart_scheduler
+
+# Settings the planner reads from the users document. Items (and the current
+# plan, which the new one is compared to) come from their own collections.
+PLANNER_PROJECTION = {"_id": 0, "username": 1, "preferences": 1, "study_windows": 1}
+
+
+def plan_chunk(users, planner_args, now_iso, verbose=False):
+    """
+    Worker: plans a chunk of user documents.
+    Returns a list of (username, status, plan_change).
+    """
+    now = datetime.fromisoformat(now_iso)
+    results = []
+    # The planner's per-run output is off unless PLANNER_VERBOSE is set (see planner_log); --verbose turns it on
+    if verbose:
+        smart_scheduler.PLANNER_VERBOSE = True
+    for user_data in users:
+        try:
+            result, _, plan_change = smart_scheduler._compute_plan(user_data, dict(planner_args), now)
+            results.append((user_data["username"], result["status"], plan_change))
+        except Exception as e:
+            results.append((user_data.get("username"), f"error: {e}", None))
+    return results
+
+
+def _iter_chunks(cursor, chunk_size):
+    chunk = []
+    for user_data in cursor:
+        chunk.append(user_data)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _bulk_write_by_user(collection, operations):
+    """
+    Sends (username, operation) pairs as one unordered bulk_write, so one
+    failed write does not stop the others. Returns the usernames whose writes failed.
+    """
+    if not operations:
+        return set()
+    try:
+        collection.bulk_write([operation for _, operation in operations], ordered=False)
+    except BulkWriteError as e:
+        return {operations[error["index"]][0] for error in e.details["writeErrors"]}
+    return set()
+
+
+def _write_results(results, stats, today):
+    deletes, inserts = [], []
+    plans = {}
+    for username, status, plan_change in results:
+        if status.startswith("error"):
+            stats["failed"].append(username)
+            print(f"Bulk planner: {username} failed ({status})")
+            continue
+        stats[status] = stats.get(status, 0) + 1
+        if plan_change:
+            plans[username] = plan_change
+            for operation in smart_scheduler.plan_write_operations(username, plan_change):
+                (inserts if isinstance(operation, InsertOne) else deletes).append((username, operation))
+    if not plans:
+        return
+
+    # Every delete runs before any insert, which keeps each user's writes in order
+    failed = _bulk_write_by_user(smart_scheduler.plan_blocks_collection, deletes)
+    failed |= _bulk_write_by_user(smart_scheduler.plan_blocks_collection,
+                                  [(username, operation) for username, operation in inserts if username not in failed])
+    # Even a user whose writes failed may have had some of them applied
+    smart_scheduler.users_collection.bulk_write([
+        UpdateOne({"username": username}, smart_scheduler.data_version_update(["generated_plan"]))
+        for username in plans
+    ], ordered=False)
+
+    digest_operations = []
+    for username, plan_change in plans.items():
+        if username in failed:
+            stats["failed"].append(username)
+            print(f"Bulk planner: {username} failed (could not write the new plan)")
+            continue
+        stats["written"] += 1
+        if "replace" in plan_change:
+            digest_operations.extend(smart_scheduler.daily_digest_operations(username, plan_change["replace"], today))
+    if digest_operations:
+        # Ordered: each user's delete has to run before that user's inserts.
+        smart_scheduler.daily_digests_collection.bulk_write(digest_operations, ordered=True)
+
+
+def _finish_chunk(future, usernames, stats, today):
+    try:
+        _write_results(future.result(), stats, today)
+    finally:
+        smart_scheduler.release_leases(f"planner:{username}" for username in usernames)
+
+
+def run_bulk_planner(query, workers, chunk_size, planner_args, verbose=False):
+    now = datetime.now()
+    now_iso = now.isoformat()
+    stats = {"users": 0, "written": 0, "busy": 0, "failed": []}
+    started = time.perf_counter()
+
+    cursor = smart_scheduler.users_collection.find(query, PLANNER_PROJECTION, batch_size=chunk_size)
+    # "spawn" so workers do not inherit the parent's MongoClient sockets.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        in_flight = {}  # future -> usernames whose leases the chunk holds
+        for chunk in _iter_chunks(cursor, chunk_size):
+            stats["users"] += len(chunk)
+            # A chunk is planned and written well within the lease, even behind the other in-flight chunks
+            leased = smart_scheduler.acquire_leases((f"planner:{user['username']}" for user in chunk),
+                                                    smart_scheduler.PLANNER_LEASE_SECONDS)
+            free_chunk = [user for user in chunk if f"planner:{user['username']}" in leased]
+            stats["busy"] += len(chunk) - len(free_chunk)
+            if not free_chunk:
+                continue
+            smart_scheduler.attach_user_items(free_chunk)
+            future = pool.submit(plan_chunk, free_chunk, planner_args, now_iso, verbose)
+            in_flight[future] = [user["username"] for user in free_chunk]
+            # Bound the number of pending chunks so memory stays flat on large collections.
+            if len(in_flight) >= workers * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _finish_chunk(future, in_flight.pop(future), stats, now.date())
+        for future in list(in_flight):
+            _finish_chunk(future, in_flight.pop(future), stats, now.date())
+
+    stats["seconds"] = round(time.perf_counter() - started, 2)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Regenerate study plans for many users at once.")
+    parser.add_argument("--users", nargs="+", help="Only plan these usernames.")
+    parser.add_argument("--query", help='Extra Mongo filter on users as JSON, e.g. \'{"username": {"$regex": "^a"}}\'.')
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Planner processes.")
+    parser.add_argument("--chunk-size", type=int, default=200, help="Users per chunk / bulk_write.")
+    parser.add_argument("--force-auto", action="store_true",
+                        help="Auto-resolve priority ties instead of leaving those plans untouched.")
+    parser.add_argument("--verbose", action="store_true", help="Show the planner's per-user output.")
+    cli_args = parser.parse_args()
+
+    query = json.loads(cli_args.query) if cli_args.query else {}
+    if cli_args.users:
+        query["username"] = {"$in": cli_args.users}
+    planner_args = {"force_auto": True} if cli_args.force_auto else {}
+
+    stats = run_bulk_planner(query, max(1, cli_args.workers), max(1, cli_args.chunk_size), planner_args,
+                             cli_args.verbose)
+    print(f"Bulk planner: {json.dumps(stats)}")
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""
+One-off migration to the normalized storage layout.
+
+Moves the embedded schedule, tasks, tests, generated_plan and chat_history
+arrays out of each users document into the classes, tasks, tests, plan_blocks
+and chat_messages collections, then $unsets them from the users document:
+
+    python migrate_storage.py --dry-run     # only report what would move
+    python migrate_storage.py               # migrate every user
+    python migrate_storage.py --keep-legacy # copy, but leave the old arrays in place
+
+Users without legacy arrays are skipped, so the script is safe to re-run. A user
+whose legacy arrays are still present (e.g. after --keep-legacy) has their
+normalized documents replaced by a fresh copy of those arrays.
+"""
+import argparse
+
+import app as smart_scheduler
+
+LEGACY_COLLECTIONS = dict(smart_scheduler.USER_ITEM_COLLECTIONS, chat_history=smart_scheduler.chat_messages_collection)
+
+
+def _is_conversation_message(message):
+    # The chat route stored its system prompt and context dump with every turn;
+    # it filtered them back out on read, so there is no point copying them.
+    role = message.get("role")
+    if role in ["assistant", "tool"]:
+        return True
+    return role == "user" and not str(message.get("content", "")).startswith("Here is my current data.")
+
+
+def migrate_user(user, dry_run=False, keep_legacy=False):
+    """Copies one user's legacy arrays into their collections. Returns {field: documents moved}."""
+    username = user["username"]
+    moved = {}
+    for field, collection in LEGACY_COLLECTIONS.items():
+        items = [item for item in user.get(field) or [] if isinstance(item, dict)]
+        if field == "chat_history":
+            items = [message for message in items if _is_conversation_message(message)]
+        moved[field] = len(items)
+        if dry_run:
+            continue
+        collection.delete_many({"username": username})
+        if items:
+            collection.insert_many([dict(item, username=username) for item in items], ordered=True)
+
+    if not dry_run and not keep_legacy:
+        smart_scheduler.users_collection.update_one(
+            {"_id": user["_id"]},
+            {"$unset": {field: "" for field in LEGACY_COLLECTIONS}}
+        )
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move embedded user arrays into their own collections.")
+    parser.add_argument("--dry-run", action="store_true", help="Report counts without writing anything.")
+    parser.add_argument("--keep-legacy", action="store_true", help="Do not $unset the old arrays afterwards.")
+    parser.add_argument("--batch-size", type=int, default=100, help="Users fetched per cursor batch.")
+    cli_args = parser.parse_args()
+
+    if not cli_args.dry_run:
+        smart_scheduler.ensure_indexes()
+
+    legacy_filter = {"$or": [{field: {"$exists": True}} for field in LEGACY_COLLECTIONS]}
+    projection = {"username": 1, **{field: 1 for field in LEGACY_COLLECTIONS}}
+    totals = {field: 0 for field in LEGACY_COLLECTIONS}
+    users_migrated = 0
+
+    for user in smart_scheduler.users_collection.find(legacy_filter, projection, batch_size=cli_args.batch_size):
+        moved = migrate_user(user, cli_args.dry_run, cli_args.keep_legacy)
+        for field, count in moved.items():
+            totals[field] += count
+        users_migrated += 1
+
+    action = "Would migrate" if cli_args.dry_run else "Migrated"
+    print(f"{action} {users_migrated} users: " + ", ".join(f"{count} {field}" for field, count in totals.items()))
+
+
+if __name__ == "__main__":
+    main()
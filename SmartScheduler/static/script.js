@@ -2,6 +2,9 @@
 let currentWeekStart = new Date();
 let selectedDate = new Date();
 let scheduleData = { schedule: [], tasks: [], tests: [], generated_plan: [] };
+// Version and ETag of scheduleData, for conditional / delta /get_schedule requests
+let scheduleVersion = null;
+let scheduleEtag = null;
 
 // === MONTH AND YEAR SELECTORS ===
 const monthNames = [
@@ -374,25 +377,51 @@ function handleDayClick(element, dateString) {
     displayDayDetails();
 }
 
-// === loadScheduleData (Unchanged) ===
+// === loadScheduleData ===
 async function loadScheduleData() {
     try {
-        const res = await fetch('/get_schedule');
+        // With a cached copy, ask only for what changed since its version:
+        // 304 if nothing did, otherwise just the changed sections.
+        // merge=1: consecutive plan blocks of a task come as one interval.
+        const url = scheduleVersion
+            ? `/get_schedule?merge=1&since=${encodeURIComponent(scheduleVersion)}`
+            : '/get_schedule?merge=1';
+        const res = await fetch(url, {
+            cache: 'no-store',
+            headers: scheduleEtag ? { 'If-None-Match': scheduleEtag } : {}
+        });
+        if (res.status === 304) {
+            return; // scheduleData is current
+        }
         if (!res.ok) {
              throw new Error(`HTTP error! status: ${res.status}`);
         }
         const data = await res.json();
+        const base = data.delta ? scheduleData : {};
+        let generatedPlan = data.generated_plan || base.generated_plan || [];
+        if (data.generated_plan_changes) {
+            // Only the days that changed: their blocks replace the cached ones
+            const changes = data.generated_plan_changes;
+            generatedPlan = generatedPlan
+                .filter(block => !changes.dates.includes(block.date))
+                .concat(changes.blocks)
+                .sort((a, b) => (a.date + a.start_time).localeCompare(b.date + b.start_time));
+        }
         scheduleData = {
-            schedule: data.schedule || [],
-            tasks: data.tasks || [],
-            tests: data.tests || [],
-            generated_plan: data.generated_plan || [],
-            preferences: data.preferences || { awake_time: '07:00', sleep_time: '23:00'},
-            study_windows: data.study_windows || []
+            schedule: data.schedule || base.schedule || [],
+            tasks: data.tasks || base.tasks || [],
+            tests: data.tests || base.tests || [],
+            generated_plan: generatedPlan,
+            preferences: data.preferences || base.preferences || { awake_time: '07:00', sleep_time: '23:00'},
+            study_windows: data.study_windows || base.study_windows || []
         };
+        scheduleVersion = data.version || null;
+        scheduleEtag = res.headers.get('ETag');
     } catch (e) {
         console.error("Fetch error:", e);
         scheduleData = { schedule: [], tasks: [], tests: [], generated_plan: [], preferences: {}, study_windows: [] }; // Reset on error
+        scheduleVersion = null;
+        scheduleEtag = null;
         const detailsBox = document.getElementById('schedule-details');
         if (detailsBox) {
             detailsBox.innerHTML = `<h4 style="margin-top:0;">Error Loading Schedule</h4><p>Could not fetch schedule data. Please try again later.</p>`;
@@ -515,8 +544,13 @@ async function sendMessage(messageOverride = null) {
   if (!messageOverride) {
     chatBox.innerHTML += `<div class="message user-message">${userMessage}</div>`;
   } else {
-    // Optionally, show what the user picked
-    chatBox.innerHTML += `<div class="message user-message"><em>(Selected priority: ${userMessage.split(": ")[1]})</em></div>`;
+    // Optionally, show what the user picked (one name or "Auto", or a JSON list of picks per tie group)
+    const choice = userMessage.split(": ").slice(1).join(": ");
+    let picked = choice;
+    if (userMessage.startsWith('User priority choices: ')) {
+        try { picked = JSON.parse(choice).join(', '); } catch (error) { /* Show it as sent */ }
+    }
+    chatBox.innerHTML += `<div class="message user-message"><em>(Selected priority: ${picked})</em></div>`;
   }
 
   input.value = ""; // Clear input box
@@ -525,24 +559,29 @@ async function sendMessage(messageOverride = null) {
   const selectedYear = yearSelect ? yearSelect.value : new Date().getFullYear().toString();
 
   try {
-      const res = await fetch("/chat", {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          message: userMessage,
-          year: selectedYear
-        })
-      });
+      // Stream the reply when the browser supports it, otherwise fall back to /chat
+      if (window.ReadableStream && window.TextDecoder) {
+          await streamChatMessage(userMessage, selectedYear);
+      } else {
+          const res = await fetch("/chat", {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({
+              message: userMessage,
+              year: selectedYear
+            })
+          });
 
-      if (!res.ok) {
-          throw new Error(`HTTP error! status: ${res.status}`);
-      }
+          if (!res.ok) {
+              throw new Error(`HTTP error! status: ${res.status}`);
+          }
 
-      const data = await res.json();
+          const data = await res.json();
 
-      // === START OF V6 CHANGE: Handle complex response ===
-      handleChatResponse(data);
-      // === END OF V6 CHANGE ===
+          // === START OF V6 CHANGE: Handle complex response ===
+          handleChatResponse(data);
+          // === END OF V6 CHANGE ===
+      }
 
       // Refresh schedule data *after* handling the response
       await loadScheduleData();
@@ -554,26 +593,157 @@ async function sendMessage(messageOverride = null) {
   }
 }
 
+// === NEW FUNCTION: streamChatMessage (SSE) ===
+// Posts to /chat_stream and reads the Server-Sent Events as they arrive:
+// "token" text is typed into a bot bubble, "tool"/"planner" show progress,
+// and "done"/"error" carry the same payload /chat returns.
+const TOOL_PROGRESS_LABELS = {
+    save_task: "Saving your task",
+    save_test: "Saving your test",
+    save_class: "Saving your class",
+    save_preference: "Saving your preference",
+    save_study_windows: "Saving your study windows",
+    update_task_details: "Updating your task",
+    update_class_schedule: "Updating your class",
+    delete_schedule_item: "Deleting the item",
+    get_daily_plan: "Looking up your plan",
+    get_priority_list: "Building your priority list",
+    reschedule_day: "Rescheduling your day",
+    run_planner_engine: "Updating your study plan"
+};
+
+async function streamChatMessage(userMessage, selectedYear) {
+    const chatBox = document.getElementById("chat-box");
+    const res = await fetch("/chat_stream", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({
+            message: userMessage,
+            year: selectedYear
+        })
+    });
+
+    if (!res.ok || !res.body) {
+        throw new Error(`HTTP error! status: ${res.status}`);
+    }
+
+    // One bubble for this reply; tokens and progress are written into it
+    const botMessage = document.createElement("div");
+    botMessage.className = "message bot-message";
+    botMessage.innerHTML = "<em>Thinking...</em>";
+    chatBox.appendChild(botMessage);
+
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let streamedText = "";
+    let finalData = null;
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Events are separated by a blank line
+        let boundary;
+        while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let eventName = "message";
+            let eventData = "";
+            rawEvent.split("\n").forEach(line => {
+                if (line.startsWith("event:")) eventName = line.slice(6).trim();
+                else if (line.startsWith("data:")) eventData += line.slice(5).trim();
+            });
+            const data = eventData ? JSON.parse(eventData) : {};
+
+            if (eventName === "token") {
+                streamedText += data.text;
+                botMessage.textContent = streamedText;
+            } else if (eventName === "tool" && data.status === "running") {
+                botMessage.innerHTML = `<em>${TOOL_PROGRESS_LABELS[data.name] || "Working on it"}...</em>`;
+            } else if (eventName === "planner") {
+                botMessage.innerHTML = "<em>Updating your study plan...</em>";
+            } else if (eventName === "done" || eventName === "error") {
+                finalData = data;
+            }
+            chatBox.scrollTop = chatBox.scrollHeight;
+        }
+    }
+
+    handleChatResponse(finalData, botMessage);
+}
+
 // === NEW FUNCTION: handleChatResponse (V6) ===
-function handleChatResponse(data) {
+// messageElement: an existing bubble to fill in (used by the streaming path)
+function handleChatResponse(data, messageElement = null) {
     const chatBox = document.getElementById("chat-box");
     if (!data || !data.reply) {
+        if (messageElement) messageElement.remove();
         chatBox.innerHTML += `<div class="message bot-message" style="color: red;">Error: Received an invalid response.</div>`;
         return;
     }
 
     // 1. Add the bot's text reply to the chat
-    chatBox.innerHTML += `<div class="message bot-message">${data.reply}</div>`;
+    if (messageElement) {
+        messageElement.innerHTML = data.reply;
+    } else {
+        chatBox.innerHTML += `<div class="message bot-message">${data.reply}</div>`;
+    }
     setTimeout(() => { chatBox.scrollTop = chatBox.scrollHeight; }, 0);
 
     // 2. Check if the server sent a special "action"
     if (data.action === 'show_priority_modal' && data.options) {
-        openPriorityModal(data.options);
+        openPriorityModal(data.options, data.tie_groups, data.infeasible);
+    }
+
+    // 3. The planner may still be running in the background
+    if (data.plan_job) {
+        watchPlannerJob(data.plan_job.job_id);
+    }
+}
+
+// === NEW FUNCTION: watchPlannerJob ===
+// Polls /plan_status until a background planner job finishes, then refreshes
+// the calendar, or asks the user to break a tie if the planner found one.
+async function watchPlannerJob(jobId, delay = 500) {
+    try {
+        const res = await fetch(`/plan_status?job_id=${encodeURIComponent(jobId)}`);
+        if (res.status === 404) {
+            // The job is gone (expired or lost); show whatever plan is saved now
+            await loadScheduleData();
+            displayDayDetails();
+            return;
+        }
+        if (!res.ok) {
+            throw new Error(`HTTP error! status: ${res.status}`);
+        }
+        const job = await res.json();
+
+        if (job.status === 'queued' || job.status === 'running') {
+            setTimeout(() => watchPlannerJob(jobId, Math.min(delay * 2, 4000)), delay);
+            return;
+        }
+
+        await loadScheduleData();
+        displayDayDetails();
+
+        if (job.status === 'done' && job.result && job.result.status === 'conflict') {
+            const chatBox = document.getElementById("chat-box");
+            chatBox.innerHTML += `<div class="message bot-message">I found a scheduling conflict. Please choose which task to prioritize first:</div>`;
+            setTimeout(() => { chatBox.scrollTop = chatBox.scrollHeight; }, 0);
+            openPriorityModal(job.result.options, job.result.tie_groups, job.result.infeasible);
+        }
+    } catch (error) {
+        console.error("Error checking planner job:", error);
     }
 }
 
 // === NEW FUNCTION: openPriorityModal (V6) ===
-function openPriorityModal(options) {
+// tieGroups holds every tie the planner found; with more than one group the
+// user picks per group and all picks go back in a single message.
+function openPriorityModal(options, tieGroups = null, infeasible = null) {
     const modal = document.getElementById('priorityConflictModal');
     // We get the *real* modal elements from index.html
     const content = document.getElementById('priority-modal-body-content');
@@ -584,12 +754,44 @@ function openPriorityModal(options) {
         return;
     }
 
+    const groups = tieGroups && tieGroups.length ? tieGroups : [options];
+
     // Clear old buttons and set header text
     buttons.innerHTML = '';
-    content.innerHTML = '<p>The AI planner found two tasks with the same deadline and priority. Which one should it work on first?</p>';
+    if (groups.length > 1) {
+        content.innerHTML = '<p>The AI planner found several groups of tasks with the same deadline and priority. Which one should it work on first in each group?</p>';
+        groups.forEach(group => {
+            const select = document.createElement('select');
+            select.className = 'modal-input priority-group-select';
+            select.add(new Option('Decide for me', ''));
+            group.forEach(optionName => select.add(new Option(optionName, optionName)));
+            content.appendChild(select);
+        });
+        const applyButton = document.createElement('button');
+        applyButton.className = 'modal-button-primary';
+        applyButton.textContent = 'Apply Choices';
+        applyButton.addEventListener('click', () => {
+            const picks = Array.from(content.querySelectorAll('.priority-group-select'))
+                .map(select => select.value)
+                .filter(value => value);
+            sendMessage(picks.length ? `User priority choices: ${JSON.stringify(picks)}` : 'User priority choice: Auto');
+            modal.classList.add('hidden');
+        });
+        buttons.appendChild(applyButton);
+    } else {
+        content.innerHTML = '<p>The AI planner found tasks with the same deadline and priority. Which one should it work on first?</p>';
+    }
+
+    if (infeasible && infeasible.length) {
+        const warning = document.createElement('p');
+        // From the deadline-order check: no order of the items meets every deadline
+        warning.textContent = 'Heads up: even in deadline order, there isn\'t enough free time for ' +
+            infeasible.map(item => `${item.name} (${item.blocks_short}h short)`).join(', ') + '.';
+        content.appendChild(warning);
+    }
 
     // Create a button for each option
-    options.forEach(optionName => {
+    (groups.length > 1 ? [] : groups[0]).forEach(optionName => {
         const button = document.createElement('button');
         button.className = 'modal-button-primary';
         button.textContent = `Prioritize: ${optionName}`;
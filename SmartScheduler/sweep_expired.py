@@ -0,0 +1,19 @@
+"""
+Expired item sweep.
+
+Deletes every user's past tasks, tests and plan blocks once, the same sweep
+the app's background sweeper runs every EXPIRY_SWEEP_INTERVAL_SECONDS. For
+deployments that turn the in-app sweeper off (EXPIRY_SWEEPER=0) and run it
+from cron instead:
+
+    python sweep_expired.py
+"""
+import app as smart_scheduler
+
+
+def main():
+    smart_scheduler.sweep_expired_items()  # Prints what it deleted
+
+
+if __name__ == "__main__":
+    main()
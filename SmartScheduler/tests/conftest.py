@@ -0,0 +1,104 @@
+"""
+Test setup: the app runs against mongomock instead of a MongoDB server.
+
+mongomock's bulk_write does not accept the write models of current PyMongo,
+so each collection gets a small bulk_write that applies the models one by one,
+returns the counts flush_writes and the planner read, and raises
+BulkWriteError for duplicate keys like the server does.
+"""
+import os
+import sys
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ["EXPIRY_SWEEPER"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mongomock
+import pytest
+from pymongo import DeleteMany, DeleteOne, InsertOne, UpdateMany, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import app as smart_scheduler
+
+
+class BulkWriteResult:
+    def __init__(self, inserted_count=0, modified_count=0, deleted_count=0):
+        self.inserted_count = inserted_count
+        self.modified_count = modified_count
+        self.deleted_count = deleted_count
+
+
+def _apply(collection, operation, counts):
+    if isinstance(operation, InsertOne):
+        collection.insert_one(operation._doc)
+        counts["inserted_count"] += 1
+    elif isinstance(operation, UpdateMany):
+        counts["modified_count"] += collection.update_many(operation._filter, operation._doc).modified_count
+    elif isinstance(operation, UpdateOne):
+        counts["modified_count"] += collection.update_one(operation._filter, operation._doc,
+                                                          upsert=bool(operation._upsert)).modified_count
+    elif isinstance(operation, DeleteMany):
+        counts["deleted_count"] += collection.delete_many(operation._filter).deleted_count
+    elif isinstance(operation, DeleteOne):
+        counts["deleted_count"] += collection.delete_one(operation._filter).deleted_count
+    else:
+        raise NotImplementedError(operation)
+
+
+def _bulk_write(collection):
+    def bulk_write(operations, ordered=True):
+        counts = {"inserted_count": 0, "modified_count": 0, "deleted_count": 0}
+        write_errors = []
+        for index, operation in enumerate(operations):
+            try:
+                _apply(collection, operation, counts)
+            except DuplicateKeyError as e:
+                write_errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if write_errors:
+            raise BulkWriteError({"writeErrors": write_errors, "nInserted": counts["inserted_count"]})
+        return BulkWriteResult(**counts)
+    return bulk_write
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """Points every collection the app uses at a fresh mongomock database."""
+    mongo_client = mongomock.MongoClient()
+    mongo_client.drop_database("db")  # mongomock clients share one in-memory server
+    database = mongo_client.db
+    for name, value in list(vars(smart_scheduler).items()):
+        if isinstance(value, Collection):
+            collection = database[value.name]
+            collection.bulk_write = _bulk_write(collection)
+            monkeypatch.setattr(smart_scheduler, name, collection)
+    for field, collection in list(smart_scheduler.USER_ITEM_COLLECTIONS.items()):
+        monkeypatch.setitem(smart_scheduler.USER_ITEM_COLLECTIONS, field, database[collection.name])
+    monkeypatch.setattr(smart_scheduler, "_client_bulk_write_supported", False)
+    monkeypatch.setattr(smart_scheduler, "_app_process_started", True)
+    smart_scheduler._planner_cache.clear()
+    return database
+
+
+@pytest.fixture
+def user(mongo):
+    """A user with the default settings and no classes, tasks or tests."""
+    smart_scheduler.users_collection.insert_one({
+        "username": "alice", "password": "x",
+        "preferences": {"awake_time": "07:00", "sleep_time": "23:00"}, "study_windows": []
+    })
+    return "alice"
+
+
+@pytest.fixture
+def client(user):
+    """A Flask test client logged in as the user fixture."""
+    smart_scheduler.app.config["TESTING"] = True
+    test_client = smart_scheduler.app.test_client()
+    with test_client.session_transaction() as session:
+        session["username"] = user
+    return test_client
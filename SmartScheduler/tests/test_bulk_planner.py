@@ -0,0 +1,32 @@
+from datetime import date
+
+import app as smart_scheduler
+import bulk_planner
+
+
+def block(hour, task):
+    return {"date": "2099-01-05", "start_time": f"{hour:02d}:00", "end_time": f"{hour + 1:02d}:00", "task": task}
+
+
+def test_one_users_failed_write_does_not_stop_the_others(mongo):
+    for username in ("alice", "bob"):
+        smart_scheduler.users_collection.insert_one({"username": username})
+    smart_scheduler.plan_blocks_collection.create_index([("username", 1), ("date", 1), ("start_time", 1)],
+                                                        unique=True)
+    smart_scheduler.plan_blocks_collection.insert_one(dict(block(9, "Work on Lab"), username="bob"))
+
+    stats = {"users": 2, "written": 0, "busy": 0, "failed": []}
+    bulk_planner._write_results([
+        ("bob", "success", {"drop": [], "add": [block(9, "Work on Essay")]}),  # Slot already taken
+        ("alice", "success", {"replace": [block(9, "Work on Essay")], "dates": ["2099-01-05"]}),
+        ("carol", "error: boom", None)
+    ], stats, date(2099, 1, 5))
+
+    assert stats["failed"] == ["carol", "bob"]
+    assert stats["written"] == 1
+    assert smart_scheduler.plan_blocks_collection.count_documents({"username": "alice"}) == 1
+    assert smart_scheduler.daily_digests_collection.count_documents({"username": "alice"}) == 1
+    assert smart_scheduler.daily_digests_collection.count_documents({"username": "bob"}) == 0
+    # Both users' plans were written to, so both get a new version
+    assert smart_scheduler.get_data_versions("bob", "test")["generated_plan"] == 1
+    assert smart_scheduler.get_data_versions("alice", "test")["generated_plan"] == 1
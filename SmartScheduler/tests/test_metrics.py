@@ -0,0 +1,14 @@
+import app as smart_scheduler
+
+
+def test_unknown_paths_share_one_route_label(client):
+    for path in ("/no-such-page", "/wp-admin/setup.php?x=1"):
+        assert client.get(path).status_code == 404
+    routes = smart_scheduler.get_trace_stats()["requests"]
+    assert "unmatched" in routes
+    assert not any(route.startswith("/") for route in routes)
+
+
+def test_label_values_are_escaped():
+    assert smart_scheduler._prometheus_labels({"route": 'a\\b"c\nd', "kind": "mongo"}) == \
+        '{route="a\\\\b\\"c\\nd",kind="mongo"}'
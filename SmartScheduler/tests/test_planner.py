@@ -0,0 +1,166 @@
+import random
+from datetime import datetime, time, timedelta
+
+import app as smart_scheduler
+
+NOW = datetime(2025, 3, 3, 9, 30)  # A Monday
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+def reference_plan(user_data, now):
+    """The original hour-by-hour V8 planner (before the bitmap availability map and slot index), force_auto."""
+    work_items = []
+    for item in user_data["tasks"] + user_data["tests"]:
+        deadline_str = item.get("deadline", item.get("date"))
+        if "T" not in deadline_str:
+            deadline_str += "T23:59:59"
+        deadline = datetime.fromisoformat(deadline_str)
+        if deadline < now:
+            continue
+        priority_str = item.get("priority", item.get("task_type", item.get("test_type", "low")))
+        item_type = item.get("task_type", item.get("test_type"))
+        work_items.append({
+            "name": item["name"], "deadline": deadline,
+            "priority": smart_scheduler.DEFAULT_PRIORITY_MAP.get(priority_str, 99),
+            "blocks_needed": item.get("duration_hours", smart_scheduler.DEFAULT_DURATION_MAP.get(item_type, 1)),
+            "blocks_allocated": 0
+        })
+    work_items.sort(key=lambda x: (x["priority"], x["deadline"]))
+
+    prefs = user_data["preferences"]
+    sleep_min = smart_scheduler._time_to_minutes(prefs["sleep_time"])
+    awake_min = smart_scheduler._time_to_minutes(prefs["awake_time"])
+    available_slots, non_preferred_slots = [], []
+    for i in range(14):
+        day = now.date() + timedelta(days=i)
+        day_name = DAYS[day.weekday()]
+        for hour in range(24):
+            hour_min = hour * 60
+            if sleep_min > awake_min:
+                asleep = hour_min >= sleep_min or hour_min < awake_min
+            else:
+                asleep = sleep_min <= hour_min < awake_min
+            busy = any(
+                cls["day"] == day_name and
+                max(smart_scheduler._time_to_minutes(cls["start_time"]), hour_min) <
+                min(smart_scheduler._time_to_minutes(cls["end_time"]), hour_min + 59)
+                for cls in user_data["schedule"])
+            if asleep or busy:
+                continue
+            slot = {"date": day.strftime("%Y-%m-%d"), "start_time": time(hour).strftime("%H:%M"),
+                    "end_time": (datetime.combine(day, time(hour)) + timedelta(hours=1)).strftime("%H:%M")}
+            preferred = any(
+                window["day"] == day_name and
+                smart_scheduler._time_to_minutes(window["start_time"]) <= hour_min <
+                smart_scheduler._time_to_minutes(window["end_time"])
+                for window in user_data["study_windows"])
+            (available_slots if preferred else non_preferred_slots).append(slot)
+    available_slots.extend(non_preferred_slots)
+
+    plan = []
+    while available_slots:
+        made_progress = False
+        for item in work_items:
+            if item["blocks_allocated"] >= item["blocks_needed"]:
+                continue
+            for index, slot in enumerate(available_slots):
+                if datetime.fromisoformat(f"{slot['date']}T{slot['start_time']}") < item["deadline"]:
+                    plan.append(dict(available_slots.pop(index), task=f"Work on {item['name']}"))
+                    item["blocks_allocated"] += 1
+                    made_progress = True
+                    break
+        if not made_progress:
+            break
+    return plan
+
+
+def random_user(seed):
+    rng = random.Random(seed)
+    tasks = [{"name": f"T{i}", "task_type": rng.choice(["assignment", "project", "seatwork"]),
+              "deadline": (NOW + timedelta(days=rng.randint(0, 13), hours=rng.randint(0, 23))).isoformat()}
+             for i in range(8)]
+    for task in tasks:
+        if rng.random() < .3:
+            task["priority"] = rng.choice(["low", "medium", "high"])
+        if rng.random() < .3:
+            task["duration_hours"] = rng.randint(1, 6)
+    tests = [{"name": f"X{i}", "test_type": rng.choice(["quiz", "exam"]),
+              "date": (NOW + timedelta(days=rng.randint(1, 13))).strftime("%Y-%m-%d")} for i in range(3)]
+    return {
+        "username": f"u{seed}", "tasks": tasks, "tests": tests, "generated_plan": [],
+        "preferences": {"awake_time": "07:00", "sleep_time": rng.choice(["23:00", "01:00"])},
+        "schedule": [{"subject": f"C{i}", "day": rng.choice(DAYS),
+                      "start_time": f"{rng.randint(8, 15):02d}:{rng.choice(['00', '30'])}",
+                      "end_time": f"{rng.randint(16, 18):02d}:00"} for i in range(4)],
+        "study_windows": [{"day": rng.choice(DAYS), "start_time": f"{rng.randint(6, 12):02d}:00",
+                           "end_time": f"{rng.randint(13, 22):02d}:00"} for i in range(3)]
+    }
+
+
+def test_full_plan_matches_reference_planner():
+    for seed in range(25):
+        user_data = random_user(seed)
+        result, plan, plan_change = smart_scheduler._compute_plan(user_data, {"force_auto": True}, NOW)
+        assert result["status"] == "success"
+        assert plan == reference_plan(user_data, NOW), f"seed {seed}"
+        assert plan_change["replace"] == plan
+
+        # Planning the same inputs again changes nothing, so nothing is written
+        _, replan, replan_change = smart_scheduler._compute_plan(dict(user_data, generated_plan=plan),
+                                                                 {"force_auto": True}, NOW)
+        assert replan == plan and replan_change is None
+
+
+def test_ties_are_reported_as_one_conflict():
+    deadline = (NOW + timedelta(days=2)).isoformat()
+    user_data = dict(random_user(0), tests=[], tasks=[
+        {"name": "A", "task_type": "assignment", "deadline": deadline},
+        {"name": "B", "task_type": "assignment", "deadline": deadline},
+        {"name": "C", "task_type": "project", "deadline": deadline},
+        {"name": "D", "task_type": "project", "deadline": deadline}
+    ])
+    result, plan, plan_change = smart_scheduler._compute_plan(user_data, {}, NOW)
+    assert result["status"] == "conflict"
+    assert result["tie_groups"] == [["C", "D"], ["A", "B"]]
+    assert plan_change is None
+
+
+def test_merged_blocks_split_back_into_the_same_plan():
+    for seed in range(10):
+        user_data = random_user(seed)
+        _, plan, _ = smart_scheduler._compute_plan(user_data, {"force_auto": True}, NOW)
+        merged = smart_scheduler.merge_plan_blocks(plan)
+        split = [block for merged_block in merged for block in smart_scheduler._split_plan_block(merged_block)]
+        key = lambda block: (block["date"], block["start_time"])
+        assert sorted(split, key=key) == sorted(plan, key=key)
+
+
+def test_incremental_run_matches_full_run_for_an_urgent_new_item():
+    project = {"name": "Project", "task_type": "project", "duration_hours": 8,
+               "deadline": (NOW + timedelta(days=3)).isoformat()}
+    user_data = dict(random_user(0), tasks=[project], tests=[], schedule=[], study_windows=[],
+                     preferences={"awake_time": "07:00", "sleep_time": "23:00"})
+    _, existing_plan, _ = smart_scheduler._compute_plan(user_data, {}, NOW)
+    # The project holds every slot before noon
+    assert [block["start_time"] for block in existing_plan[:5]] == ["07:00", "08:00", "09:00", "10:00", "11:00"]
+
+    essay = {"name": "Essay", "task_type": "assignment", "priority": "high", "duration_hours": 2,
+             "deadline": NOW.replace(hour=12, minute=0).isoformat()}
+    user_data = dict(user_data, tasks=[project, essay], generated_plan=existing_plan)
+    full_result, full_plan, _ = smart_scheduler._compute_plan(user_data, {}, NOW)
+    result, plan, _ = smart_scheduler._compute_plan(user_data, {"changed_items": ["Essay"]}, NOW)
+    assert result["short_items"] == full_result["short_items"] == []
+    key = lambda block: (block["date"], block["start_time"])
+    assert sorted(plan, key=key) == sorted(full_plan, key=key)
+
+
+def test_digests_are_only_rewritten_when_the_plan_changes(user, monkeypatch):
+    saved_digests = []
+    monkeypatch.setattr(smart_scheduler, "save_daily_digests", lambda *args: saved_digests.append(args))
+    smart_scheduler.tasks_collection.insert_one({"username": user, "name": "Essay", "task_type": "assignment",
+                                                 "deadline": (datetime.now() + timedelta(days=2)).isoformat()})
+    smart_scheduler.run_planner_engine_db(user, {})
+    assert len(saved_digests) == 1
+    # Different args, so not a planner cache hit, but the same plan comes out
+    smart_scheduler.run_planner_engine_db(user, {"force_auto": True})
+    assert len(saved_digests) == 1
@@ -0,0 +1,45 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as smart_scheduler
+
+
+def test_user_planner_locks_are_dropped_after_use():
+    with smart_scheduler._user_planner_lock("alice"):
+        assert "alice" in smart_scheduler._user_planner_locks
+    assert "alice" not in smart_scheduler._user_planner_locks
+
+
+def test_planner_lease_wait_gives_up(mongo, monkeypatch):
+    monkeypatch.setattr(smart_scheduler, "PLANNER_LEASE_WAIT_SECONDS", 0.2)
+    smart_scheduler.leases_collection.insert_one({"_id": "planner:alice", "holder": "another-process",
+                                                  "expires_at": datetime.now() + timedelta(minutes=1)})
+    with pytest.raises(TimeoutError):
+        with smart_scheduler._user_planner_lease("alice"):
+            pass
+
+
+def test_submitted_job_runs_and_is_stored(user, monkeypatch):
+    monkeypatch.setattr(smart_scheduler, "PLANNER_DEBOUNCE_SECONDS", 0)
+    smart_scheduler.tasks_collection.insert_one({"username": user, "name": "Essay", "task_type": "assignment",
+                                                 "deadline": (datetime.now() + timedelta(days=2)).isoformat()})
+    job = smart_scheduler.submit_planner_job(user, {})
+    for _ in range(100):
+        stored = smart_scheduler.get_planner_job(user, job["job_id"])
+        if stored["status"] not in ("queued", "running"):
+            break
+        time.sleep(0.05)
+    assert stored["status"] == "done"
+    assert stored["result"]["status"] == "success"
+    assert smart_scheduler.plan_blocks_collection.count_documents({"username": user}) == 2  # An assignment takes 2 blocks
+
+
+def test_acquire_leases_skips_leases_held_elsewhere(mongo):
+    smart_scheduler.leases_collection.insert_one({"_id": "planner:bob", "holder": "another-process",
+                                                  "expires_at": datetime.now() + timedelta(minutes=1)})
+    names = ["planner:alice", "planner:bob", "planner:carol"]
+    assert smart_scheduler.acquire_leases(names, 60) == {"planner:alice", "planner:carol"}
+    smart_scheduler.release_leases(names)
+    assert [lease["_id"] for lease in smart_scheduler.leases_collection.find()] == ["planner:bob"]
@@ -0,0 +1,21 @@
+import app as smart_scheduler
+from app import parse_priority_choices
+
+
+def test_single_choice_is_taken_verbatim():
+    assert parse_priority_choices("User priority choice: [CS101] Essay") == ["[CS101] Essay"]
+    assert parse_priority_choices("User priority choice: Auto") == ["Auto"]
+
+
+def test_group_choices_are_a_json_list_of_names():
+    assert parse_priority_choices('User priority choices: ["[CS101] Essay", "Lab"]') == ["[CS101] Essay", "Lab"]
+    assert parse_priority_choices("User priority choices: [CS101] Essay") is None
+    assert parse_priority_choices('User priority choices: {"name": "Lab"}') is None
+    assert parse_priority_choices('User priority choices: ["Lab", 3]') is None
+
+
+def test_malformed_choice_gets_an_error_reply(client, user):
+    response = client.post("/chat", json={"message": "User priority choices: [oops", "year": "2025"})
+    assert response.status_code == 200
+    assert "couldn't read that choice" in response.json["reply"]
+    assert smart_scheduler.load_chat_history(user) == []
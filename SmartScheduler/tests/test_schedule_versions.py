@@ -0,0 +1,69 @@
+import app as smart_scheduler
+
+
+def get_schedule(client, **headers):
+    return client.get("/get_schedule", headers=headers)
+
+
+def test_etag_changes_after_each_write(client, user):
+    first = get_schedule(client)
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert get_schedule(client, **{"If-None-Match": etag}).status_code == 304
+
+    smart_scheduler.update_user_data(user, "task", {"name": "Essay", "task_type": "assignment",
+                                                    "deadline": "2099-01-01T12:00:00"})
+    second = get_schedule(client, **{"If-None-Match": etag})
+    assert second.status_code == 200
+    assert second.headers["ETag"] != etag
+    assert [task["name"] for task in second.json["tasks"]] == ["Essay"]
+
+    smart_scheduler.update_user_data(user, "preference", {"awake_time": "06:00", "sleep_time": "22:00"})
+    third = get_schedule(client, **{"If-None-Match": second.headers["ETag"]})
+    assert third.status_code == 200
+    assert third.json["preferences"] == {"awake_time": "06:00", "sleep_time": "22:00"}
+
+
+def test_noop_write_keeps_the_version(client, user):
+    smart_scheduler.update_user_data(user, "preference", {"awake_time": "07:00", "sleep_time": "23:00"})
+    version = get_schedule(client).json["version"]
+    # Same preferences again: nothing modified, so no new version
+    smart_scheduler.update_user_data(user, "preference", {"awake_time": "07:00", "sleep_time": "23:00"})
+    assert get_schedule(client).json["version"] == version
+
+
+def test_since_returns_only_changed_sections(client, user):
+    version = get_schedule(client).json["version"]
+    smart_scheduler.update_user_data(user, "class", {"subject": "Math", "day": "Monday",
+                                                     "start_time": "09:00", "end_time": "10:00"})
+    delta = client.get(f"/get_schedule?since={version}").json
+    assert delta["delta"] is True
+    assert [cls["subject"] for cls in delta["schedule"]] == ["Math"]
+    assert "tasks" not in delta and "generated_plan" not in delta and "preferences" not in delta
+
+
+def test_merged_and_unmerged_plans_have_different_etags(client):
+    assert client.get("/get_schedule?merge=1").headers["ETag"] != get_schedule(client).headers["ETag"]
+
+
+def plan_block(date, hour, task):
+    return {"date": date, "start_time": f"{hour:02d}:00", "end_time": f"{hour + 1:02d}:00", "task": task}
+
+
+def test_since_returns_only_the_days_the_planner_changed(client, user):
+    monday = [plan_block("2099-01-05", hour, "Work on Essay") for hour in (9, 10)]
+    tuesday = [plan_block("2099-01-06", 9, "Work on Lab")]
+    smart_scheduler._apply_plan_change(user, {"replace": monday + tuesday, "dates": ["2099-01-05", "2099-01-06"]})
+    version = get_schedule(client).json["version"]
+
+    smart_scheduler._apply_plan_change(user, {"drop": [monday[1]], "add": [plan_block("2099-01-05", 11, "Work on Lab")]})
+    delta = client.get(f"/get_schedule?merge=1&since={version}").json
+    assert "generated_plan" not in delta
+    assert delta["generated_plan_changes"] == {"dates": ["2099-01-05"], "blocks": [
+        plan_block("2099-01-05", 9, "Work on Essay"), plan_block("2099-01-05", 11, "Work on Lab")]}
+
+    # A plan write the log does not cover sends the whole plan again
+    smart_scheduler.delete_schedule_item_db(user, {"item_name": "Lab"})
+    delta = client.get(f"/get_schedule?since={version}").json
+    assert "generated_plan_changes" not in delta
+    assert delta["generated_plan"] == [plan_block("2099-01-05", 9, "Work on Essay")]
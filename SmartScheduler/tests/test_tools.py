@@ -0,0 +1,36 @@
+import app as smart_scheduler
+
+
+def add_item_with_blocks(username, name):
+    smart_scheduler.tasks_collection.insert_one({"username": username, "name": name, "task_type": "assignment",
+                                                 "deadline": "2099-01-01T12:00:00"})
+    smart_scheduler.plan_blocks_collection.insert_one({"username": username, "date": "2099-01-01",
+                                                       "start_time": "09:00", "end_time": "10:00",
+                                                       "task": f"Work on {name}"})
+
+
+def plan_tasks(username):
+    return sorted(block["task"] for block in smart_scheduler.plan_blocks_collection.find({"username": username}))
+
+
+def test_rename_moves_only_that_items_blocks(user):
+    add_item_with_blocks(user, "Lab")
+    add_item_with_blocks(user, "Lab Report")
+    add_item_with_blocks(user, "C++ (intro)")
+    smart_scheduler.update_task_details_db(user, {"current_name": "Lab", "new_name": "Chem Lab"})
+    smart_scheduler.update_task_details_db(user, {"current_name": "C++ (intro)", "new_name": "C++"})
+    assert plan_tasks(user) == ["Work on C++", "Work on Chem Lab", "Work on Lab Report"]
+
+
+def test_rename_of_a_missing_item_changes_nothing(user):
+    add_item_with_blocks(user, "Lab Report")
+    reply = smart_scheduler.update_task_details_db(user, {"current_name": "Lab", "new_name": "Chem Lab"})
+    assert reply == "Sorry, I couldn't find an item named 'Lab' to update."
+    assert plan_tasks(user) == ["Work on Lab Report"]
+
+
+def test_delete_removes_only_that_items_blocks(user):
+    add_item_with_blocks(user, "Lab")
+    add_item_with_blocks(user, "Lab Report")
+    smart_scheduler.delete_schedule_item_db(user, {"item_name": "Lab"})
+    assert plan_tasks(user) == ["Work on Lab Report"]
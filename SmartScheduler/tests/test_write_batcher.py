@@ -0,0 +1,81 @@
+import pytest
+
+import app as smart_scheduler
+from app import flush_writes, new_write_batch, queue_write
+
+
+def test_back_to_back_sets_merge_into_one_write(user):
+    batch = new_write_batch()
+    first = queue_write(batch, smart_scheduler.users_collection, "update_one",
+                        {"username": user}, {"$set": {"preferences": {"awake_time": "06:00"}}})
+    second = queue_write(batch, smart_scheduler.users_collection, "update_one",
+                         {"username": user}, {"$set": {"study_windows": [{"day": "Monday"}]}}, counted=True)
+    assert first is second
+    assert len(batch["writes"]) == 1
+
+    flush_writes(batch)
+    assert first["count"] == 1
+    saved = smart_scheduler.users_collection.find_one({"username": user})
+    assert saved["preferences"] == {"awake_time": "06:00"}
+    assert saved["study_windows"] == [{"day": "Monday"}]
+
+
+def test_counts_cover_inserts_updates_and_deletes(user):
+    tasks = smart_scheduler.tasks_collection
+    batch = new_write_batch()
+    inserts = [queue_write(batch, tasks, "insert_one", {"username": user, "name": name}) for name in "ABC"]
+    flush_writes(batch)
+    assert [write["count"] for write in inserts] == [3, 3, 3]  # One chunk shares its inserted_count
+
+    batch = new_write_batch()
+    renamed = queue_write(batch, tasks, "update_one", {"username": user, "name": "A"},
+                          {"$set": {"name": "A2"}}, counted=True)
+    missing = queue_write(batch, tasks, "update_one", {"username": user, "name": "Z"},
+                          {"$set": {"name": "Z2"}}, counted=True)
+    deleted = queue_write(batch, tasks, "delete_many", {"username": user, "name": {"$in": ["B", "C"]}}, counted=True)
+    nothing = queue_write(batch, tasks, "delete_many", {"username": user, "name": "Q"}, counted=True)
+    flush_writes(batch)
+    assert (renamed["count"], missing["count"], deleted["count"], nothing["count"]) == (1, 0, 2, 0)
+    assert [task["name"] for task in tasks.find({"username": user})] == ["A2"]
+
+
+def test_counted_writes_get_their_own_chunk():
+    class Collection:
+        name = "tasks"
+
+    collection = Collection()
+    batch = new_write_batch()
+    queue_write(batch, collection, "update_one", {"name": "A"}, {"$set": {"x": 1}})
+    queue_write(batch, collection, "update_one", {"name": "B"}, {"$set": {"x": 1}}, counted=True)
+    queue_write(batch, collection, "delete_many", {"name": "C"})
+    queue_write(batch, collection, "update_one", {"name": "D"}, {"$set": {"x": 1}})
+    chunks = [[write["args"][0]["name"] for write in chunk]
+              for _, chunk in smart_scheduler._collection_chunks(batch["writes"])]
+    assert chunks == [["A"], ["B", "C"], ["D"]]
+
+
+def test_versions_are_bumped_only_for_changed_sections(user):
+    before = smart_scheduler.get_data_versions(user, "test")
+    batch = new_write_batch()
+    queue_write(batch, smart_scheduler.tasks_collection, "insert_one", {"username": user, "name": "A"})
+    queue_write(batch, smart_scheduler.tests_collection, "delete_many", {"username": user, "name": "nothing"})
+    flush_writes(batch)
+    after = smart_scheduler.get_data_versions(user, "test")
+    assert after == dict(before, tasks=before["tasks"] + 1)
+
+
+def test_versions_are_bumped_for_writes_sent_before_a_failure(user, monkeypatch):
+    before = smart_scheduler.get_data_versions(user, "test")
+
+    def failing_bulk_write(operations, ordered=True):
+        raise RuntimeError("connection reset")
+
+    monkeypatch.setattr(smart_scheduler.tests_collection, "bulk_write", failing_bulk_write)
+    batch = new_write_batch()
+    queue_write(batch, smart_scheduler.tasks_collection, "insert_one", {"username": user, "name": "A"})
+    queue_write(batch, smart_scheduler.tests_collection, "insert_one", {"username": user, "name": "B"})
+    with pytest.raises(RuntimeError):
+        flush_writes(batch)
+    after = smart_scheduler.get_data_versions(user, "test")
+    # The task was saved; the test may or may not have been, so its section moves too
+    assert after == dict(before, tasks=before["tasks"] + 1, tests=before["tests"] + 1)